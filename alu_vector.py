@@ -0,0 +1,85 @@
+from dataclasses import dataclass
+from typing import Iterable, Iterator
+
+import numpy as np
+
+
+# alu64 and shift64 from cpu5arm.v evaluated over whole NumPy arrays of operands at once, with the same
+# bit-level results as the scalar versions in cpu5arm_model
+LOW63 = np.uint64((1 << 63) - 1)
+
+
+@dataclass
+class AluResult:
+  d: np.ndarray
+  Cout: np.ndarray
+  V: np.ndarray
+  Z_flag: np.ndarray
+  N: np.ndarray
+
+
+def alu64(a: np.ndarray, b: np.ndarray, Cin: np.ndarray, S: np.ndarray):
+  a = np.asarray(a, dtype=np.uint64)
+  b = np.asarray(b, dtype=np.uint64)
+  Cin = np.asarray(Cin, dtype=np.uint64) & np.uint64(1)
+  S = np.asarray(S, dtype=np.uint8) & np.uint8(0b111)
+  # alu_cell inverts b when S[0] is set; uint64 sums wrap, so the carries come from the wrap-arounds
+  b_in = np.where(S & np.uint8(1), ~b, b)
+  partial = a + b_in
+  total = partial + Cin
+  Cout = (partial < a) | (total < partial)
+  carry_into_top = ((a & LOW63) + (b_in & LOW63) + Cin) >> np.uint64(63)
+  V = Cout ^ carry_into_top.astype(bool)
+  d = np.select(
+    [S == 0b100, S == 0b101, S == 0b110, (S & np.uint8(0b010)).astype(bool)],
+    [a | b, ~(a | b), a & b, total],
+    default=a ^ b_in,
+  )
+  return AluResult(d=d, Cout=Cout, V=V, Z_flag=d == 0, N=(d >> np.uint64(63)).astype(bool))
+
+
+def shift64(val: np.ndarray, shamt: np.ndarray, lsl: np.ndarray, lsr: np.ndarray):
+  val = np.asarray(val, dtype=np.uint64)
+  shamt = np.asarray(shamt, dtype=np.uint64) & np.uint64(0x3F)
+  lsl = np.asarray(lsl, dtype=bool)
+  lsr = np.asarray(lsr, dtype=bool)
+  return np.where(lsl, val << shamt, np.where(lsr, val >> shamt, val))
+
+
+def evaluate(a, b, Cin, S, shamt, lsl, lsr):
+  # the EX stage of cpu5arm: alu64 and shift64 side by side, op_out_mux picking the shifter for LSL and LSR
+  result = alu64(a, b, Cin, S)
+  lsl = np.asarray(lsl, dtype=bool)
+  lsr = np.asarray(lsr, dtype=bool)
+  result.d = np.where(lsl | lsr, shift64(a, shamt, lsl, lsr), result.d)
+  return result
+
+
+def sweep(chunks: Iterable[dict]) -> Iterator[AluResult]:
+  # evaluates a stream of operand chunks (dicts of a, b, Cin, S, shamt, lsl, lsr arrays) one at a time,
+  # so a sweep only ever holds one chunk of operands and results
+  for chunk in chunks: yield evaluate(**chunk)
+
+
+def random_operands(count: int, chunk_size: int = 1 << 20, seed: int = 0, corner_fraction: float = 0.125):
+  # chunks of random operands in which a fraction of a and b are swapped for values around 0, 2^63 and
+  # 2^64, where the carry, overflow, zero and negative flags flip
+  rng = np.random.default_rng(seed)
+  corners = np.array([0, 1, 2, (1 << 63) - 2, (1 << 63) - 1, 1 << 63, (1 << 63) + 1, (1 << 64) - 2, (1 << 64) - 1], dtype=np.uint64)
+  remaining = count
+  while remaining > 0:
+    size = min(chunk_size, remaining)
+    remaining -= size
+    chunk = {
+      "a": rng.integers(0, 1 << 64, size, dtype=np.uint64, endpoint=False),
+      "b": rng.integers(0, 1 << 64, size, dtype=np.uint64, endpoint=False),
+      "Cin": rng.integers(0, 2, size, dtype=np.uint8),
+      "S": rng.integers(0, 8, size, dtype=np.uint8),
+      "shamt": rng.integers(0, 64, size, dtype=np.uint8),
+      "lsl": rng.random(size) < 0.125,
+      "lsr": rng.random(size) < 0.125,
+    }
+    for operand in ("a", "b"):
+      use_corner = rng.random(size) < corner_fraction
+      chunk[operand] = np.where(use_corner, corners[rng.integers(0, len(corners), size)], chunk[operand])
+    yield chunk
@@ -0,0 +1,45 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import cpu5arm_model
+from alu_vector import random_operands, sweep
+
+
+def check(samples, seed):
+  # every lane of one chunk against the scalar alu64/shift64 of the pipeline model
+  chunk = next(random_operands(samples, chunk_size=samples, seed=seed))
+  result = next(sweep([chunk]))
+  for i in range(samples):
+    a, b, Cin, S = int(chunk["a"][i]), int(chunk["b"][i]), int(chunk["Cin"][i]), int(chunk["S"][i])
+    d, Cout, V, Z, N = cpu5arm_model.alu64(a, b, Cin, S)
+    if chunk["lsl"][i] or chunk["lsr"][i]: d = cpu5arm_model.shift64(a, int(chunk["shamt"][i]), bool(chunk["lsl"][i]), bool(chunk["lsr"][i]))
+    expected = (d, Cout, V, Z, N)
+    actual = (int(result.d[i]), int(result.Cout[i]), int(result.V[i]), int(result.Z_flag[i]), int(result.N[i]))
+    if actual != expected: raise AssertionError(f"lane {i}: a={a:#x} b={b:#x} Cin={Cin} S={S:03b}: got {actual}, expected {expected}")
+
+
+def run(count, chunk_size):
+  check(20000, seed=1)
+  operations = 0
+  overflows = 0
+  evaluating = 0.0
+  start = time.perf_counter()
+  for chunk in random_operands(count, chunk_size=chunk_size):
+    chunk_start = time.perf_counter()
+    result = next(sweep([chunk]))
+    evaluating += time.perf_counter() - chunk_start
+    operations += len(result.d)
+    overflows += int(result.V.sum())
+  elapsed = time.perf_counter() - start
+  print(f"{operations:,} operations with {chunk_size:,}-operand chunks, {overflows:,} overflows")
+  print(f"evaluation:               {operations / evaluating / 1e6:7.1f} M ops/s")
+  print(f"including operand stream: {operations / elapsed / 1e6:7.1f} M ops/s")
+
+
+if __name__ == '__main__':
+  # python benchmarks/alu_throughput.py [operations] [chunk size]
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 1 << 24
+  chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1 << 20
+  run(count, chunk_size)
@@ -0,0 +1,78 @@
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import cpu5arm_model
+from schematic_generator import load_modules, read_file_list, read_sources
+from schematic_simulator import Simulator, pack, unpack
+
+
+def replay_testbench(simulator: Simulator, testbench):
+  # cpu5armtb's clocking, like cpu5arm_model.run_testbench: the load data is only driven while clk is
+  # low, so databus reads as the processor's own store data after the rising edge
+  vectors = testbench.vectors
+  lanes = simulator.lanes
+  value = (lambda number, width: pack([number] * lanes, width)) if lanes else (lambda number, width: number)
+  read = (lambda planes: set(unpack(planes, lanes))) if lanes else (lambda number: {number})
+  for _ in range(2):
+    simulator.posedge({"reset": value(1, 1)})
+    simulator.negedge({"reset": value(1, 1)})
+  mismatches = 0
+  instrbus = 0
+  for k in range(testbench.count):
+    databusk = vectors["databusin"].get(k - 4) if k >= 4 else None
+    simulator.posedge({"ibus": value(instrbus, 32), "reset": value(int(k == 0), 1), "databus": value(databusk or 0, 64)})
+    outputs = simulator.evaluate({"ibus": value(instrbus, 32), "reset": value(int(k == 0), 1)})
+    checks = [(vectors["iaddrbusout"].get(k), outputs["iaddrbus"])]
+    if k >= 3 and k - 3 not in testbench.skipped:
+      checks.append((vectors["daddrbusout"].get(k - 3), outputs["daddrbus"]))
+      checks.append((vectors["databusout"].get(k - 3), outputs["databus"]))
+    mismatches += sum(1 for expected, actual in checks if expected is not None and read(actual) != {expected})
+    instrbus = vectors["instrbusin"].get(k) or 0
+    simulator.negedge({"ibus": value(instrbus, 32), "databus": value(databusk or 0, 64)})
+  return mismatches
+
+
+def check_lanes(modules, top, lanes, cycles, seed):
+  # every lane of the bit-parallel simulator against its own scalar simulator, on random inputs
+  rng = random.Random(seed)
+  parallel = Simulator(modules, top, lanes=lanes)
+  scalars = [Simulator(modules, top) for _ in range(lanes)]
+  for cycle in range(cycles):
+    stimulus = [{name: rng.getrandbits(width) for name, width in parallel.inputs.items()} for _ in range(lanes)]
+    outputs = parallel.cycle({name: pack([inputs[name] for inputs in stimulus], width) for name, width in parallel.inputs.items()})
+    for lane, (scalar, inputs) in enumerate(zip(scalars, stimulus)):
+      expected = scalar.cycle(inputs)
+      for name, planes in outputs.items():
+        if unpack(planes, lanes)[lane] != expected[name]: raise AssertionError(f"{top} cycle {cycle} lane {lane}: {name} differs from the scalar simulator")
+
+
+def run(cycles, lanes):
+  modules = load_modules(read_sources(read_file_list(os.path.join(ROOT, "files.txt"))))
+  testbench = cpu5arm_model.load_testbench(os.path.join(ROOT, "cpu5armtb.v"))
+  for simulator in (Simulator(modules, "cpu5arm"), Simulator(modules, "cpu5arm", lanes=8)):
+    mismatches = replay_testbench(simulator, testbench)
+    if mismatches: raise AssertionError(f"{mismatches} cpu5armtb mismatches with lanes={simulator.lanes}")
+  check_lanes(modules, "cpu5arm", 4, 20, seed=1)
+
+  for lane_count in (None, lanes):
+    start = time.perf_counter()
+    simulator = Simulator(modules, "cpu5arm", lanes=lane_count)
+    compile_time = time.perf_counter() - start
+    program = [{"ibus": value, "reset": 0} for value in testbench.vectors["instrbusin"].values()]
+    if lane_count: program = [{"ibus": pack([inputs["ibus"]] * lane_count, 32), "reset": [0]} for inputs in program]
+    start = time.perf_counter()
+    for k in range(cycles): simulator.cycle(program[k % len(program)])
+    rate = cycles / (time.perf_counter() - start)
+    label = f"{lane_count} lanes" if lane_count else "scalar"
+    print(f"{label:>9}: compiled in {compile_time:5.2f}s, {rate:10,.0f} cycles/s, {rate * (lane_count or 1):12,.0f} vector-cycles/s")
+
+
+if __name__ == '__main__':
+  # python benchmarks/compiled_simulator.py [cycles] [lanes]
+  cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+  lanes = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+  run(cycles, lanes)
@@ -0,0 +1,125 @@
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+from schematic_generator import Block, Input, Reg, Schematic, Wire, extract_netlist
+from schematic_graph import SchematicGraph
+
+
+def object_schematic(count, fanout, seed):
+  # a layered netlist of count nodes the way the DFS leaves it: objects in Schematic.nodes and node_visited,
+  # each node driving about fanout nodes of later layers
+  rng = random.Random(seed)
+  schematic = Schematic("synthetic")
+  for k in range(64): schematic.add_input(Input(name=f"in{k}"))
+  node_types = [Wire] * 8 + [Reg, Block]
+  for k in range(len(schematic.nodes), count):
+    node_type = node_types[k % len(node_types)]
+    node = node_type(name=f"n{k}")
+    if node_type is Block: node.module_name = "cell"
+    schematic.nodes[node.name] = node
+    schematic.node_visited[node.name] = False
+  nodes = list(schematic.nodes.values())
+  for k, node in enumerate(nodes[:-1]):
+    for _ in range(fanout): node.outputs.append(nodes[rng.randrange(k + 1, min(len(nodes), k + 1000))])
+  return schematic
+
+
+def object_bytes(schematic: Schematic):
+  # bytes held by the node objects, their outputs lists and names, and the dicts of the schematic, not counting
+  # the gate trees and module names, the same things SchematicGraph.nbytes counts
+  size = sys.getsizeof(schematic.nodes) + sys.getsizeof(schematic.node_visited) + sys.getsizeof(schematic.inputs)
+  for node in schematic.nodes.values():
+    size += sys.getsizeof(node) + sys.getsizeof(node.outputs) + sys.getsizeof(node.name)
+    if isinstance(node, Block): size += sys.getsizeof(node.input_nums)
+  return size
+
+
+def walk_objects(schematic: Schematic):
+  seen = set()
+  work = list(schematic.inputs)
+  for node in work: seen.add(node.name)
+  while work:
+    node = work.pop()
+    for output in node.outputs:
+      if output.name not in seen:
+        seen.add(output.name)
+        work.append(output)
+  return len(seen)
+
+
+def run(count, fanout):
+  schematic = object_schematic(count, fanout, seed=1)
+  start = time.perf_counter()
+  graph = SchematicGraph.from_schematic(schematic)
+  compact_time = time.perf_counter() - start
+  objects_size, graph_size = object_bytes(schematic), graph.nbytes()
+  print(f"{count:,} nodes, {count * fanout:,} edges, packed in {compact_time:.2f}s")
+  print(f"  objects: {objects_size / 1e6:8.1f} MB")
+  print(f"  graph:   {graph_size / 1e6:8.1f} MB  ({objects_size / graph_size:.1f}x smaller)")
+
+  start = time.perf_counter()
+  reached = walk_objects(schematic)
+  object_time = time.perf_counter() - start
+  start = time.perf_counter()
+  graph_reached = len(graph.reachable(graph.inputs))
+  graph_time = time.perf_counter() - start
+  if reached != graph_reached: raise AssertionError(f"object walk reached {reached} nodes, graph walk {graph_reached}")
+  print(f"  walk from the inputs: objects {object_time:.2f}s, graph {graph_time:.2f}s ({object_time / graph_time:.1f}x)")
+
+
+def memory(count, fanout):
+  # the graph is packed from finished objects, so the peak is the objects plus the graph either way; only
+  # what is held afterwards drops, and only when the objects are released
+  for release in (False, True):
+    tracemalloc.start()
+    schematic = object_schematic(count, fanout, seed=1)
+    graph = SchematicGraph.from_schematic(schematic, release)
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"  {'released' if release else 'kept':<8} peak {peak / 1e6:8.1f} MB, held after packing {held / 1e6:8.1f} MB")
+    del schematic, graph
+
+
+def grid_design(rows, cells):
+  # Verilog of a grid module with a chain of rows instances, each a chain of cells instances of four gates
+  lines = ["module cell(y, a, b);", "  input a, b;", "  output y;", "  wire p, q, r;", "  assign p = a & b;", "  assign q = a ^ b;", "  assign r = p | q;", "  assign y = ~r;", "endmodule"]
+  for name, child, count in (("row", "cell", cells), ("grid", "row", rows)):
+    lines += [f"module {name}(y, a, b);", "  input a, b;", "  output y;"]
+    previous = "a"
+    for k in range(count):
+      lines += [f"  wire w{k};", f"  {child} u{k}(.y(w{k}), .a({previous}), .b(b));"]
+      previous = f"w{k}"
+    lines += [f"  assign y = {previous};", "endmodule"]
+  return "\n".join(lines) + "\n"
+
+
+def extraction(rows, cells):
+  # the grid elaborated into one flat netlist, once as node objects packed with compact(release=True) and
+  # once with compact=True, where the DFS and the elaboration fill the graph and no node objects are made
+  text = grid_design(rows, cells)
+  for compact in (False, True):
+    tracemalloc.start()
+    start = time.perf_counter()
+    graph = extract_netlist("grid", texts=[text], depth=2, compact=compact)
+    if not compact: graph = graph.compact(release=True)
+    elapsed = time.perf_counter() - start
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if compact and graph.name_text != packed.name_text: raise AssertionError("compact=True built a different graph")
+    label = "compact=True" if compact else "objects"
+    print(f"  {label:<12} {len(graph):,} nodes, peak {peak / 1e6:8.1f} MB, held {held / 1e6:8.1f} MB, {elapsed:.1f}s traced")
+    packed = graph
+
+
+if __name__ == '__main__':
+  # python benchmarks/graph_store.py [nodes] [fanout] [rows] [cells]
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+  fanout = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+  run(count, fanout)
+  memory(count, fanout)
+  extraction(int(sys.argv[3]) if len(sys.argv) > 3 else 300, int(sys.argv[4]) if len(sys.argv) > 4 else 100)
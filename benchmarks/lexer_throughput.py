@@ -0,0 +1,55 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from schematic_generator import strip_verilog, tokenize_line
+
+
+# character-at-a-time lexer the compiled one replaced, kept to check the tokens match and to compare speed
+def reference_tokenize_line(line):
+  tokens = []
+  current_token = ""
+  for char in line:
+    if current_token == "" and char == " ": continue
+    elif char not in " ,:?;&|+-*=.":
+      current_token += char
+    else:
+      if current_token != "": tokens.append(current_token)
+      current_token = ""
+      if char != " ": tokens.append(char)
+  if current_token != "": tokens.append(current_token)
+  return tokens
+
+
+def throughput(function, argument, size, repeat):
+  start = time.perf_counter()
+  for _ in range(repeat): function(argument)
+  elapsed = time.perf_counter() - start
+  return size * repeat / elapsed / 1e6
+
+
+def run(paths, repeat):
+  source_lines = []
+  for path in paths:
+    with open(path, "r") as f: source_lines += f.readlines()
+  source_size = sum(len(line) for line in source_lines)
+  stripped = strip_verilog(source_lines)
+  stripped_size = sum(len(line) for line in stripped)
+
+  tokens = [tokenize_line(line) for line in stripped]
+  if tokens != [reference_tokenize_line(line) for line in stripped]: raise AssertionError("compiled lexer tokens differ from the reference lexer")
+
+  print(f"source: {source_size/1e6:.3f} MB in {len(source_lines)} lines, {len(stripped)} statements after stripping")
+  print(f"strip_verilog:           {throughput(strip_verilog, source_lines, source_size, repeat):8.2f} MB/s")
+  tokenize_all = lambda lines: [tokenize_line(line) for line in lines]
+  reference_all = lambda lines: [reference_tokenize_line(line) for line in lines]
+  print(f"tokenize_line:           {throughput(tokenize_all, stripped, stripped_size, repeat):8.2f} MB/s")
+  print(f"reference tokenize_line: {throughput(reference_all, stripped, stripped_size, repeat):8.2f} MB/s")
+
+
+if __name__ == '__main__':
+  # python benchmarks/lexer_throughput.py [repeat] [verilog files...]
+  repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+  paths = sys.argv[2:] or [os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cpu5arm.v")]
+  run(paths, repeat)
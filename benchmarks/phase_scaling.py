@@ -0,0 +1,165 @@
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, replace
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from schematic_generator import build_gate, build_module_table, build_schematic, parse_expression, render_dot, strip_verilog
+from synthetic_verilog import DesignShape, generate_design
+
+# each sweep varies one parameter of the base shape; SWEEP_SIZES gives the size the phase times are fitted
+# against, the leaves of an expression for depth
+SWEEP_SIZES = {"modules": lambda value: value, "wires": lambda value: value, "fanout": lambda value: value, "depth": lambda value: 2 ** value, "array": lambda value: value}
+SWEEPS = {
+  "modules": [2, 8, 32],
+  "wires": [8, 32, 128],
+  "fanout": [2, 4, 16],
+  "depth": [1, 3, 5],
+  "array": [2, 8, 32],
+}
+PHASES = ["strip_verilog", "module_table", "fanout_index", "build_gate", "dfs", "emit_dot", "render"]
+
+
+def time_phases(text, top, render_directory=None):
+  # the phases of generate_schematic one after another. build_gate parses every statement with the
+  # parser cache cleared first, so the dfs after it finds the gates already parsed and times the search alone
+  timings = {}
+  clock = time.perf_counter
+  start = clock()
+  stripped = strip_verilog(io.StringIO(text, newline=None))
+  timings["strip_verilog"] = clock() - start
+  start = clock()
+  modules = build_module_table(stripped)
+  timings["module_table"] = clock() - start
+  start = clock()
+  for module in modules.values(): module.fanout()
+  timings["fanout_index"] = clock() - start
+  parse_expression.cache_clear()
+  start = clock()
+  for module in modules.values():
+    for tokens, _ in module.fanout().statements.values():
+      if len(tokens) > 5: build_gate(tokens[3:-1])
+  timings["build_gate"] = clock() - start
+  # every module as a top, like --all
+  start = clock()
+  schematics = [build_schematic(modules, name) for name in modules]
+  timings["dfs"] = clock() - start
+  start = clock()
+  dot_texts = [schematic.dot_source() for schematic in schematics]
+  timings["emit_dot"] = clock() - start
+  dot_text = dot_texts[list(modules).index(top)]
+  # without Graphviz the DOT text is the end product and the render is skipped
+  timings["render"] = None
+  if render_directory is not None:
+    start = clock()
+    render_dot(dot_text, os.path.join(render_directory, top), format="png")
+    timings["render"] = clock() - start
+  counts = {"source_bytes": len(text), "statements": len(stripped), "modules": len(modules), "nodes": sum(len(schematic.nodes) for schematic in schematics), "dot_bytes": sum(len(dot) for dot in dot_texts)}
+  return timings, counts
+
+
+def measure(shape: DesignShape, repeat, render_directory):
+  # the fastest of repeat runs of each phase
+  text, top = generate_design(shape)
+  best = None
+  for _ in range(repeat):
+    timings, counts = time_phases(text, top, render_directory)
+    best = timings if best is None else {phase: None if seconds is None else min(seconds, best[phase]) for phase, seconds in timings.items()}
+  return {"shape": asdict(shape), "label": shape.label(), "counts": counts, "phases": best}
+
+
+def scaling_exponents(sweep, results):
+  # k in time ~ size**k from the smallest to the largest design of a sweep: about 1 for a phase linear in
+  # the swept parameter, 2 for quadratic, 0 for a phase it doesn't affect
+  first, last = results[0], results[-1]
+  size_ratio = SWEEP_SIZES[sweep](last["shape"][sweep]) / SWEEP_SIZES[sweep](first["shape"][sweep])
+  exponents = {}
+  for phase in PHASES:
+    before, after = first["phases"][phase], last["phases"][phase]
+    if before and after and size_ratio > 1: exponents[phase] = round(math.log(after / before) / math.log(size_ratio), 3)
+  return {"sweep": sweep, "exponents": exponents}
+
+
+def git_commit():
+  try: return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError): return None
+
+
+def run(sweeps, repeat, render):
+  base = DesignShape()
+  measured = {}
+  scaling = []
+  with tempfile.TemporaryDirectory() as render_directory:
+    for sweep, values in sweeps.items():
+      results = []
+      for value in values:
+        shape = replace(base, **{sweep: value})
+        if shape not in measured: measured[shape] = measure(shape, repeat, render_directory if render else None)
+        results.append(measured[shape])
+        timings = measured[shape]["phases"]
+        print(f"{shape.label():<40} " + " ".join(f"{phase}={timings[phase] * 1e3:.1f}ms" for phase in PHASES if timings[phase] is not None))
+      scaling.append(scaling_exponents(sweep, results))
+  return {
+    "commit": git_commit(),
+    "python": platform.python_version(),
+    "render": render,
+    "repeat": repeat,
+    "designs": list(measured.values()),
+    "scaling": scaling,
+  }
+
+
+def compare(report, baseline, threshold, floor):
+  # phases that got slower than threshold times the baseline on the same design, ignoring phases under floor
+  # seconds, and sweeps whose growth exponent rose by more than 0.3
+  regressions = []
+  previous = {design["label"]: design for design in baseline["designs"]}
+  for design in report["designs"]:
+    if design["label"] not in previous: continue
+    for phase, seconds in design["phases"].items():
+      before = previous[design["label"]]["phases"].get(phase)
+      if seconds is None or not before or seconds < floor: continue
+      if seconds / before > threshold: regressions.append(f"{design['label']} {phase}: {before * 1e3:.1f}ms -> {seconds * 1e3:.1f}ms")
+  previous_scaling = {entry["sweep"]: entry["exponents"] for entry in baseline["scaling"]}
+  for entry in report["scaling"]:
+    for phase, exponent in entry["exponents"].items():
+      before = previous_scaling.get(entry["sweep"], {}).get(phase)
+      if before is not None and exponent - before > 0.3: regressions.append(f"{entry['sweep']} sweep {phase}: scaling exponent {before} -> {exponent}")
+  return regressions
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Time each phase of the schematic generator on synthetic designs of growing size.")
+  parser.add_argument("--sweep", action="append", choices=list(SWEEPS), help="parameter to sweep; repeat for several (default: all)")
+  parser.add_argument("--quick", action="store_true", help="only the two smallest designs of each sweep")
+  parser.add_argument("--repeat", type=int, default=3, help="runs per design, the fastest is kept (default: 3)")
+  parser.add_argument("--output", metavar="PATH", help="write the results as JSON to PATH")
+  parser.add_argument("--compare", metavar="PATH", help="JSON results of an earlier run to check for regressions")
+  parser.add_argument("--threshold", type=float, default=1.5, help="slowdown ratio that counts as a regression (default: 1.5)")
+  parser.add_argument("--floor", type=float, default=0.005, help="ignore phases faster than this many seconds (default: 0.005)")
+  args = parser.parse_args(argv)
+
+  sweeps = {name: values[:2] if args.quick else values for name, values in SWEEPS.items() if not args.sweep or name in args.sweep}
+  # the render phase needs the Graphviz dot program; everything before it runs without Graphviz
+  report = run(sweeps, args.repeat, render=shutil.which("dot") is not None)
+  for entry in report["scaling"]: print(f"{entry['sweep']} sweep exponents: " + ", ".join(f"{phase} {exponent}" for phase, exponent in entry["exponents"].items()))
+  if args.output:
+    with open(args.output, "w") as f: json.dump(report, f, indent=2)
+  if args.compare:
+    with open(args.compare) as f: regressions = compare(report, json.load(f), args.threshold, args.floor)
+    for regression in regressions: print(f"regression: {regression}")
+    if regressions: sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
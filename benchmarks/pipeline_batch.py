@@ -0,0 +1,45 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from cpu5arm_asm import StressProgram
+from cpu5arm_batch import Cpu5armBatch
+from cpu5arm_model import Cpu5arm
+
+
+def check(batch, programs, cycles, samples):
+  # the first lanes against the scalar pipeline model, which also gives its speed on the same programs
+  elapsed = 0.0
+  for lane in range(min(samples, batch.lanes)):
+    cpu = Cpu5arm()
+    start = time.perf_counter()
+    memory = cpu.run(programs[lane], {}, cycles)
+    elapsed += time.perf_counter() - start
+    expected = (cpu.registers, cpu.pc, cpu.flags, memory)
+    actual = (batch.lane_registers(lane), batch.lane_pc(lane), batch.lane_flags(lane), batch.memories[lane])
+    if actual != expected: raise AssertionError(f"lane {lane}: registers, pc, flags and memory {[a == e for a, e in zip(actual, expected)]}")
+  return min(samples, batch.lanes) * cycles / elapsed
+
+
+def run(cycles, lanes, samples=64):
+  # a stress program per lane, half as long again as the run, as branches skip words
+  programs = []
+  for seed in range(lanes):
+    stress = StressProgram(seed)
+    programs.append([stress(4 * index, index) for index in range(cycles * 3 // 2)])
+  batch = Cpu5armBatch(programs)
+  start = time.perf_counter()
+  batch.run(cycles)
+  elapsed = time.perf_counter() - start
+  scalar = check(batch, programs, cycles, samples)
+  print(f"{lanes:,} lanes, {cycles:,} cycles, {batch.instructions:,} instructions")
+  print(f"batch:  {batch.instructions / elapsed / 1e6:7.2f} M instructions/s")
+  print(f"scalar: {scalar / 1e6:7.2f} M instructions/s")
+
+
+if __name__ == '__main__':
+  # python benchmarks/pipeline_batch.py [cycles] [lanes]
+  cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+  lanes = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+  run(cycles, lanes)
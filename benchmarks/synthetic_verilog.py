@@ -0,0 +1,77 @@
+import random
+from dataclasses import asdict, dataclass
+
+OPERATORS = ["&", "|", "^", "+"]
+
+
+@dataclass(frozen=True)
+class DesignShape:
+  modules: int = 8      # stage modules chained in the top module, each its own module definition
+  wires: int = 32       # assigned wires in each stage module
+  fanout: int = 4       # later wires that read each wire
+  depth: int = 3        # nesting depth of each assign expression
+  array: int = 8        # width of the bus and of the bit_cell instance array in each stage
+
+  def label(self):
+    return "-".join(f"{key}{value}" for key, value in asdict(self).items())
+
+
+def expression(operands, depth, rng):
+  # a balanced tree of binary operators with 2**depth leaves, with the odd ~ and ?: mixed in
+  if depth == 0: return operands[rng.randrange(len(operands))]
+  left = expression(operands, depth - 1, rng)
+  right = expression(operands, depth - 1, rng)
+  choice = rng.random()
+  if choice < 0.1: return f"(sel ? {left} : {right})"
+  if choice < 0.2: return f"(~({left} {rng.choice(OPERATORS)} {right}))"
+  return f"({left} {rng.choice(OPERATORS)} {right})"
+
+
+def stage_module(name, shape: DesignShape, rng):
+  # assigns over a sliding window of earlier wires, so each wire is read by about fanout later ones,
+  # then an instance array of bit_cell, a clocked register, and the output
+  bus = f"[{shape.array - 1}:0] "
+  lines = [f"module {name}(out, in0, in1, sel, clk);"]
+  lines.append(f"  input {bus}in0, in1;")
+  lines.append("  input sel, clk;")
+  lines.append(f"  output {bus}out;")
+  signals = ["in0", "in1"]
+  for i in range(shape.wires):
+    lines.append(f"  wire {bus}w{i};")
+    window = signals[-shape.fanout:]
+    lines.append(f"  assign w{i} = {expression(window, shape.depth, rng)};")
+    signals.append(f"w{i}")
+  lines.append(f"  wire {bus}cells_y;")
+  lines.append(f"  bit_cell cells[{shape.array - 1}:0] (")
+  lines.append(f"    .y(cells_y),")
+  lines.append(f"    .a({signals[-1]}),")
+  lines.append(f"    .b({signals[-2]}),")
+  lines.append("    .s(sel)")
+  lines.append("  );")
+  lines.append(f"  reg {bus}q;")
+  lines.append("  always @(posedge clk) begin")
+  lines.append("    q <= cells_y;")
+  lines.append("  end")
+  lines.append(f"  assign out = q ^ {signals[-1]};")
+  lines.append("endmodule")
+  return lines
+
+
+def generate_design(shape: DesignShape, seed=0):
+  # Verilog text and top module name of a design the schematic generator and compiled simulator both read
+  rng = random.Random(seed)
+  bus = f"[{shape.array - 1}:0] "
+  lines = ["module bit_cell(y, a, b, s);", "  input a, b, s;", "  output y;", "  assign y = s ? (a & b) : (a ^ b);", "endmodule", ""]
+  for k in range(shape.modules): lines += stage_module(f"stage{k}", shape, rng) + [""]
+  lines.append("module synthetic_top(a, b, sel, clk, y);")
+  lines.append(f"  input {bus}a, b;")
+  lines.append("  input sel, clk;")
+  lines.append(f"  output {bus}y;")
+  previous = "a"
+  for k in range(shape.modules):
+    lines.append(f"  wire {bus}s{k};")
+    lines.append(f"  stage{k} u{k}(.out(s{k}), .in0({previous}), .in1(b), .sel(sel), .clk(clk));")
+    previous = f"s{k}"
+  lines.append(f"  assign y = {previous};")
+  lines.append("endmodule")
+  return "\n".join(lines) + "\n", "synthetic_top"
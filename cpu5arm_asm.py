@@ -0,0 +1,457 @@
+import argparse
+import os
+import random
+import re
+import sys
+from dataclasses import dataclass
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from cpu5arm_model import B_FORMAT, CB_FORMAT, D_FORMAT, I_FORMAT, IM_FORMAT, R_FORMAT, ZERO_REGISTER, Cpu5arm, decode
+
+
+# assembler for the LEGv8 subset cpu5arm decodes, and a generator of random programs that keep to its
+# pipeline, both turned into cpu5armtb-style vectors by running them on the Python pipeline model
+OPCODES = {name: opcode for table in (R_FORMAT, D_FORMAT, I_FORMAT, IM_FORMAT, CB_FORMAT, B_FORMAT) for opcode, name in table.items()}
+# the README writes the conditional branches B.EQ and the testbench BEQ; both assemble
+CONDITION_NAMES = {"BEQ": "B.EQ", "BNE": "B.NE", "BLT": "B.LT", "BGE": "B.GE"}
+MNEMONICS = {**{name: name for name in OPCODES}, **{text: name for name, text in CONDITION_NAMES.items()}}
+SHIFTS = {"LSL", "LSR"}
+SETS_FLAGS = {"ADDS", "ANDS", "SUBS", "ADDIS", "ANDIS", "SUBIS"}
+# cpu5armtb encodes STUR with 01 in the op2 field and LDUR with 00; the decoder ignores it
+D_OP2 = {"LDUR": 0b00, "STUR": 0b01}
+OPERAND_TOKEN = re.compile(r"<<|#?-?[\w.]+")
+REGISTER = re.compile(r"[RX](\d+)$|XZR$", re.I)
+LABEL = re.compile(r"\s*([A-Za-z_.][\w.]*)\s*:")
+
+
+def field(value, width, what):
+  # legv8_decoder zero-extends every immediate, so offsets are unsigned too and branches only go forward
+  if not 0 <= value < (1 << width): raise ValueError(f"{what} {value} does not fit in {width} unsigned bits")
+  return value
+
+
+def register(number):
+  if not 0 <= number <= ZERO_REGISTER: raise ValueError(f"no register R{number}")
+  return number
+
+
+def encode_r(name, rd, rn, rm=0, shamt=0):
+  # opcode, Rm, shamt, Rn, Rd; the ALU computes Rn op Rm
+  return OPCODES[name] << 21 | register(rm) << 16 | field(shamt, 6, "shift amount") << 10 | register(rn) << 5 | register(rd)
+
+
+def encode_i(name, rd, rn, imm):
+  return OPCODES[name] << 22 | field(imm, 12, "immediate") << 10 | register(rn) << 5 | register(rd)
+
+
+def encode_d(name, rt, rn, offset=0):
+  return OPCODES[name] << 21 | field(offset, 9, "offset") << 12 | D_OP2[name] << 10 | register(rn) << 5 | register(rt)
+
+
+def encode_im(rd, imm, hw=0):
+  return OPCODES["MOVZ"] << 23 | field(hw, 2, "shift") << 21 | field(imm, 16, "immediate") << 5 | register(rd)
+
+
+def encode_b(offset):
+  return OPCODES["B"] << 26 | field(offset, 26, "branch offset")
+
+
+def encode_cb(name, rt, offset):
+  # offsets count instructions from the branch itself; the conditional branches leave Rt 0
+  return OPCODES[name] << 24 | field(offset, 19, "branch offset") << 5 | register(rt)
+
+
+def number(token: str):
+  # #2, #-3, #0x0F0F, #hABCD and #d32 as cpu5armtb writes them
+  text = token.lstrip("#")
+  sign = -1 if text.startswith("-") else 1
+  text = text.lstrip("-")
+  if text[:2].lower() == "0x": return sign * int(text[2:], 16)
+  if text[:1] in "hH" and len(text) > 1: return sign * int(text[1:], 16)
+  if text[:1] in "dD" and len(text) > 1: return sign * int(text[1:])
+  return sign * int(text)
+
+
+def assemble(text, index=0, labels=None):
+  # one instruction at instruction index; branch targets are offsets or labels from assemble_program
+  mnemonic, _, operand_text = text.strip().partition(" ")
+  name = MNEMONICS.get(mnemonic.upper())
+  if name is None: raise ValueError(f"unknown instruction {mnemonic!r}: {text}")
+  registers, numbers = [], []
+  for token in OPERAND_TOKEN.findall(operand_text):
+    if token == "<<" or token.upper() == "LSL": continue
+    match = REGISTER.match(token)
+    if match is not None: registers.append(int(match.group(1)) if match.group(1) is not None else ZERO_REGISTER)
+    elif token.startswith("#") or token.lstrip("-")[:1].isdigit(): numbers.append(number(token))
+    elif labels is not None and token in labels: numbers.append(labels[token] - index)
+    else: raise ValueError(f"unknown operand {token!r}: {text}")
+
+  def expect(register_count, number_counts):
+    if len(registers) != register_count or len(numbers) not in number_counts: raise ValueError(f"{name} takes {register_count} registers and {' or '.join(map(str, number_counts))} numbers: {text}")
+
+  if name in SHIFTS:
+    expect(2, (1,))
+    return encode_r(name, registers[0], registers[1], shamt=numbers[0])
+  if name in R_FORMAT.values():
+    expect(3, (0,))
+    return encode_r(name, registers[0], registers[1], registers[2])
+  if name in I_FORMAT.values():
+    expect(2, (1,))
+    return encode_i(name, registers[0], registers[1], numbers[0])
+  if name in D_FORMAT.values():
+    expect(2, (0, 1))
+    return encode_d(name, registers[0], registers[1], numbers[0] if numbers else 0)
+  if name == "MOVZ":
+    # MOVZ Rd, #imm, LSL #16 or cpu5armtb's MOVZ Rd, (<< 1*16), #imm
+    expect(1, (1, 2, 3))
+    if "<<" in operand_text and len(numbers) == 3: return encode_im(registers[0], numbers[2], numbers[0])
+    return encode_im(registers[0], numbers[0], numbers[1] // 16 if len(numbers) > 1 else 0)
+  if name == "B":
+    expect(0, (1,))
+    return encode_b(numbers[0])
+  if name in ("CBZ", "CBNZ"):
+    expect(1, (1,))
+    return encode_cb(name, registers[0], numbers[0])
+  expect(0, (1,))
+  return encode_cb(name, 0, numbers[0])
+
+
+def assemble_program(lines: Iterable[str]):
+  # instruction words from assembly lines, one instruction per line, with // and ; comments and label: lines
+  statements, labels = [], {}
+  for line in lines:
+    text = re.split(r"//|;", line, 1)[0]
+    label = LABEL.match(text)
+    while label is not None:
+      labels[label.group(1)] = len(statements)
+      text = text[label.end():]
+      label = LABEL.match(text)
+    if text.strip(): statements.append(text)
+  return [assemble(text, index, labels) for index, text in enumerate(statements)]
+
+
+def disassemble(instr: int):
+  name = decode(instr).mnemonic
+  rd, rn, rm = instr & 0x1F, (instr >> 5) & 0x1F, (instr >> 16) & 0x1F
+  if name in SHIFTS: return f"{name} R{rd}, R{rn}, #{(instr >> 10) & 0x3F}"
+  if name in R_FORMAT.values(): return f"{name} R{rd}, R{rn}, R{rm}"
+  if name in I_FORMAT.values(): return f"{name} R{rd}, R{rn}, #{(instr >> 10) & 0xFFF}"
+  if name in D_FORMAT.values(): return f"{name} R{rd}, [R{rn}, #{(instr >> 12) & 0x1FF}]"
+  if name == "MOVZ": return f"MOVZ R{rd}, #0x{(instr >> 5) & 0xFFFF:04X}, LSL #{((instr >> 21) & 0x3) * 16}"
+  if name == "B": return f"B #{instr & 0x3FFFFFF}"
+  if name in ("CBZ", "CBNZ"): return f"{name} R{rd}, #{(instr >> 5) & 0x7FFFF}"
+  if name in CONDITION_NAMES: return f"{CONDITION_NAMES[name]} #{(instr >> 5) & 0x7FFFF}"
+  return f".word 0x{instr:08X}"
+
+
+class StressProgram:
+  # random instructions, made one at a time as the model fetches them, that keep to what the pipeline does
+  # without forwarding or stalls:
+  # - a register is only read 3 or more instructions after the last write to it, once WB has written it
+  # - the NZV latch is an always block on the ALU flags, so it only loads when they change. A flag-setting
+  #   instruction only follows a shift or a branch, which leave the flags x, so it always loads them, and the
+  #   conditional branches only come once one has
+  # - a branch never sits in the delay slot of another, and branches go 2 or more instructions forward, past
+  #   the delay slot, so every address runs once and the program ends
+  # Loads and stores use R31 as the base half the time, so later loads read back what earlier stores wrote
+  def __init__(self, seed=0, branch_rate=0.1, memory_rate=0.2, max_skip=8):
+    self.rng = random.Random(seed)
+    self.branch_rate = branch_rate
+    self.memory_rate = memory_rate
+    self.max_skip = max_skip
+    # the first instruction index that may read each register; R31 always reads 0
+    self.ready = [sys.maxsize] * ZERO_REGISTER + [0]
+    self.flags_set = False
+    self.last_was_branch = False
+    self.flags_unknown = True
+
+  def source(self, index):
+    readable = [number for number, ready in enumerate(self.ready) if ready <= index]
+    return self.rng.choice(readable)
+
+  def destination(self, index):
+    rd = ZERO_REGISTER if self.rng.random() < 1 / 16 else self.rng.randrange(ZERO_REGISTER)
+    if rd != ZERO_REGISTER: self.ready[rd] = index + 3
+    return rd
+
+  def operation(self, names, flags_unknown):
+    # a flag-setting operation half the time it may load the latch, a plain one otherwise
+    setters = [name for name in names if name in SETS_FLAGS]
+    if flags_unknown and self.rng.random() < 0.5: return self.rng.choice(setters)
+    return self.rng.choice([name for name in names if name not in SETS_FLAGS])
+
+  def __call__(self, address, index):
+    rng = self.rng
+    roll = rng.random()
+    flags_unknown = self.flags_unknown
+    if roll < self.branch_rate and not self.last_was_branch:
+      self.last_was_branch = self.flags_unknown = True
+      offset = rng.randint(2, self.max_skip)
+      choices = ["B", "CBZ", "CBNZ"] + (list(CONDITION_NAMES) if self.flags_set else [])
+      name = rng.choice(choices)
+      if name == "B": return encode_b(offset)
+      if name in ("CBZ", "CBNZ"): return encode_cb(name, self.source(index), offset)
+      return encode_cb(name, 0, offset)
+    self.last_was_branch = self.flags_unknown = False
+    if roll < self.branch_rate + self.memory_rate:
+      rn = ZERO_REGISTER if rng.random() < 0.5 else self.source(index)
+      offset = rng.randrange(256) if rn == ZERO_REGISTER else rng.randrange(512)
+      if rng.random() < 0.5: return encode_d("STUR", self.source(index), rn, offset)
+      return encode_d("LDUR", self.destination(index), rn, offset)
+    kind = rng.random()
+    if kind < 0.1: name, word = "MOVZ", encode_im(self.destination(index), rng.randrange(1 << 16), rng.randrange(4))
+    elif kind < 0.45:
+      name = self.operation(list(I_FORMAT.values()), flags_unknown)
+      rn = self.source(index)
+      word = encode_i(name, self.destination(index), rn, rng.randrange(1 << 12))
+    elif kind < 0.6:
+      name = rng.choice(sorted(SHIFTS))
+      rn = self.source(index)
+      word = encode_r(name, self.destination(index), rn, shamt=rng.randrange(64))
+    else:
+      name = self.operation([name for name in R_FORMAT.values() if name not in SHIFTS], flags_unknown)
+      rn, rm = self.source(index), self.source(index)
+      word = encode_r(name, self.destination(index), rn, rm)
+    self.flags_unknown = name in SHIFTS
+    if name in SETS_FLAGS: self.flags_set = True
+    return word
+
+
+@dataclass
+class Vector:
+  # one row of the testbench tables: the instruction fed at index, the address it was fetched from, and the
+  # data address and store data it puts on the buses in MEM. None is x, or z for databusin
+  index: int
+  address: int
+  instr: int
+  daddrbus: Optional[int] = None
+  databusin: Optional[int] = None
+  databusout: Optional[int] = None
+
+
+def run_vectors(fetch: Callable[[int, int], Optional[int]], count, seed=0) -> Iterator[Vector]:
+  # feeds fetch(address, index) -> instruction word to the model with cpu5armtb's clocking and yields each
+  # instruction's vector once its MEM stage is done. Stops after count instructions or when fetch gives None.
+  # Loads read what was stored at their address before, or random data
+  rng = random.Random(seed)
+  cpu = Cpu5arm()
+  for _ in range(2):
+    cpu.posedge(None, reset=True)
+    cpu.negedge()
+  memory = {}
+  in_flight = {}
+  instrbus = None
+  fetching = True
+  k = 0
+  while fetching or in_flight:
+    cpu.posedge(instrbus, in_flight[k - 4].databusin if k - 4 in in_flight else None, reset=k == 0)
+    if k - 4 in in_flight: yield in_flight.pop(k - 4)
+    if k - 3 in in_flight:
+      vector = in_flight[k - 3]
+      vector.daddrbus, vector.databusout = cpu.daddrbus, cpu.databus
+      mnemonic = decode(vector.instr).mnemonic
+      if mnemonic == "STUR" and vector.daddrbus is not None: memory[vector.daddrbus] = vector.databusout
+      elif mnemonic == "LDUR" and vector.daddrbus is not None: vector.databusin = memory.setdefault(vector.daddrbus, rng.getrandbits(64))
+    instrbus = None
+    if fetching and k < count and cpu.iaddrbus is not None: instrbus = fetch(cpu.iaddrbus, k)
+    if instrbus is not None: in_flight[k] = Vector(k, cpu.iaddrbus, instrbus)
+    else: fetching = False
+    cpu.negedge()
+    k += 1
+
+
+def program_fetch(program: List[int]):
+  # a fetch that runs an assembled program from address 0 and stops when the PC leaves it
+  return lambda address, index: program[address >> 2] if (address >> 2) < len(program) else None
+
+
+HIGH_Z = "64'bz"
+
+
+def verilog_value(value, width=64, unknown="dontcare"):
+  return unknown if value is None else f"{width}'h{value:0{width // 4}X}"
+
+
+def hex_value(value, width=64, unknown="x"):
+  return unknown * (width // 4) if value is None else f"{value:0{width // 4}X}"
+
+
+def vector_assignments(vector: Vector):
+  k = vector.index
+  return (
+    f'iname[{k}] = "{disassemble(vector.instr)}";\n'
+    f"iaddrbusout[{k}] = {verilog_value(vector.address)};\n"
+    f"instrbusin[{k}] = {verilog_value(vector.instr, 32)};\n"
+    f"daddrbusout[{k}] = {verilog_value(vector.daddrbus)};\n"
+    f"databusin[{k}] = {verilog_value(vector.databusin, unknown=HIGH_Z)};\n"
+    f"databusout[{k}] = {verilog_value(vector.databusout)};\n\n"
+  )
+
+
+TESTBENCH_ARRAYS = ["iname", "iaddrbusout", "instrbusin", "daddrbusout", "databusin", "databusout"]
+# cpu5armtb's clocking and checks, with the checks of a data address or store data skipped where the vector
+# holds x instead of by instruction number, and only mismatches printed
+TESTBENCH = """`timescale 1ns/10ps
+
+// Testbench for arm cpu, generated by cpu5arm_asm.py
+
+module cpu5armtb();
+
+parameter num = {num};
+reg  [31:0] instrbus;
+reg  [31:0] instrbusin[0:num];
+wire [63:0] iaddrbus, daddrbus;
+reg  [63:0] iaddrbusout[0:num], daddrbusout[0:num];
+wire [63:0] databus;
+reg  [63:0] databusk, databusin[0:num], databusout[0:num];
+reg         clk, reset;
+reg         clkd;
+
+reg [63:0] dontcare;
+reg [32*8:1] iname[0:num];
+integer error, k;
+
+cpu5arm dut(.reset(reset),.clk(clk),.iaddrbus(iaddrbus),.ibus(instrbus),.daddrbus(daddrbus),.databus(databus));
+
+initial begin
+dontcare = 64'hx;
+
+{vectors}
+end
+
+assign databus = clkd ? 64'bz : databusk;
+initial begin
+  error = 0;
+  clkd = 1;
+  clk = 1;
+  databusk = 64'bz;
+  reset = 1;
+  #5
+  clk = 0;
+  clkd = 0;
+  #5
+  clk = 1;
+  clkd = 1;
+  #5
+  clk = 0;
+  clkd = 0;
+  #5
+  for (k = 0; k <= num; k = k + 1) begin
+    clk = 1;
+    #2
+    clkd = 1;
+    #3
+    reset = 0;
+    if (k >= 3)
+      databusk = databusin[k-3];
+    if (iaddrbusout[k] !== iaddrbus) begin
+      $display ("instruction %0d (%0s): iaddrbus = %h, expected %h", k, iname[k], iaddrbus, iaddrbusout[k]);
+      error = error + 1;
+    end
+    instrbus = instrbusin[k];
+    if ((k >= 3) && (daddrbusout[k-3] !== dontcare) && (daddrbusout[k-3] !== daddrbus)) begin
+      $display ("instruction %0d (%0s): daddrbus = %h, expected %h", k-3, iname[k-3], daddrbus, daddrbusout[k-3]);
+      error = error + 1;
+    end
+    if ((k >= 3) && (databusout[k-3] !== dontcare) && (databusout[k-3] !== databus)) begin
+      $display ("instruction %0d (%0s): databus = %h, expected %h", k-3, iname[k-3], databus, databusout[k-3]);
+      error = error + 1;
+    end
+    clk = 0;
+    #2
+    clkd = 0;
+    #3
+    ;
+  end
+  $display (" Number Of Errors = %d", error);
+  $display (" Total Instructions = %d", num + 1);
+end
+
+endmodule
+"""
+
+
+def write_testbench(vectors: Iterable[Vector], stream, count):
+  # the whole testbench with the vectors written out as assignments, like cpu5armtb.v
+  head, tail = TESTBENCH.replace("{num}", str(count - 1)).split("{vectors}")
+  stream.write(head)
+  for vector in vectors: stream.write(vector_assignments(vector))
+  stream.write(tail)
+
+
+def write_readmemh(vectors: Iterable[Vector], prefix):
+  # one $readmemh file per array, [prefix].[array].hex, and the instruction memory image [prefix].imem.hex
+  # with an @ line wherever a branch skips addresses; returns the number of vectors. The image holds the first
+  # instruction fetched from each address, which is all of them for a StressProgram
+  streams = {array: open(f"{prefix}.{array}.hex", "w") for array in TESTBENCH_ARRAYS + ["imem"]}
+  count = 0
+  next_word = None
+  try:
+    for vector in vectors:
+      count += 1
+      text = disassemble(vector.instr).encode()[:32].rjust(32, b"\0")
+      streams["iname"].write(text.hex() + "\n")
+      streams["iaddrbusout"].write(hex_value(vector.address) + "\n")
+      streams["instrbusin"].write(hex_value(vector.instr, 32) + "\n")
+      streams["daddrbusout"].write(hex_value(vector.daddrbus) + "\n")
+      streams["databusin"].write(hex_value(vector.databusin, unknown="z") + "\n")
+      streams["databusout"].write(hex_value(vector.databusout) + "\n")
+      word = vector.address >> 2
+      if next_word is None or word >= next_word:
+        if word != next_word: streams["imem"].write(f"@{word:X}\n")
+        streams["imem"].write(f"{vector.instr:08X}\n")
+        next_word = word + 1
+  finally:
+    for stream in streams.values(): stream.close()
+  return count
+
+
+def write_readmemh_testbench(stream, prefix, count):
+  name = os.path.basename(prefix)
+  loads = "\n".join(f'$readmemh("{name}.{array}.hex", {array});' for array in TESTBENCH_ARRAYS)
+  stream.write(TESTBENCH.replace("{num}", str(count - 1)).replace("{vectors}", loads))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Assemble a LEGv8 program or generate a random one, and write cpu5armtb-style vectors for it from the pipeline model.")
+  parser.add_argument("source", nargs="?", help="assembly file, one instruction per line, with label: lines and // comments")
+  parser.add_argument("--generate", type=int, metavar="COUNT", default=0, help="generate a random program of COUNT instructions instead")
+  parser.add_argument("--seed", type=int, default=0, help="seed for the generated program and the load data (default: 0)")
+  parser.add_argument("--branch-rate", type=float, default=0.1, help="fraction of generated instructions that branch (default: 0.1)")
+  parser.add_argument("--memory-rate", type=float, default=0.2, help="fraction of generated instructions that load or store (default: 0.2)")
+  parser.add_argument("--max-instructions", type=int, default=1000000, help="stop an assembled program after this many instructions, for a branch to itself (default: 1000000)")
+  parser.add_argument("--format", choices=["testbench", "readmemh"], default="testbench", help="write the vectors into the testbench, or into $readmemh files the testbench loads (default: testbench)")
+  parser.add_argument("--output", metavar="PREFIX", help="writes [PREFIX]_tb.v, and the [PREFIX].*.hex files with --format readmemh (default: the source name, or stress)")
+  args = parser.parse_args(argv)
+  if (args.source is None) == (not args.generate): parser.error("give an assembly file or --generate COUNT")
+
+  if args.generate:
+    fetch = StressProgram(args.seed, args.branch_rate, args.memory_rate)
+    count = args.generate
+  else:
+    try:
+      with open(args.source) as f: program = assemble_program(f)
+    except FileNotFoundError:
+      print(f"Error: assembly file '{args.source}' does not exist.")
+      sys.exit(1)
+    except ValueError as e:
+      print(f"Error: {e}")
+      sys.exit(1)
+    fetch = program_fetch(program)
+    count = args.max_instructions
+  prefix = args.output or (os.path.splitext(args.source)[0] if args.source else "stress")
+  vectors = run_vectors(fetch, count, args.seed)
+  if args.format == "readmemh":
+    count = write_readmemh(vectors, prefix)
+    with open(f"{prefix}_tb.v", "w") as f: write_readmemh_testbench(f, prefix, count)
+  else:
+    # an assembled program is run first to count the instructions the testbench declares
+    if not args.generate:
+      vectors = list(vectors)
+      count = len(vectors)
+    with open(f"{prefix}_tb.v", "w") as f: write_testbench(vectors, f, count)
+  print(f"{count} instructions, written to {prefix}_tb.v")
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,187 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from alu_vector import evaluate
+from cpu5arm_model import BRANCH_CODES, BUBBLE, CB_FORMAT, D_FORMAT, I_FORMAT, ZERO_REGISTER, Decoded, decode
+
+
+# many independent cpu5arm pipelines in lockstep, one program per lane, with the same edges as Cpu5arm.run:
+# every latch and register is a NumPy array over the lanes, with an ok mask where the scalar model holds None.
+# The top 11 bits of an instruction word pick its mnemonic, so the decoder is a 2048-row table
+
+OPCODE_SHIFT = 21
+# the decoder row every bubble takes, after the 2048 opcode prefixes
+BUBBLE_ROW = 1 << (32 - OPCODE_SHIFT)
+
+COLUMNS = ["a", "b", "immediate", "imm", "S", "branch", "shift", "reg_write", "mem_to_reg", "mem_write", "set_flags"]
+# bit position of the register field for each port kind, and the shift and mask of each immediate kind
+FIELD_SHIFT = np.array([0, 5, 16, 0, 0], dtype=np.uint32)
+IMMEDIATE_SHIFT = np.array([0, 10, 12, 5, 0, 5], dtype=np.uint64)
+IMMEDIATE_MASK = np.array([0, 0xFFF, 0x1FF, 0x7FFFF, 0x3FFFFFF, 0xFFFF], dtype=np.uint64)
+
+
+def decoder_row(decoded: Decoded):
+  # one row of the decoder table, a value per COLUMNS entry: where A and B are read from (0 none, 1 Rn, 2 Rm,
+  # 3 Rd, 4 R31), the immediate (0 none, 1 I, 2 D, 3 CB, 4 B, 5 MOVZ), whether bbus_alu takes it, the ALU S
+  # (-1 none), the branch and shift codes, and RegWrite, MemToReg, MemWrite and SetFlags.
+  # decoder_table decodes Rd, Rn and Rm set to their own bit positions, which tells the register fields apart
+  fields = {5: 1, 16: 2, 0: 3, ZERO_REGISTER: 4}
+  name = decoded.mnemonic
+  if name in I_FORMAT.values(): immediate = 1
+  elif name in D_FORMAT.values(): immediate = 2
+  elif name in CB_FORMAT.values(): immediate = 3
+  elif name == "B": immediate = 4
+  elif name == "MOVZ": immediate = 5
+  else: immediate = 0
+  return [
+    fields.get(decoded.a_register, 0), fields.get(decoded.b_register, 0), immediate, decoded.imm,
+    decoded.alu_operation if decoded.alu_operation is not None else -1, BRANCH_CODES.get(name, 0), 1 if decoded.lsl else 2 if decoded.lsr else 0,
+    decoded.reg_write, decoded.mem_to_reg, decoded.mem_write, decoded.set_flags,
+  ]
+
+
+def decoder_table():
+  rows = [decoder_row(decode(prefix << OPCODE_SHIFT | 16 << 16 | 5 << 5 | 0)) for prefix in range(BUBBLE_ROW)]
+  return np.array(rows + [decoder_row(BUBBLE)], dtype=np.int8)
+
+
+DECODER = decoder_table()
+
+
+def immediate(kind, word):
+  # decode's sign_extend_immediate for each immediate kind, zero-extended like the design
+  w = word.astype(np.uint64)
+  value = (w >> IMMEDIATE_SHIFT[kind]) & IMMEDIATE_MASK[kind]
+  return np.where(kind == 5, value << (((w >> np.uint64(21)) & np.uint64(3)) * np.uint64(16)), value)
+
+
+def known(values, ok, lanes):
+  # values[lanes] as a list of ints, with None where they are x
+  values = values[lanes].tolist()
+  if ok[lanes].all(): return values
+  return [value if value_ok else None for value, value_ok in zip(values, ok[lanes].tolist())]
+
+
+class Cpu5armBatch:
+  # lanes freshly reset cpu5arm pipelines, each running its own program from address 0 against its own data
+  # memory. The memory stays a dict per lane, so only the lanes with a load or store in MEM leave NumPy
+  def __init__(self, programs: List[List[int]], memories: Optional[List[Dict[int, int]]] = None):
+    lanes = len(programs)
+    self.lanes = lanes
+    self.memories = memories if memories is not None else [{} for _ in range(lanes)]
+    self.lengths = np.array([len(program) for program in programs], dtype=np.uint64)
+    self.program = np.zeros((lanes, max([len(program) for program in programs] + [1])), dtype=np.uint32)
+    for lane, program in enumerate(programs): self.program[lane, :len(program)] = program
+    # the program and the registers are read through flat views, which NumPy gathers from faster than 2-D ones
+    self.program_base = np.arange(lanes, dtype=np.intp) * self.program.shape[1]
+    self.register_base = np.arange(lanes, dtype=np.intp) * (ZERO_REGISTER + 1)
+    zeros64, no = np.zeros(lanes, dtype=np.uint64), np.zeros(lanes, dtype=bool)
+    # after the reset edge: pc is 0, every latch holds a bubble, and regcell[30:0] are x
+    self.registers = np.zeros((lanes, ZERO_REGISTER + 1), dtype=np.uint64)
+    self.registers_ok = np.zeros((lanes, ZERO_REGISTER + 1), dtype=bool)
+    self.registers_ok[:, ZERO_REGISTER] = True
+    self.pc, self.pc_ok = zeros64.copy(), ~no
+    self.if_word, self.if_ok, self.if_pca, self.if_pca_ok = np.zeros(lanes, dtype=np.uint32), no.copy(), zeros64.copy(), no.copy()
+    # ID_EX keeps what the later stages need: the register written (-1 none), MemToReg, MemWrite, and bbus
+    self.id_dest, self.id_mem_to_reg, self.id_mem_write = np.full(lanes, -1, dtype=np.int8), no.copy(), no.copy()
+    self.id_bbus, self.id_bbus_ok = zeros64.copy(), no.copy()
+    self.ex_dest, self.ex_mem_to_reg, self.ex_mem_write = np.full(lanes, -1, dtype=np.int8), no.copy(), no.copy()
+    self.ex_daddrbus, self.ex_daddrbus_ok, self.ex_data, self.ex_data_ok = zeros64.copy(), no.copy(), zeros64.copy(), no.copy()
+    self.result, self.result_ok = zeros64.copy(), no.copy()
+    # the latched NZV and the ALU flags of the last instruction, with ok masks where they are x
+    self.flags, self.flags_ok = np.zeros((3, lanes), dtype=bool), no.copy()
+    self.raw_flags, self.raw_flags_ok = np.zeros((3, lanes), dtype=bool), no.copy()
+    self.instructions = 0
+
+  def memory_stage(self):
+    # (data, ok) of each lane's MEM stage: the store data for a STUR, which is also written, or the load
+    data, ok = self.ex_data.copy(), self.ex_data_ok & self.ex_mem_write
+    stores = np.flatnonzero(self.ex_mem_write)
+    if len(stores):
+      values = known(self.ex_data, self.ex_data_ok, stores)
+      for lane, address, value in zip(stores.tolist(), known(self.ex_daddrbus, self.ex_daddrbus_ok, stores), values): self.memories[lane][address] = value
+    loads = np.flatnonzero(self.ex_mem_to_reg)
+    if len(loads):
+      values = [self.memories[lane].get(address) for lane, address in zip(loads.tolist(), known(self.ex_daddrbus, self.ex_daddrbus_ok, loads))]
+      ok[loads] = [value is not None for value in values]
+      data[loads] = [value if value is not None else 0 for value in values]
+    return data, ok
+
+  def cycle(self):
+    # IF: the word at pc, or a bubble off the end of the program
+    index = self.pc >> np.uint64(2)
+    fetched = self.pc_ok & (index < self.lengths)
+    ibus = np.take(self.program.reshape(-1), self.program_base + np.where(fetched, index, 0).astype(np.intp))
+    self.instructions += int(np.count_nonzero(fetched))
+    wb_dest, wb_mem_to_reg, wb_daddrbus, wb_daddrbus_ok = self.ex_dest, self.ex_mem_to_reg, self.ex_daddrbus, self.ex_daddrbus_ok
+    wb_data, wb_data_ok = self.memory_stage()
+
+    # ID: decode the word in IF_ID, read the registers, and resolve the branch against the latched flags
+    word = self.if_word
+    prefix = np.where(self.if_ok, word >> np.uint32(OPCODE_SHIFT), BUBBLE_ROW).astype(np.intp)
+    table = dict(zip(COLUMNS, np.ascontiguousarray(np.take(DECODER, prefix, axis=0).T)))
+    reads = []
+    for port in ("a", "b"):
+      kind = table[port]
+      number = np.where(kind >= 4, ZERO_REGISTER, (word >> FIELD_SHIFT[kind]) & np.uint32(0x1F)).astype(np.intp)
+      cells = self.register_base + number
+      reads.append((np.take(self.registers.reshape(-1), cells), (kind != 0) & np.take(self.registers_ok.reshape(-1), cells)))
+    (abus, abus_ok), (bbus, bbus_ok) = reads
+    value = immediate(table["immediate"], word)
+    N, Z, V = self.flags
+    flags_ok = self.flags_ok
+    # the condition of each branch code, picked per lane by the code
+    conditions = np.stack([
+      np.zeros(self.lanes, dtype=bool), np.ones(self.lanes, dtype=bool), bbus_ok & (bbus == 0), bbus_ok & (bbus != 0),
+      flags_ok & Z, flags_ok & ~Z, flags_ok & (N == V), flags_ok & (N != V),
+    ])
+    taken = np.take(conditions.reshape(-1), table["branch"].astype(np.intp) * self.lanes + np.arange(self.lanes)) & self.if_pca_ok
+    next_pc = np.where(taken, (value << np.uint64(2)) + self.if_pca, self.pc + np.uint64(4))
+    next_pc_ok = taken | self.pc_ok
+
+    # the latches move on
+    rd = word & np.uint32(0x1F)
+    self.ex_dest, self.ex_mem_to_reg, self.ex_mem_write = self.id_dest, self.id_mem_to_reg, self.id_mem_write
+    self.ex_daddrbus, self.ex_daddrbus_ok, self.ex_data, self.ex_data_ok = self.result, self.result_ok, self.id_bbus, self.id_bbus_ok
+    self.id_dest = np.where((table["reg_write"] != 0) & (rd != ZERO_REGISTER), rd, -1).astype(np.int8)
+    self.id_mem_to_reg, self.id_mem_write = table["mem_to_reg"] != 0, table["mem_write"] != 0
+    self.id_bbus, self.id_bbus_ok = bbus, bbus_ok
+    self.if_word, self.if_ok, self.if_pca, self.if_pca_ok = ibus, fetched, self.pc, self.pc_ok
+    self.pc, self.pc_ok = next_pc, next_pc_ok
+
+    # EX of the instruction just latched into ID_EX, and the NZV latch, which loads when the flags change
+    uses_imm = table["imm"] != 0
+    operand, operand_ok = np.where(uses_imm, value, bbus), uses_imm | bbus_ok
+    S, shift = table["S"], table["shift"]
+    alu_ok = (S >= 0) & abus_ok & operand_ok
+    shamt = (word >> np.uint32(10)) & np.uint32(0x3F)
+    result = evaluate(abus, operand, S == 0b011, S.astype(np.uint8), shamt, shift == 1, shift == 2)
+    self.result = result.d
+    self.result_ok = np.where(shift != 0, abus_ok, alu_ok)
+    raw = np.stack([result.N, result.Z_flag, result.V])
+    changed = (alu_ok != self.raw_flags_ok) | (alu_ok & (raw != self.raw_flags).any(axis=0))
+    load = (table["set_flags"] != 0) & changed
+    self.flags = np.where(load, raw, self.flags)
+    self.flags_ok = np.where(load, alu_ok, self.flags_ok)
+    self.raw_flags, self.raw_flags_ok = raw, alu_ok
+
+    # WB on the falling edge
+    writing = np.flatnonzero(wb_dest >= 0)
+    if len(writing):
+      cells = self.register_base[writing] + wb_dest[writing]
+      self.registers.reshape(-1)[cells] = np.where(wb_mem_to_reg, wb_data, wb_daddrbus)[writing]
+      self.registers_ok.reshape(-1)[cells] = np.where(wb_mem_to_reg, wb_data_ok, wb_daddrbus_ok)[writing]
+
+  def run(self, cycles: int):
+    for _ in range(cycles): self.cycle()
+    return self.memories
+
+  def lane_registers(self, lane) -> List[Optional[int]]:
+    return [int(value) if ok else None for value, ok in zip(self.registers[lane], self.registers_ok[lane])]
+
+  def lane_pc(self, lane) -> Optional[int]:
+    return int(self.pc[lane]) if self.pc_ok[lane] else None
+
+  def lane_flags(self, lane):
+    return tuple(int(flag) for flag in self.flags[:, lane]) if self.flags_ok[lane] else (None, None, None)
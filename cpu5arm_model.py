@@ -0,0 +1,438 @@
+import argparse
+import re
+import sys
+import time
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, List, Optional, Set
+
+
+# Python model of cpu5arm.v, one posedge and one negedge at a time. Values are ints, or None where the
+# Verilog would hold x or z; a control signal that is x acts like 0, as it does in the design's
+# "sel === 1'b1" muxes
+MASK64 = (1 << 64) - 1
+ZERO_REGISTER = 31
+
+# legv8_decoder opcodes, by the instruction bits they are matched on
+R_FORMAT = {
+  0b00101000000: "ADD", 0b00101000001: "ADDS", 0b00101000010: "AND", 0b00101000011: "ANDS",
+  0b00101000100: "EOR", 0b00101000101: "ENOR", 0b00101000110: "LSL", 0b00101000111: "LSR",
+  0b00101001000: "ORR", 0b00101001001: "SUB", 0b00101001010: "SUBS",
+}
+D_FORMAT = {0b11010000000: "LDUR", 0b11010000001: "STUR"}
+I_FORMAT = {
+  0b1000100000: "ADDI", 0b1000100001: "ADDIS", 0b1000100010: "ANDI", 0b1000100011: "ANDIS",
+  0b1000100100: "EORI", 0b1000100101: "ENORI", 0b1000100110: "ORRI", 0b1000100111: "SUBI", 0b1000101000: "SUBIS",
+}
+IM_FORMAT = {0b110010101: "MOVZ"}
+CB_FORMAT = {0b11110100: "CBZ", 0b11110101: "CBNZ", 0b01110100: "BEQ", 0b01110101: "BNE", 0b01110110: "BLT", 0b01110111: "BGE"}
+B_FORMAT = {0b000011: "B"}
+
+# alu_cell's S encoding for every instruction that uses the ALU; the rest leave S as 3'bxxx
+ALU_OPERATION = {
+  "ADD": 0b010, "ADDS": 0b010, "AND": 0b110, "ANDS": 0b110, "EOR": 0b000, "ENOR": 0b001, "ORR": 0b100, "SUB": 0b011, "SUBS": 0b011,
+  "ADDI": 0b010, "ADDIS": 0b010, "ANDI": 0b110, "ANDIS": 0b110, "EORI": 0b000, "ENORI": 0b001, "ORRI": 0b100, "SUBI": 0b011, "SUBIS": 0b011,
+  "LDUR": 0b010, "STUR": 0b010, "MOVZ": 0b010,
+}
+SETS_FLAGS = {"ADDS", "ANDS", "SUBS", "ADDIS", "ANDIS", "SUBIS"}
+NO_REGISTER_WRITE = {"STUR", "B", "CBZ", "CBNZ", "BEQ", "BNE", "BLT", "BGE"}
+
+
+@dataclass(frozen=True)
+class Decoded:
+  # the legv8_decoder outputs for one instruction word, minus Branch, which also depends on the flags
+  mnemonic: Optional[str] = None
+  alu_operation: Optional[int] = None
+  imm: bool = False
+  reg_write: bool = False
+  mem_to_reg: bool = False
+  mem_write: bool = False
+  set_flags: bool = False
+  lsl: bool = False
+  lsr: bool = False
+  a_register: Optional[int] = None
+  b_register: Optional[int] = None
+  d_register: int = ZERO_REGISTER
+  sign_extend_immediate: Optional[int] = None
+  shift_amount: int = 0
+
+
+# what the pipeline latches hold while an x instruction word passes through them, as after reset
+BUBBLE = Decoded()
+
+
+def instruction_name(instr: int):
+  return R_FORMAT.get(instr >> 21) or D_FORMAT.get(instr >> 21) or I_FORMAT.get(instr >> 22) or IM_FORMAT.get(instr >> 23) or CB_FORMAT.get(instr >> 24) or B_FORMAT.get(instr >> 26)
+
+
+def sign_extend_immediate(name: Optional[str], instr: int):
+  if name in I_FORMAT.values(): return (instr >> 10) & 0xFFF
+  if name in D_FORMAT.values(): return (instr >> 12) & 0x1FF
+  if name in CB_FORMAT.values(): return (instr >> 5) & 0x7FFFF
+  if name == "B": return instr & 0x3FFFFFF
+  if name == "MOVZ": return (((instr >> 5) & 0xFFFF) << (((instr >> 21) & 0x3) * 16)) & MASK64
+  return None
+
+
+@lru_cache(maxsize=65536)
+def decode(instr: Optional[int]):
+  if instr is None: return BUBBLE
+  name = instruction_name(instr)
+  rd = instr & 0x1F
+  rn = (instr >> 5) & 0x1F
+  rm = (instr >> 16) & 0x1F
+
+  if name in R_FORMAT.values() or name in I_FORMAT.values() or name in D_FORMAT.values(): a_register = rn
+  elif name == "MOVZ": a_register = ZERO_REGISTER
+  else: a_register = None
+  if name in R_FORMAT.values() and name not in ("LSL", "LSR"): b_register = rm
+  elif name in ("CBZ", "CBNZ", "STUR"): b_register = rd # Rt is the same field as Rd
+  else: b_register = None
+
+  return Decoded(
+    mnemonic=name,
+    alu_operation=ALU_OPERATION.get(name),
+    imm=name in I_FORMAT.values() or name in D_FORMAT.values() or name == "MOVZ",
+    reg_write=name not in NO_REGISTER_WRITE,
+    mem_to_reg=name == "LDUR",
+    mem_write=name == "STUR",
+    set_flags=name in SETS_FLAGS,
+    lsl=name == "LSL",
+    lsr=name == "LSR",
+    a_register=a_register,
+    b_register=b_register,
+    d_register=rd,
+    sign_extend_immediate=sign_extend_immediate(name, instr),
+    shift_amount=(instr >> 10) & 0x3F,
+  )
+
+
+BRANCH_CODES = {"B": 1, "CBZ": 2, "CBNZ": 3, "BEQ": 4, "BNE": 5, "BGE": 6, "BLT": 7}
+
+
+def flatten(decoded: Decoded, instr: Optional[int] = None):
+  # one instruction as a tuple for Cpu5arm.run: (word, decoded, A register, B register, branch code, branch
+  # offset in bytes, ALU S, immediate for bbus_alu or None, shift code, shift amount, register written or -1,
+  # MemToReg, MemWrite, SetFlags)
+  branch = BRANCH_CODES.get(decoded.mnemonic, 0)
+  return (
+    instr, decoded, decoded.a_register, decoded.b_register, branch, decoded.sign_extend_immediate << 2 if branch else 0,
+    decoded.alu_operation, decoded.sign_extend_immediate if decoded.imm else None, 1 if decoded.lsl else 2 if decoded.lsr else 0, decoded.shift_amount,
+    decoded.d_register if decoded.reg_write and decoded.d_register != ZERO_REGISTER else -1, decoded.mem_to_reg, decoded.mem_write, decoded.set_flags,
+  )
+
+
+@lru_cache(maxsize=None)
+def opcode_op(opcode: int):
+  # flatten() of the top 11 bits of a word, which pick the mnemonic, with Rd, Rn and Rm set to their own bit
+  # positions so the register fields in the tuple say which field each one is
+  return flatten(decode(opcode << 21 | 16 << 16 | 5 << 5 | 0))
+
+
+def register_field(position: Optional[int], instr: int):
+  return (instr >> position) & 0x1F if position is not None and position != ZERO_REGISTER else position
+
+
+@lru_cache(maxsize=65536)
+def pipeline_op(instr: Optional[int]):
+  # flatten(decode(instr), instr) filled in from opcode_op, without building a Decoded for every word; the
+  # tuple holds None in its place, for decode(instr)
+  if instr is None: return flatten(BUBBLE)
+  _, decoded, a, b, branch, _, S, imm, shift, _, d, mem_to_reg, mem_write, set_flags = opcode_op(instr >> 21)
+  value = sign_extend_immediate(decoded.mnemonic, instr)
+  rd = instr & 0x1F
+  return (
+    instr, None, register_field(a, instr), register_field(b, instr), branch, value << 2 if branch else 0, S, value if imm is not None else None,
+    shift, (instr >> 10) & 0x3F, rd if d == 0 and rd != ZERO_REGISTER else -1, mem_to_reg, mem_write, set_flags,
+  )
+
+
+def alu64(a: int, b: int, Cin: int, S: int):
+  # alu_cell: b is inverted when S[0] is set and the carries from the lac tree are only added in when S[1] is set
+  b_in = b ^ MASK64 if S & 1 else b
+  total = a + b_in + Cin
+  if S == 0b100: d = a | b
+  elif S == 0b101: d = (a | b) ^ MASK64
+  elif S == 0b110: d = a & b
+  elif S & 0b010: d = total & MASK64
+  else: d = a ^ b_in
+  Cout = total >> 64
+  # overflow: V = Cout ^ c[63], the carry into the top bit
+  V = Cout ^ (((a & (MASK64 >> 1)) + (b_in & (MASK64 >> 1)) + Cin) >> 63)
+  return d, Cout, V, int(d == 0), d >> 63
+
+
+def alu_flags(source):
+  # (N, Z, V) of alu64 for (S, a, b), or all x without operands
+  if source is None: return (None, None, None)
+  S, a, b = source
+  _, _, V, Z, N = alu64(a, b, int(S == 0b011), S)
+  return (N, Z, V)
+
+
+def shift64(val: int, shamt: int, lsl: bool, lsr: bool):
+  if lsl: return (val << shamt) & MASK64
+  if lsr: return val >> shamt
+  return val
+
+
+def execute(decoded: Decoded, abus: Optional[int], bbus: Optional[int]):
+  # (dbus, (N_raw, Z_raw, V_raw)) of the EX stage for the instruction in ID_EX_reg
+  bbus_alu = decoded.sign_extend_immediate if decoded.imm else bbus
+  if decoded.alu_operation is None or abus is None or bbus_alu is None: d = N = Z = V = None
+  else: d, _, V, Z, N = alu64(abus, bbus_alu, int(decoded.alu_operation == 0b011), decoded.alu_operation)
+  if decoded.lsl or decoded.lsr: d = shift64(abus, decoded.shift_amount, decoded.lsl, decoded.lsr) if abus is not None else None
+  return d, (N, Z, V)
+
+
+class Cpu5arm:
+  def __init__(self):
+    # regcell[30:0] start out x, zero_reg always reads 0 and ignores writes
+    self.registers: List[Optional[int]] = [None] * ZERO_REGISTER + [0]
+    self.pc: Optional[int] = None
+    self.if_id = (None, None) # instruction word, address it was fetched from
+    self.id_ex = (BUBBLE, None, None) # decoded instruction, abus, bbus
+    self.ex_mem = (BUBBLE, None, None) # decoded instruction, dbus (daddrbus), write data
+    self.mem_wb = (BUBBLE, None, None) # decoded instruction, daddrbus, databus
+    self.ex_result = (None, (None, None, None))
+    self.flags = (None, None, None) # N_bit, Z_bit, V_bit
+
+  @property
+  def iaddrbus(self):
+    return self.pc
+
+  @property
+  def daddrbus(self):
+    return self.ex_mem[1]
+
+  @property
+  def databus(self):
+    # the CPU only drives databus while a STUR is in MEM
+    return self.ex_mem[2] if self.ex_mem[0].mem_write else None
+
+  def read_register(self, register: Optional[int]):
+    return self.registers[register] if register is not None else None
+
+  def branch_taken(self, decoded: Decoded, bbus: Optional[int]):
+    name = decoded.mnemonic
+    if name == "B": return True
+    if name == "CBZ": return bbus == 0
+    if name == "CBNZ": return bbus is not None and bbus != 0
+    N, Z, V = self.flags
+    if name == "BEQ": return Z == 1
+    if name == "BNE": return Z == 0
+    if name == "BGE": return N is not None and V is not None and N == V
+    if name == "BLT": return N is not None and V is not None and N != V
+    return False
+
+  def posedge(self, ibus: Optional[int], databus: Optional[int] = None, reset=False):
+    # ibus is the instruction word on the bus, databus what the memory drives (None for z)
+    instr, pca = self.if_id
+    decoded = decode(instr)
+    abus = self.read_register(decoded.a_register)
+    bbus = self.read_register(decoded.b_register)
+    # branches resolve in decode: the target is the branch's own address plus the offset times 4
+    if reset: pc = 0
+    elif self.branch_taken(decoded, bbus) and pca is not None: pc = ((decoded.sign_extend_immediate << 2) + pca) & MASK64
+    else: pc = (self.pc + 4) & MASK64 if self.pc is not None else None
+
+    ex_decoded, _, ex_bbus = self.id_ex
+    mem_decoded, daddrbus, write_data = self.ex_mem
+    if mem_decoded.mem_write: databus = write_data if databus is None or databus == write_data else None
+
+    self.mem_wb = (mem_decoded, daddrbus, databus)
+    self.ex_mem = (ex_decoded, self.ex_result[0], ex_bbus)
+    self.id_ex = (decoded, abus, bbus)
+    self.if_id = (ibus, self.pc)
+    self.pc = pc
+
+    # the NZV latch is an always block on the ALU flags, so it only loads when they change
+    ex_result = execute(decoded, abus, bbus)
+    if decoded.set_flags and ex_result[1] != self.ex_result[1]: self.flags = ex_result[1]
+    self.ex_result = ex_result
+
+  def negedge(self):
+    # regfile's dff cells load on the falling edge, so WB writes land before the next decode reads them
+    decoded, daddrbus, databus = self.mem_wb
+    if decoded.reg_write and decoded.d_register != ZERO_REGISTER: self.registers[decoded.d_register] = databus if decoded.mem_to_reg else daddrbus
+
+  def run(self, program: List[int], memory: Dict[int, int], cycles: int):
+    # runs a program from address 0 with instruction memory program[iaddrbus / 4] and data memory
+    # keyed by daddrbus, as a testbench with real memories would. The same edges as posedge and negedge, with
+    # every word flattened by pipeline_op as it is fetched, the latches held in locals, and the ALU flags only
+    # worked out when a flag-setting instruction compares them with the last ones
+    self.posedge(None, reset=True)
+    self.negedge()
+    bubble = pipeline_op(None)
+    registers = self.registers
+    pc = self.pc
+    if_op, if_pca = pipeline_op(self.if_id[0]), self.if_id[1]
+    id_op, id_abus, id_bbus = flatten(self.id_ex[0]), self.id_ex[1], self.id_ex[2]
+    ex_op, ex_daddrbus, ex_data = flatten(self.ex_mem[0]), self.ex_mem[1], self.ex_mem[2]
+    result, (N, Z, V) = self.ex_result[0], self.flags
+    last_flags, last_source = self.ex_result[1], None
+    for _ in range(cycles):
+      ibus_op = pipeline_op(program[pc >> 2]) if pc is not None and (pc >> 2) < len(program) else bubble
+      _, _, a, b, branch, offset, S, imm, shift, shamt, _, _, _, sets_flags = if_op
+      # MEM: the store or load of the instruction in EX_MEM, which then moves on to WB
+      wb_op, wb_daddrbus = ex_op, ex_daddrbus
+      if wb_op[12]:
+        memory[ex_daddrbus] = ex_data
+        wb_data = ex_data
+      else: wb_data = memory.get(ex_daddrbus) if wb_op[11] else None
+      # ID: the register reads and the branch, resolved here against the latched flags
+      abus = registers[a] if a is not None else None
+      bbus = registers[b] if b is not None else None
+      if branch and if_pca is not None and (
+        branch == 1 or (branch == 2 and bbus == 0) or (branch == 3 and bbus is not None and bbus != 0) or (branch == 4 and Z == 1) or (branch == 5 and Z == 0)
+        or (branch == 6 and N is not None and V is not None and N == V) or (branch == 7 and N is not None and V is not None and N != V)
+      ): next_pc = (offset + if_pca) & MASK64
+      else: next_pc = (pc + 4) & MASK64 if pc is not None else None
+      ex_op, ex_daddrbus, ex_data = id_op, result, id_bbus
+      id_op, id_abus, id_bbus = if_op, abus, bbus
+      if_op, if_pca = ibus_op, pc
+      pc = next_pc
+      # EX of the instruction just latched into ID_EX, as execute does
+      operand = imm if imm is not None else bbus
+      if S is None or abus is None or operand is None: result, source = None, None
+      else:
+        source = (S, abus, operand)
+        if S == 0b010: result = (abus + operand) & MASK64
+        elif S == 0b011: result = (abus - operand) & MASK64
+        elif S == 0b110: result = abus & operand
+        elif S == 0b100: result = abus | operand
+        elif S == 0b000: result = abus ^ operand
+        else: result = alu64(abus, operand, int(S == 0b011), S)[0]
+      if shift: result = shift64(abus, shamt, shift == 1, shift == 2) if abus is not None else None
+      if sets_flags:
+        flags = alu_flags(source)
+        if last_flags is None: last_flags = alu_flags(last_source)
+        if flags != last_flags: N, Z, V = flags
+        last_flags = flags
+      else: last_flags = None if source is not None else (None, None, None)
+      last_source = source
+      # WB on the falling edge
+      if wb_op[10] >= 0: registers[wb_op[10]] = wb_data if wb_op[11] else wb_daddrbus
+    self.pc = pc
+    self.if_id = (if_op[0], if_pca)
+    self.id_ex = (id_op[1] or decode(id_op[0]), id_abus, id_bbus)
+    self.ex_mem = (ex_op[1] or decode(ex_op[0]), ex_daddrbus, ex_data)
+    if cycles: self.mem_wb = (wb_op[1] or decode(wb_op[0]), wb_daddrbus, wb_data)
+    self.ex_result = (result, last_flags if last_flags is not None else alu_flags(last_source))
+    self.flags = (N, Z, V)
+    return memory
+
+VECTOR_ARRAYS = ["instrbusin", "iaddrbusout", "daddrbusout", "databusin", "databusout"]
+VECTOR_ASSIGNMENT = re.compile(r"\b(" + "|".join(VECTOR_ARRAYS) + r")\[(\d+)\]\s*=\s*([^;]+);")
+NAME_ASSIGNMENT = re.compile(r'\biname\[(\d+)\]\s*=\s*"([^"]*)"')
+PARAMETER = re.compile(r"\bparameter\s+(\w+)\s*=\s*([^;]+);")
+SIZED_NUMBER = re.compile(r"(\d+)'([bdh])\s*([0-9a-fA-FxXzZ_]+)")
+SKIPPED_CHECK = re.compile(r"\(k-3\)\s*!=\s*(\d+)")
+
+
+@dataclass
+class TestbenchVectors:
+  count: int
+  vectors: Dict[str, Dict[int, Optional[int]]] = field(default_factory=dict)
+  names: Dict[int, str] = field(default_factory=dict)
+  # instructions whose data address and store data the testbench doesn't check
+  skipped: Set[int] = field(default_factory=set)
+
+
+@dataclass
+class Mismatch:
+  index: int
+  bus: str
+  expected: Optional[int]
+  actual: Optional[int]
+
+
+def constant_value(text: str, parameters: Dict[str, tuple]):
+  # (value, width) of a sized number, parameter, or concatenation of them; value is None for x or z
+  text = text.strip()
+  if text.startswith("{") and text.endswith("}"):
+    value, width = 0, 0
+    for part in text[1:-1].split(","):
+      part_value, part_width = constant_value(part, parameters)
+      value = None if value is None or part_value is None else (value << part_width) | part_value
+      width += part_width
+    return value, width
+  if text in parameters: return parameters[text]
+  number = SIZED_NUMBER.fullmatch(text)
+  if number is None: return int(text), 32
+  width, base, digits = int(number.group(1)), number.group(2), number.group(3).replace("_", "")
+  if any(digit in "xXzZ" for digit in digits): return None, width
+  return int(digits, {"b": 2, "d": 10, "h": 16}[base]) & ((1 << width) - 1), width
+
+
+def load_testbench(path="cpu5armtb.v"):
+  with open(path, "r") as f: source = re.sub(r"//[^\n]*", "", f.read())
+  parameters = {}
+  for name, value in PARAMETER.findall(source): parameters[name] = constant_value(value, parameters)
+  parameters["dontcare"] = (None, 64)
+  testbench = TestbenchVectors(count=parameters["num"][0] + 1)
+  testbench.vectors = {array: {} for array in VECTOR_ARRAYS}
+  for array, index, value in VECTOR_ASSIGNMENT.findall(source): testbench.vectors[array][int(index)] = constant_value(value, parameters)[0]
+  testbench.names = {int(index): name for index, name in NAME_ASSIGNMENT.findall(source)}
+  testbench.skipped = {int(index) for index in SKIPPED_CHECK.findall(source)}
+  return testbench
+
+
+def run_testbench(testbench: TestbenchVectors, verbose=False):
+  # replays cpu5armtb's clocking: two clock edges in reset, then for each k one posedge, the checks,
+  # the next instruction on ibus, and the negedge. Load data for instruction k-3 is driven while clk is low
+  vectors = testbench.vectors
+  cpu = Cpu5arm()
+  mismatches: List[Mismatch] = []
+  for _ in range(2):
+    cpu.posedge(None, reset=True)
+    cpu.negedge()
+  instrbus = None
+  for k in range(testbench.count):
+    databusk = vectors["databusin"].get(k - 4) if k >= 4 else None
+    cpu.posedge(instrbus, databusk, reset=k == 0)
+    checks = [("iaddrbus", vectors["iaddrbusout"].get(k), cpu.iaddrbus, k)]
+    if k >= 3 and k - 3 not in testbench.skipped:
+      checks.append(("daddrbus", vectors["daddrbusout"].get(k - 3), cpu.daddrbus, k - 3))
+      if vectors["databusout"].get(k - 3) is not None: checks.append(("databus", vectors["databusout"][k - 3], cpu.databus, k - 3))
+    for bus, expected, actual, index in checks:
+      if expected != actual:
+        mismatches.append(Mismatch(index, bus, expected, actual))
+        if verbose: print(f"instruction {index} ({testbench.names.get(index, '?')}): {bus} is {format_bus(actual)}, expected {format_bus(expected)}")
+    instrbus = vectors["instrbusin"].get(k)
+    cpu.negedge()
+  return mismatches
+
+
+def format_bus(value: Optional[int]):
+  return "x" if value is None else f"{value:016X}"
+
+
+def instructions_per_second(cycles: int, seed=0):
+  # a stress program twice as long as the run, so every cycle fetches a new instruction rather than a bubble
+  # once the program ends. Branches only go forward, so no word runs twice and each one is decoded as it is
+  # fetched
+  from cpu5arm_asm import StressProgram
+  stress = StressProgram(seed)
+  program = [stress(4 * index, index) for index in range(2 * cycles)]
+  cpu = Cpu5arm()
+  start = time.perf_counter()
+  cpu.run(program, {}, cycles)
+  return cycles / (time.perf_counter() - start)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Run the cpu5armtb vectors on a Python model of the cpu5arm pipeline.")
+  parser.add_argument("testbench", nargs="?", default="cpu5armtb.v", help="testbench with the vectors (default: cpu5armtb.v)")
+  parser.add_argument("--verbose", action="store_true", help="print every mismatch")
+  parser.add_argument("--benchmark", type=int, metavar="CYCLES", default=0, help="also time a stress program run for this many cycles")
+  args = parser.parse_args(argv)
+  testbench = load_testbench(args.testbench)
+  mismatches = run_testbench(testbench, verbose=args.verbose)
+  print(f"{testbench.count} instructions, {len(mismatches)} mismatches")
+  if args.benchmark: print(f"{instructions_per_second(args.benchmark):,.0f} instructions/s")
+  if mismatches: sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,292 @@
+import argparse
+import gzip
+import json
+import math
+import sys
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, List, Set
+
+from schematic_generator import Block, Reg, Schematic, extract_netlist
+from schematic_timing import leaf_net
+
+# the bits of a changed value that hold a 0 or a 1; x and z bits are unknown and never toggle or count as high
+KNOWN_BITS = bytes.maketrans(b"01xXzZuUwW-hHlL", b"110000000000000")
+VALUE_BITS = bytes.maketrans(b"01xXzZuUwW-hHlL", b"010000000000000")
+# sections of the value changes that only hold more value changes
+DUMP_KEYWORDS = {b"$dumpvars", b"$dumpall", b"$dumpon", b"$dumpoff", b"$end"}
+# the first byte of a scalar change, 0 1 x X z Z, followed by the identifier
+SCALAR_VALUES = frozenset(b"01xXzZ")
+
+
+@dataclass
+class Activity:
+  # a signal's 0 <-> 1 bit changes over the dump, and the fraction of its bit-time spent at 1
+  width: int
+  toggles: int
+  duty: float
+
+
+def open_vcd(path) -> BinaryIO:
+  # a dump as written, or gzipped
+  with open(path, "rb") as f: gzipped = f.read(2) == b"\x1f\x8b"
+  return gzip.open(path, "rb") if gzipped else open(path, "rb")
+
+
+class VcdReader:
+  # reads a VCD dump in one pass, a line at a time. Only the declarations and one accumulator per signal
+  # identifier are held, so memory is bounded by the number of signals however long the dump is. Signals
+  # declared in several scopes under one identifier, like a port and the net it connects to, share it
+  def __init__(self, stream: BinaryIO):
+    self.stream = stream
+    self.timescale = ""
+    # full dotted name -> identifier code
+    self.names: Dict[str, bytes] = {}
+    self.widths: Dict[bytes, int] = {}
+    # identifier code -> [value, known bits, time of the last change, toggles, bit-time at 1, all bits]
+    self.state: Dict[bytes, list] = {}
+    self.start = None
+    self.time = 0
+    self.in_comment = False
+    self.read_header()
+
+  def read_header(self):
+    scopes: List[str] = []
+    words = deque()
+    def token():
+      while not words:
+        line = self.stream.readline()
+        if not line: raise ValueError("the dump ends before $enddefinitions")
+        words.extend(line.split())
+      return words.popleft()
+    def section():
+      # the words up to the $end closing a keyword, however many lines they take
+      found = []
+      word = token()
+      while word != b"$end":
+        found.append(word)
+        word = token()
+      return found
+    while True:
+      keyword = token()
+      if keyword == b"$scope": scopes.append(section()[1].decode())
+      elif keyword == b"$upscope":
+        scopes.pop()
+        section()
+      elif keyword == b"$var":
+        # $var wire 64 # databus [63:0] $end; the bit range is dropped, a bit-blasted name keeps its select
+        _, width, code, name = section()[:4]
+        self.names[".".join(scopes + [name.decode()])] = code
+        self.widths.setdefault(code, int(width))
+        self.state.setdefault(code, [0, 0, 0, 0, 0, (1 << int(width)) - 1])
+      elif keyword == b"$timescale": self.timescale = b"".join(section()).decode()
+      elif keyword == b"$enddefinitions":
+        section()
+        # anything after it on the same line is the first of the value changes
+        self.rest = list(words)
+        return
+      elif keyword.startswith(b"$"): section()
+      else: raise ValueError(f"unexpected '{keyword.decode()}' in the declarations")
+
+  def change(self, code, text, time):
+    state = self.state.get(code)
+    if state is None: return
+    try:
+      # a value shorter than its signal is extended with 0 when it starts with 0 or 1
+      value, known = int(text, 2), state[5]
+    except ValueError:
+      value = int(text.translate(VALUE_BITS), 2)
+      known = int(text.translate(KNOWN_BITS), 2)
+      if text[:1] in (b"0", b"1"): known |= state[5] ^ ((1 << len(text)) - 1)
+    old_value, old_known = state[0], state[1]
+    state[4] += (old_value & old_known).bit_count() * (time - state[2])
+    state[3] += ((old_value ^ value) & old_known & known).bit_count()
+    state[0], state[1], state[2] = value, known, time
+
+  def words(self, words):
+    # the value changes of a line the fast path in read doesn't take: keywords, comments, or several
+    # changes on one line
+    tokens = iter(words)
+    for token in tokens:
+      if self.in_comment:
+        self.in_comment = token != b"$end"
+        continue
+      first = token[0]
+      if first == 35:  # '#'
+        self.time = int(token[1:])
+        if self.start is None: self.start = self.time
+      elif first in SCALAR_VALUES: self.change(token[1:], token[:1], self.time)
+      elif first in (98, 66): self.change(next(tokens), token[1:], self.time)  # 'b'
+      elif first in (114, 82): next(tokens)  # a real value; its signal has no bits to toggle
+      elif token == b"$comment": self.in_comment = True
+      elif token not in DUMP_KEYWORDS: raise ValueError(f"unexpected '{token.decode()}' in the value changes")
+
+  def read(self):
+    # consumes the value changes and returns the activity of every signal by its dotted name, with the
+    # identifier code of each name. Nearly every line is one change or one timestamp, which skip words
+    self.words(self.rest)
+    change = self.change
+    for line in self.stream:
+      words = line.split()
+      if len(words) == 1 and not self.in_comment:
+        token = words[0]
+        first = token[0]
+        if first in SCALAR_VALUES:
+          change(token[1:], token[:1], self.time)
+          continue
+        if first == 35:
+          self.time = int(token[1:])
+          if self.start is None: self.start = self.time
+          continue
+      elif len(words) == 2 and words[0][0] in (98, 66) and not self.in_comment:
+        change(words[1], words[0][1:], self.time)
+        continue
+      self.words(words)
+    end = self.time
+    start = self.start if self.start is not None else 0
+    span = end - start
+    activity = {}
+    for code, state in self.state.items():
+      width = self.widths[code]
+      state[4] += (state[0] & state[1]).bit_count() * (end - state[2])
+      state[2] = end
+      activity[code] = Activity(width, state[3], state[4] / (width * span) if span else 0.0)
+    return {name: activity[code] for name, code in self.names.items()}, self.names
+
+
+def find_scope(names, schematic: Schematic):
+  # the scope holding the most nets of the schematic's top module, like cpu5armtb.dut for cpu5arm
+  counts = defaultdict(int)
+  for name in names:
+    scope, _, net = name.rpartition(".")
+    if scope and leaf_net(net) in schematic.nodes: counts[scope] += 1
+  if not counts: raise ValueError(f"no scope in the dump holds the nets of {schematic.name}")
+  return max(counts, key=lambda scope: (counts[scope], -scope.count(".")))
+
+
+class SchematicActivity:
+  # the activity of a dump laid onto a schematic. A net is the signal of the same name in the scope of the top
+  # module, or the scope of its instance when --depth expanded it; a Block adds up the toggles of every signal
+  # in its instance's scope, or of the nets it drives when the dump stops above it
+  def __init__(self, schematic: Schematic, activity: Dict[str, Activity], codes: Dict[str, bytes], scope=None):
+    self.schematic = schematic
+    self.scope = scope or find_scope(activity, schematic)
+    self.nets: Dict[str, Activity] = {}
+    block_codes: Dict[str, Set[str]] = defaultdict(set)
+    # node names by their path without selects, so every scope of an instance array like regcell[30:0] finds
+    # the one Block the array is drawn as
+    paths = {}
+    for name in schematic.nodes: paths.setdefault("/".join(leaf_net(part) for part in name.split("/")), name)
+    prefix = self.scope + "."
+    for name, signal in activity.items():
+      if not name.startswith(prefix): continue
+      parts = [leaf_net(part) for part in name[len(prefix):].split(".")]
+      net = paths.get("/".join(parts))
+      if net is not None:
+        # a bit-blasted vector adds up its bits, the duty weighted by width
+        previous = self.nets.get(net)
+        if previous is None: self.nets[net] = Activity(signal.width, signal.toggles, signal.duty)
+        else:
+          width = previous.width + signal.width
+          self.nets[net] = Activity(width, previous.toggles + signal.toggles, (previous.duty * previous.width + signal.duty * signal.width) / width)
+      for depth in range(1, len(parts)):
+        instance = schematic.nodes.get(paths.get("/".join(parts[:depth])))
+        if isinstance(instance, Block): block_codes[instance.name].add(codes[name])
+    if not self.nets and not block_codes: raise ValueError(f"no net of {schematic.name} is in the dump under {self.scope}")
+    toggles_of_code = {codes[name]: signal.toggles for name, signal in activity.items()}
+    self.blocks: Dict[str, int] = {}
+    for node in schematic.nodes.values():
+      if not isinstance(node, Block): continue
+      if block_codes[node.name]: self.blocks[node.name] = sum(toggles_of_code[code] for code in block_codes[node.name])
+      else: self.blocks[node.name] = sum(self.nets[output.name].toggles for output in node.outputs if output.name in self.nets)
+    self.busiest = max([activity.toggles for activity in self.nets.values()] + list(self.blocks.values()) + [1])
+
+  def heat(self, toggles):
+    # 0 for idle to 1 for the busiest net or block, on a log scale since a few nets toggle every cycle
+    return math.log1p(toggles) / math.log1p(self.busiest)
+
+  def color(self, toggles):
+    # blue through green and yellow to red
+    return f"{0.667 * (1 - self.heat(toggles)):.3f} 0.850 0.950"
+
+  def annotating(self, dot):
+    return ActivityDot(dot, self)
+
+  def report(self, count=10):
+    nets = sorted(self.nets.items(), key=lambda item: -item[1].toggles)[:count]
+    blocks = sorted(self.blocks.items(), key=lambda item: -item[1])[:count]
+    return {
+      "module": self.schematic.name,
+      "scope": self.scope,
+      "nets_mapped": len(self.nets),
+      "nets": [{"net": name, "width": activity.width, "toggles": activity.toggles, "duty": activity.duty} for name, activity in nets],
+      "blocks": [{"block": name, "module": self.schematic.nodes[name].module_name, "toggles": toggles} for name, toggles in blocks],
+    }
+
+  def summary(self, count=10):
+    report = self.report(count)
+    lines = [f"{self.schematic.name}: {report['nets_mapped']} of {len(self.schematic.nodes)} nodes found under {self.scope}"]
+    lines.append(f"{'net':<24}{'width':>6}{'toggles':>12}{'duty':>8}")
+    for net in report["nets"]: lines.append(f"{net['net']:<24}{net['width']:>6}{net['toggles']:>12}{net['duty']:>8.3f}")
+    if report["blocks"]:
+      lines.append(f"{'block':<24}{'module':>14}{'toggles':>12}")
+      for block in report["blocks"]: lines.append(f"{block['block']:<24}{block['module']:>14}{block['toggles']:>12}")
+    return "\n".join(lines)
+
+
+class ActivityDot:
+  # passes nodes and edges through to a DotWriter or Digraph, colouring the blocks and registers by their
+  # toggles and the edges by the toggles of the net they carry, drawn thicker the busier it is
+  def __init__(self, dot, activity: SchematicActivity):
+    self.dot = dot
+    self.activity = activity
+
+  def node(self, name, label=None, **attrs):
+    node = self.activity.schematic.nodes.get(name)
+    if isinstance(node, Block):
+      toggles = self.activity.blocks[name]
+      label = f"{label}\n{toggles} toggles"
+      attrs.update(style="filled", fillcolor=self.activity.color(toggles))
+    elif isinstance(node, Reg) and name in self.activity.nets:
+      attrs.update(style="filled", fillcolor=self.activity.color(self.activity.nets[name].toggles))
+    self.dot.node(name, label, **attrs)
+
+  def edge(self, tail_name, head_name, label=None, **attrs):
+    net = label
+    if net is None:
+      # the unlabelled edges out of a junction or connect point carry the net the point is named after
+      kind, _, rest = tail_name.partition("/")
+      if kind in ("junctionof", "connectof", "inputof"): net = rest
+    activity = self.activity.nets.get(net)
+    if activity is not None: attrs.update(color=self.activity.color(activity.toggles), penwidth=f"{1 + 4 * self.activity.heat(activity.toggles):.2f}")
+    self.dot.edge(tail_name, head_name, label, **attrs)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Count the switching activity of every net in a VCD dump and lay it onto the schematic of a Verilog top module.")
+  parser.add_argument("top", help="top module the dump was taken of")
+  parser.add_argument("vcd", help="VCD dump, optionally gzipped")
+  parser.add_argument("--file-list", default="files.txt", help="file listing the Verilog sources (default: files.txt)")
+  parser.add_argument("--depth", type=int, default=0, help="expand module instances this many levels down (default: 0)")
+  parser.add_argument("--scope", help="dotted scope of the top module in the dump, like cpu5armtb.dut (default: the scope holding most of its nets)")
+  parser.add_argument("--count", type=int, default=10, help="number of busiest nets and blocks to list (default: 10)")
+  parser.add_argument("--draw", metavar="FORMAT", help="draw the schematic coloured by activity to [top].[FORMAT], like png, svg or dot")
+  parser.add_argument("--bundle", action="store_true", help="with --draw, merge parallel edges into bus edges coloured by their busiest signal")
+  parser.add_argument("--output", metavar="PATH", help="write the report as JSON")
+  args = parser.parse_args(argv)
+
+  try:
+    schematic = extract_netlist(args.top, file_list=args.file_list, depth=args.depth)
+    with open_vcd(args.vcd) as stream: activity, codes = VcdReader(stream).read()
+    annotated = SchematicActivity(schematic, activity, codes, args.scope)
+  except (FileNotFoundError, ValueError) as e:
+    print(f"Error: {e}")
+    sys.exit(1)
+  print(annotated.summary(args.count))
+  if args.output:
+    with open(args.output, "w") as f: json.dump(annotated.report(args.count), f, indent=2)
+  if args.draw: schematic.draw_schematic(format=args.draw, activity=annotated, bundle=args.bundle)
+
+
+if __name__ == '__main__':
+  main()
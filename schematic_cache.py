@@ -0,0 +1,60 @@
+import hashlib
+import json
+import mmap
+import os
+
+
+def content_hash(*parts):
+  digest = hashlib.sha256()
+  for part in parts:
+    # a memory-mapped source is hashed in place, the same as its bytes
+    digest.update(part if isinstance(part, (bytes, mmap.mmap)) else str(part).encode())
+    digest.update(b"\0")
+  return digest.hexdigest()
+
+
+class SchematicCache:
+  # modules/<file hash>.json holds the parsed modules of one Verilog file,
+  # dot/<key>.dot the DOT text for a top module and set of files,
+  # renders/<output hash>.txt the hash of the DOT text last rendered to that output
+  def __init__(self, directory: str, salt: str = ""):
+    self.directory = directory
+    self.salt = salt
+    for sub_directory in ["modules", "dot", "renders"]: os.makedirs(os.path.join(directory, sub_directory), exist_ok=True)
+
+  def path(self, sub_directory, name):
+    return os.path.join(self.directory, sub_directory, name)
+
+  def read(self, path):
+    try:
+      with open(path, "r") as f: return f.read()
+    except FileNotFoundError:
+      return None
+
+  def write(self, path, text):
+    # write then rename so a reader never sees half a file
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f: f.write(text)
+    os.replace(temp_path, path)
+
+  def load_modules(self, file_hash):
+    text = self.read(self.path("modules", f"{content_hash(self.salt, file_hash)}.json"))
+    return json.loads(text) if text is not None else None
+
+  def save_modules(self, file_hash, modules_data):
+    self.write(self.path("modules", f"{content_hash(self.salt, file_hash)}.json"), json.dumps(modules_data))
+
+  def dot_key(self, module_name, file_hashes, depth=0, bundle=False):
+    return content_hash(self.salt, module_name, depth, bundle, *file_hashes)
+
+  def load_dot(self, key):
+    return self.read(self.path("dot", f"{key}.dot"))
+
+  def save_dot(self, key, dot_text):
+    self.write(self.path("dot", f"{key}.dot"), dot_text)
+
+  def render_up_to_date(self, output_path, dot_hash):
+    return os.path.exists(output_path) and self.read(self.path("renders", f"{content_hash(os.path.abspath(output_path))}.txt")) == dot_hash
+
+  def record_render(self, output_path, dot_hash):
+    self.write(self.path("renders", f"{content_hash(os.path.abspath(output_path))}.txt"), dot_hash)
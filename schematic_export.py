@@ -0,0 +1,239 @@
+import json
+from typing import BinaryIO, Dict, Iterator, TextIO
+
+from schematic_generator import Block, Gate, MultiInputGate, Schematic, SingleInputGate, TSB, Wire
+from schematic_graph import KIND_OF_TYPE, NODE_TYPES, NodeKind
+
+# a netlist is a stream of records: one schematic header, a node record per node in id order, an outputs
+# record per node that drives anything, and an end record. The binary form holds the same records
+NETLIST_VERSION = 1
+BINARY_MAGIC = b"SNL\x01"
+GATE_KINDS = {SingleInputGate: "single", MultiInputGate: "multi", TSB: "tsb"}
+GATE_TAGS = {"single": 1, "multi": 2, "tsb": 3}
+KIND_NAMES = [kind.name.lower() for kind in NodeKind]
+
+
+def gate_children(gate: Gate):
+  if type(gate) == MultiInputGate: return gate.inputs
+  if type(gate) == TSB: return [gate.input, gate.enable]
+  return [gate.input]
+
+
+def gate_postfix(gate):
+  # the gate tree in postfix order, built with a stack like Gate.__repr__: a net or constant is a string and a
+  # gate is [name, kind, number of inputs], taking that many values before it
+  items = []
+  work = [(gate, False)]
+  while work:
+    item, expanded = work.pop()
+    if not isinstance(item, Gate): items.append(item)
+    elif expanded: items.append([item.name, GATE_KINDS[type(item)], len(gate_children(item))])
+    else:
+      work.append((item, True))
+      work.extend((child, False) for child in reversed(gate_children(item)))
+  return items
+
+
+def gate_from_postfix(items):
+  stack = []
+  for item in items:
+    if isinstance(item, str):
+      stack.append(item)
+      continue
+    name, kind, arity = item
+    children = stack[len(stack) - arity:]
+    del stack[len(stack) - arity:]
+    if kind == "multi": stack.append(MultiInputGate(name, children))
+    elif kind == "tsb": stack.append(TSB(name, children[0], children[1]))
+    else: stack.append(SingleInputGate(name, children[0]))
+  return stack[0]
+
+
+def netlist_records(schematic: Schematic) -> Iterator[dict]:
+  # the records of a schematic one at a time; only the name -> id table is held beside the schematic
+  ids = {name: node_id for node_id, name in enumerate(schematic.nodes)}
+  yield {"record": "schematic", "version": NETLIST_VERSION, "name": schematic.name, "nodes": len(ids), "edges": sum(len(node.outputs) for node in schematic.nodes.values()), "inputs": [ids[node.name] for node in schematic.inputs]}
+  for node_id, node in enumerate(schematic.nodes.values()):
+    record = {"record": "node", "id": node_id, "name": node.name, "kind": KIND_NAMES[KIND_OF_TYPE[type(node)]]}
+    if isinstance(node, Wire) and node.gate is not None: record["gate"] = gate_postfix(node.gate)
+    if isinstance(node, Block):
+      record["module"] = node.module_name
+      record["clocked"] = bool(node.clocked)
+      record["input_nums"] = list(node.input_nums)
+    yield record
+  for node_id, node in enumerate(schematic.nodes.values()):
+    if node.outputs: yield {"record": "outputs", "id": node_id, "outputs": [ids[output.name] for output in node.outputs]}
+  yield {"record": "end"}
+
+
+def write_jsonl(schematic: Schematic, stream: TextIO):
+  for record in netlist_records(schematic): stream.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+
+def read_jsonl(stream: TextIO) -> Iterator[dict]:
+  for line in stream:
+    if line.strip(): yield json.loads(line)
+
+
+class BinaryWriter:
+  # unsigned LEB128 varints; a string is written once in full and later as a reference to its first use
+  def __init__(self, stream: BinaryIO):
+    self.stream = stream
+    self.strings: Dict[str, int] = {}
+
+  def varint(self, value):
+    data = bytearray()
+    while True:
+      byte = value & 0x7f
+      value >>= 7
+      if value:
+        data.append(byte | 0x80)
+      else:
+        data.append(byte)
+        break
+    self.stream.write(data)
+
+  def string(self, text):
+    # 0 and the UTF-8 bytes for a new string, or 1 + the number of an earlier one
+    if text in self.strings:
+      self.varint(self.strings[text] + 1)
+      return
+    self.strings[text] = len(self.strings)
+    data = text.encode()
+    self.varint(0)
+    self.varint(len(data))
+    self.stream.write(data)
+
+
+class BinaryReader:
+  def __init__(self, stream: BinaryIO):
+    self.stream = stream
+    self.strings = []
+
+  def byte(self):
+    data = self.stream.read(1)
+    if not data: raise EOFError("netlist ends in the middle of a record")
+    return data[0]
+
+  def varint(self):
+    value = shift = 0
+    while True:
+      byte = self.byte()
+      value |= (byte & 0x7f) << shift
+      shift += 7
+      if not byte & 0x80: return value
+
+  def string(self):
+    reference = self.varint()
+    if reference: return self.strings[reference - 1]
+    text = self.stream.read(self.varint()).decode()
+    self.strings.append(text)
+    return text
+
+
+def write_binary(schematic: Schematic, stream: BinaryIO):
+  # each record of netlist_records in order: the header, then per node its kind byte (0x80 set when a gate
+  # follows) and name, then the outputs of every node as a count and ids
+  writer = BinaryWriter(stream)
+  stream.write(BINARY_MAGIC)
+  node_count = next_outputs = 0
+  for record in netlist_records(schematic):
+    kind = record["record"]
+    if kind == "schematic":
+      node_count = record["nodes"]
+      writer.string(record["name"])
+      for count in (record["nodes"], record["edges"], len(record["inputs"])): writer.varint(count)
+      for node_id in record["inputs"]: writer.varint(node_id)
+    elif kind == "node":
+      stream.write(bytes([KIND_NAMES.index(record["kind"]) | (0x80 if "gate" in record else 0)]))
+      writer.string(record["name"])
+      if "module" in record:
+        writer.string(record["module"])
+        stream.write(bytes([record["clocked"]]))
+        writer.varint(len(record["input_nums"]))
+        for num in record["input_nums"]: writer.string(num)
+      if "gate" in record:
+        writer.varint(len(record["gate"]))
+        for item in record["gate"]:
+          if isinstance(item, str):
+            stream.write(b"\x00")
+            writer.string(item)
+          else:
+            stream.write(bytes([GATE_TAGS[item[1]]]))
+            writer.string(item[0])
+            writer.varint(item[2])
+    else:
+      # every node gets an outputs list in the binary form, empty for the nodes that have no outputs record
+      last = record["id"] if kind == "outputs" else node_count
+      for _ in range(last - next_outputs): writer.varint(0)
+      if kind == "outputs":
+        writer.varint(len(record["outputs"]))
+        for node_id in record["outputs"]: writer.varint(node_id)
+        next_outputs = record["id"] + 1
+
+
+def read_binary(stream: BinaryIO) -> Iterator[dict]:
+  # the same records read_jsonl gives for the same schematic
+  if stream.read(len(BINARY_MAGIC)) != BINARY_MAGIC: raise ValueError("not a binary netlist")
+  reader = BinaryReader(stream)
+  name = reader.string()
+  node_count, edge_count, input_count = reader.varint(), reader.varint(), reader.varint()
+  yield {"record": "schematic", "version": NETLIST_VERSION, "name": name, "nodes": node_count, "edges": edge_count, "inputs": [reader.varint() for _ in range(input_count)]}
+  tags = {tag: kind for kind, tag in GATE_TAGS.items()}
+  for node_id in range(node_count):
+    kind_byte = reader.byte()
+    kind = KIND_NAMES[kind_byte & 0x7f]
+    record = {"record": "node", "id": node_id, "name": reader.string(), "kind": kind}
+    if kind == "block":
+      record["module"] = reader.string()
+      record["clocked"] = bool(reader.byte())
+      record["input_nums"] = [reader.string() for _ in range(reader.varint())]
+    if kind_byte & 0x80:
+      items = []
+      for _ in range(reader.varint()):
+        tag = reader.byte()
+        if tag == 0: items.append(reader.string())
+        else:
+          gate_name = reader.string()
+          items.append([gate_name, tags[tag], reader.varint()])
+      record["gate"] = items
+    yield record
+  for node_id in range(node_count):
+    outputs = [reader.varint() for _ in range(reader.varint())]
+    if outputs: yield {"record": "outputs", "id": node_id, "outputs": outputs}
+  yield {"record": "end"}
+
+
+def write_netlist(schematic: Schematic, path, format="jsonl"):
+  if format == "jsonl":
+    with open(path, "w") as f: write_jsonl(schematic, f)
+  else:
+    with open(path, "wb") as f: write_binary(schematic, f)
+
+
+def read_netlist(path) -> Iterator[dict]:
+  # the records of a netlist file in either format, told apart by the binary header
+  with open(path, "rb") as f: binary = f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+  if binary:
+    with open(path, "rb") as f: yield from read_binary(f)
+  else:
+    with open(path, "r") as f: yield from read_jsonl(f)
+
+
+def schematic_from_records(records) -> Schematic:
+  # rebuilds the node objects from a stream of records
+  nodes = []
+  for record in records:
+    kind = record["record"]
+    if kind == "schematic":
+      schematic = Schematic(record["name"])
+      inputs = record["inputs"]
+    elif kind == "node":
+      node = NODE_TYPES[KIND_NAMES.index(record["kind"])](name=record["name"])
+      if "gate" in record: node.gate = gate_from_postfix(record["gate"])
+      if "module" in record: node.module_name, node.clocked, node.input_nums = record["module"], record["clocked"], list(record["input_nums"])
+      schematic.nodes[node.name] = node
+      nodes.append(node)
+    elif kind == "outputs": nodes[record["id"]].outputs = [nodes[node_id] for node_id in record["outputs"]]
+  schematic.inputs = [nodes[node_id] for node_id in inputs]
+  return schematic
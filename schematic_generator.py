@@ -1,123 +1,405 @@
+import argparse
+import contextlib
+import io
+import json
+import mmap
+import os
+import re
 import sys
-from dataclasses import dataclass, field
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from dataclasses import dataclass, field, fields, replace
 from typing import List, Dict, Union
-from graphviz import Digraph
+try:
+  from graphviz import Digraph, render
+except ImportError:
+  # only --digraph and rendering an image need the Graphviz bindings, --format dot works without them
+  Digraph = render = None
+from schematic_cache import SchematicCache, content_hash
+from schematic_profile import CAPTURES, Profiler
 
 
-@dataclass
+# every module whose code shapes the DOT text or the parsed modules: the partitions, cones, the compact graph and
+# activity colouring live outside this file. Cache entries written by a different version of any of them are ignored
+DOT_SOURCES = ["schematic_generator.py", "schematic_partition.py", "schematic_graph.py", "schematic_activity.py", "schematic_watch.py"]
+
+
+@lru_cache(maxsize=None)
+def generator_salt():
+  # hashed the first time a cache is opened; a module that isn't installed next to this one is skipped
+  parts = []
+  for name in DOT_SOURCES:
+    try:
+      with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), "rb") as source: parts += [name, source.read()]
+    except FileNotFoundError:
+      continue
+  return content_hash(*parts)
+
+# set by --profile; with profiling off the counters on the hot paths cost one test for None
+profiler: Profiler = None
+
+
+def phase(name):
+  return profiler.phase(name) if profiler is not None else contextlib.nullcontext()
+
+
+@contextlib.contextmanager
+def profiling(new_profiler: Profiler):
+  global profiler
+  previous, profiler = profiler, new_profiler
+  cache_misses = parse_expression.cache_info().misses
+  new_profiler.start()
+  try: yield new_profiler
+  finally:
+    new_profiler.stop()
+    new_profiler.counts["parse_expression_misses"] += parse_expression.cache_info().misses - cache_misses
+    profiler = previous
+
+
+@dataclass(repr=False, slots=True)
 class Gate:
   name: str
 
-@dataclass
+  def __repr__(self):
+    # same text as the dataclass repr, built with a stack so deep gate trees don't hit the recursion limit
+    text = []
+    work = [self]
+    while work:
+      item = work.pop()
+      if isinstance(item, Gate):
+        parts = [f"{type(item).__name__}(name={item.name!r}"]
+        for gate_field in fields(item)[1:]:
+          value = getattr(item, gate_field.name)
+          parts.append(f", {gate_field.name}=")
+          if isinstance(value, list):
+            parts.append("[")
+            for idx, element in enumerate(value):
+              if idx: parts.append(", ")
+              parts.append(element if isinstance(element, Gate) else repr(element))
+            parts.append("]")
+          else: parts.append(value if isinstance(value, Gate) else repr(value))
+        parts.append(")")
+        work.extend(reversed(parts))
+      else: text.append(item)
+    return "".join(text)
+
+@dataclass(repr=False, slots=True)
 class SingleInputGate(Gate):
   input: Union[str, Gate]
 
-@dataclass
+@dataclass(repr=False, slots=True)
 class MultiInputGate(Gate):
   inputs: List[Union[str, Gate]] = field(default_factory=list)
 
-@dataclass
+@dataclass(repr=False, slots=True)
 class TSB(SingleInputGate):
   enable: Union[str, Gate]
 
-@dataclass
+@dataclass(slots=True)
 class Node:
   name: str
 
-@dataclass
+@dataclass(slots=True)
 class Input(Node):
   outputs: List[Node] = field(default_factory=list)
 
-@dataclass
+@dataclass(slots=True)
 class Wire(Input):
   gate: Gate = None
 
-@dataclass
+@dataclass(slots=True)
 class Output(Wire):
   pass
 
-@dataclass
+@dataclass(slots=True)
 class Inout(Output):
   pass
 
-@dataclass
+@dataclass(slots=True)
 class Block(Inout):
   clocked: bool = False
   input_nums: List[str] = field(default_factory=list)
   module_name: str = None
 
-@dataclass
+@dataclass(slots=True)
 class Reg(Wire):
   pass
 
 
+def statement_gate(line, tokens):
+  # the gate of an assign or nonblocking statement, or None
+  if tokens is None and line is not None: tokens = tokenize_line(line)
+  if tokens is not None and len(tokens) > 5:
+    gate = build_gate(tokens[3:-1])
+    if isinstance(gate, Gate): return gate
+  return None
+
+
+# a token is a run of non-separator characters or a single separator; spaces separate but are dropped
+TOKEN = re.compile(r"[^ ,:?;&|+\-*=.]+|[,:?;&|+\-*=.]")
+COMMENT_START = re.compile(r"/\*|//|`")
+
+
 def tokenize_line(line):
+  if profiler is not None: profiler.counts["tokenize_line"] += 1
+  return TOKEN.findall(line)
+
+
+# operators split apart by tokenize_line ("& &", "= =") are put back together here
+EXPRESSION_TOKEN = re.compile(r"""\s*(?:
+  (?P<number>\d[\d_]*\s*'[sS]?[bBoOdDhH]\s*[0-9a-fA-FxXzZ_?]+|'[sS]?[bBoOdDhH][0-9a-fA-FxXzZ_?]+|\d[\d_]*)
+  |(?P<name>[A-Za-z_\\$][\w$]*(?:\s*\[[^\]]*\])*)
+  |(?P<operator>=\s*=\s*=|!\s*=\s*=|=\s*=|!\s*=|<\s*=|>\s*=|&\s*&|\|\s*\||<<<|>>>|<<|>>|~&|~\||~\^|\^~|\*\*|[~!&|^+\-*/%<>?:(),{}])
+)""", re.X)
+BINARY_PRECEDENCE = {"||": 2, "&&": 3, "|": 4, "^": 5, "~^": 5, "^~": 5, "&": 6, "==": 7, "!=": 7, "===": 7, "!==": 7, "<": 8, "<=": 8, ">": 8, ">=": 8, "<<": 9, ">>": 9, "<<<": 9, ">>>": 9, "+": 10, "-": 10, "*": 11, "/": 11, "%": 11, "**": 12}
+UNARY_OPERATORS = {"~", "!", "-", "+", "&", "|", "^", "~&", "~|", "~^", "^~"}
+UNARY_PRECEDENCE = 13
+TERNARY_PRECEDENCE = 1
+# gate names the schematic has always used for these operators
+GATE_NAMES = {"&&": "&", "||": "|", "==": "="}
+
+
+def lex_expression(text):
   tokens = []
-  current_token = ""
-  for char in line:
-    if current_token == "" and char == " ": continue
-    elif char != " " and char != "," and char != ":" and char != "?" and char != ";" and char != "&" and char != "|" and char != "+" and char != "-" and char != "*" and char != "=" and char != ".":
-      current_token += char
-    else:
-      if current_token != "": tokens.append(current_token)
-      current_token = ""
-      if char != " ": tokens.append(char)
-  if current_token != "": tokens.append(current_token)
+  i = 0
+  text = text.rstrip()
+  while i < len(text):
+    match = EXPRESSION_TOKEN.match(text, i)
+    if match is None or match.end() == i: raise ValueError(f"Unexpected character {text[i:].strip()[:1]!r} in expression: {text}")
+    kind = match.lastgroup
+    tokens.append((kind, "".join(match.group(kind).split())))
+    i = match.end()
   return tokens
 
 
+def is_high_z(operand):
+  return isinstance(operand, str) and operand[0].isdigit() and '\'' in operand and 'z' in operand.lower()
+
+
+def reduce_operator(operators, operands):
+  kind, value = operators.pop()
+  if kind == "unary":
+    operands[-1] = [SingleInputGate(name=value, input=operands[-1][0]), False]
+  elif kind == "binary":
+    right, right_grouped = operands.pop()
+    left, left_grouped = operands[-1]
+    name = GATE_NAMES.get(value, value)
+    # a && b & c binds as a && (b & c) but both are drawn as one & gate
+    right_inputs = right.inputs if isinstance(right, MultiInputGate) and right.name == name and name in GATE_NAMES.values() and not right_grouped else [right]
+    # operators chained without parenthesis share one gate, like a | b | c
+    if isinstance(left, MultiInputGate) and left.name == name and not left_grouped: left.inputs.extend(right_inputs)
+    else: operands[-1] = [MultiInputGate(name=name, inputs=[left] + right_inputs), False]
+  elif kind == ":":
+    if_false, _ = operands.pop()
+    if_true, _ = operands.pop()
+    condition, _ = operands[-1]
+    if is_high_z(if_false): operands[-1] = [TSB(name="Tri-State Buffer", input=condition, enable=if_true), False]
+    else: operands[-1] = [MultiInputGate(name="?", inputs=[condition, if_true, if_false]), False]
+  else: raise ValueError(f"Unbalanced {kind!r} in expression")
+
+
+def operator_precedence(entry):
+  kind, value = entry
+  if kind == "unary": return UNARY_PRECEDENCE
+  if kind == "binary": return BINARY_PRECEDENCE[value]
+  if kind == "?" or kind == ":": return TERNARY_PRECEDENCE
+  return None
+
+
+def reduce_to_marker(operators, operands, text):
+  while operators and operator_precedence(operators[-1]) is not None:
+    if operators[-1][0] == "?": raise ValueError(f"'?' without ':' in expression: {text}")
+    reduce_operator(operators, operands)
+
+
+@lru_cache(maxsize=4096)
+def parse_expression(text):
+  # shunting-yard: one pass over the tokens with an operand and an operator stack, so nesting depth costs no recursion
+  operands = [] # [gate or leaf name, wrapped in parenthesis]
+  operators = [] # (kind, value); "(" and "{" entries are markers that stop reductions
+  expect_operand = True
+  for kind, value in lex_expression(text):
+    if kind != "operator":
+      if not expect_operand: raise ValueError(f"Missing operator before {value} in expression: {text}")
+      operands.append([value, False])
+      expect_operand = False
+    elif expect_operand and value in UNARY_OPERATORS: operators.append(("unary", value))
+    elif value == "(":
+      if not expect_operand: raise ValueError(f"Missing operator before '(' in expression: {text}")
+      operators.append(("(", len(operands)))
+    elif value == ")":
+      if expect_operand: raise ValueError(f"Missing operand before ')' in expression: {text}")
+      reduce_to_marker(operators, operands, text)
+      if not operators or operators[-1][0] != "(" or len(operands) != operators[-1][1] + 1: raise ValueError(f"Unbalanced ')' in expression: {text}")
+      operators.pop()
+      operands[-1][1] = True
+      expect_operand = False
+    elif value == "{":
+      if expect_operand: operators.append(("{", len(operands)))
+      elif operators and operators[-1][0] == "{" and len(operands) == operators[-1][1] + 1:
+        # replication, {count{value}}
+        count = operands.pop()[0]
+        operators.append(("{replicate", (count, len(operands))))
+        expect_operand = True
+      else: raise ValueError(f"Missing operator before '{{' in expression: {text}")
+    elif value == "," or value == "}":
+      if expect_operand: raise ValueError(f"Missing operand before {value!r} in expression: {text}")
+      reduce_to_marker(operators, operands, text)
+      if not operators or not operators[-1][0].startswith("{"): raise ValueError(f"Unexpected {value!r} in expression: {text}")
+      if value == "}":
+        kind, start = operators.pop()
+        if kind == "{replicate": (count, start) = start
+        parts = [operand for operand, _ in operands[start:]]
+        del operands[start:]
+        if kind == "{replicate": operands.append([MultiInputGate(name="{" + (count if isinstance(count, str) else "n") + "}", inputs=parts), True])
+        elif len(parts) == 1: operands.append([parts[0], True])
+        else: operands.append([MultiInputGate(name="{}", inputs=parts), True])
+        expect_operand = False
+      else: expect_operand = True
+    elif value == "?" or value == ":" or value in BINARY_PRECEDENCE:
+      if expect_operand: raise ValueError(f"Missing operand before {value!r} in expression: {text}")
+      precedence = TERNARY_PRECEDENCE if value in "?:" else BINARY_PRECEDENCE[value]
+      while operators and operator_precedence(operators[-1]) is not None and operators[-1][0] != "?":
+        # ?: is right associative, everything else is left associative
+        if operator_precedence(operators[-1]) < precedence or (precedence == TERNARY_PRECEDENCE and value == "?"): break
+        reduce_operator(operators, operands)
+      if value == ":":
+        if not operators or operators[-1][0] != "?": raise ValueError(f"':' without '?' in expression: {text}")
+        operators[-1] = (":", None)
+      elif value == "?": operators.append(("?", None))
+      else: operators.append(("binary", value))
+      expect_operand = True
+    else: raise ValueError(f"Unexpected {value!r} in expression: {text}")
+  if expect_operand: raise ValueError(f"Incomplete expression: {text}")
+  reduce_to_marker(operators, operands, text)
+  if operators or len(operands) != 1: raise ValueError(f"Incomplete expression: {text}")
+  return operands[0][0]
+
+
 def build_gate(raw_tokens: List[str]):
-  not_the_gate = False
-  tokens = [t.strip() for t in raw_tokens]
-  while (tokens[0].startswith('(') and tokens[-1].endswith(')')) or (tokens[0].startswith('~(') and tokens[-1].endswith(')')):
-    if tokens[0].startswith('(') and tokens[-1].endswith(')'):
-      tokens[0] = tokens[0][1:]
-      tokens[-1] = tokens[-1][:-1]
-      tokens = [item for item in tokens if item]
-    else:
-      not_the_gate = True
-      tokens[0] = tokens[0][1:]
-  groups = []
-  group_element = ""
-  parenthesis_level = 0
-  for idx, raw_token in enumerate(tokens):
-    token = raw_token
-    if token.count('(') == token.count(')'): token = raw_token.replace('(', "").replace(')', "")
-    group_element += f"{token}"
-    parenthesis_level += (token.count('(') - token.count(')'))
-    if parenthesis_level == 0:
-      groups.append(group_element)
-      group_element = ""
-    elif idx < len(tokens) - 1 and (token != tokens[idx+1] or len(token) != 1) and not token.endswith('('): group_element += " "
-  
-  return_gate = None
-  for idx, ele in enumerate(groups):
-    if len(ele) == 1 and ele == groups[idx-1]: groups.pop(idx)
-  gate_chars = set([ele for ele in groups if len(ele) == 1])
-  #TSB case
-  if len(groups) > 4 and groups[1] == '?' and groups[3] == ':' and '\'' in groups[4] and 'z' in groups[4].lower() and groups[4][0].isdigit():
-    input_field = None
-    if '(' not in groups[0] and ')' not in groups[0]: input_field = groups[0]
-    else: input_field = build_gate(tokenize_line(groups[0]))
-    enable_field = None
-    if '(' not in groups[2] and ')' not in groups[2]: enable_field = groups[2]
-    else: enable_field = build_gate(tokenize_line(groups[2]))
-    return_gate = TSB(name="Tri-State Buffer", input=input_field, enable=enable_field)
-  elif len(gate_chars) != 1: raise ValueError(f"Groups: {groups}\nRaw tokens: {raw_tokens}\nTokens: {tokens}\nNot: {not_the_gate}\nI was too lazy to implement operator precedence. Please use parenthesis to indicate order of operations. This error could also hit if there is no logic gate operator.")
-  else:
-    return_gate = MultiInputGate(name=next(iter(gate_chars)))
-    for group in groups:
-      if group == next(iter(gate_chars)):
+  # the parse is cached by the normalized expression text, so the returned tree may be shared and must not be modified
+  if profiler is not None: profiler.counts["build_gate"] += 1
+  with phase("build_gate"):
+    text = " ".join(raw_token.strip() for raw_token in raw_tokens)
+    return parse_expression(" ".join(value for _, value in lex_expression(text)))
+
+
+DOT_ID = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*|-?(\.[0-9]+|[0-9]+(\.[0-9]*)?))$')
+DOT_HTML_STRING = re.compile(r'<.*>$', re.DOTALL)
+DOT_KEYWORDS = {'node', 'edge', 'graph', 'digraph', 'subgraph', 'strict'}
+DOT_UNESCAPED_QUOTE = re.compile(r'(?P<escaped_backslashes>(?:\\{2})*)\\?(?P<literal_quote>")')
+GRAPH_ATTR = {'rankdir': 'LR'}
+# --format values written by schematic_export instead of Graphviz
+NETLIST_FORMATS = ["jsonl", "netlist"]
+NODE_ATTR = {'shape': 'box'}
+
+
+@lru_cache(maxsize=65536)
+def dot_quote(identifier: str):
+  # same quoting as graphviz.quoting.quote so streamed output matches Digraph.source
+  if DOT_HTML_STRING.match(identifier): return identifier
+  if not DOT_ID.match(identifier) or identifier.lower() in DOT_KEYWORDS: return '"' + DOT_UNESCAPED_QUOTE.sub(r'\g<escaped_backslashes>\\\g<literal_quote>', identifier) + '"'
+  return identifier
+
+
+def dot_quote_edge(identifier: str):
+  node, _, rest = identifier.partition(':')
+  parts = [dot_quote(node)]
+  if rest:
+    port, _, compass = rest.partition(':')
+    parts.append(dot_quote(port))
+    if compass: parts.append(compass)
+  return ':'.join(parts)
+
+
+def dot_attr_list(label=None, attrs=None):
+  result = [f'label={dot_quote(label)}'] if label is not None else []
+  if attrs: result += [f'{dot_quote(k)}={dot_quote(v)}' for k, v in sorted(attrs.items()) if v is not None]
+  return f' [{" ".join(result)}]' if result else ''
+
+
+class DotWriter:
+  # writes each node and edge straight to a stream instead of keeping a Digraph body in memory
+  def __init__(self, stream, graph_attr=None, node_attr=None):
+    self.stream = stream
+    self.stream.write('digraph {\n')
+    if graph_attr: self.stream.write(f'\tgraph{dot_attr_list(attrs=graph_attr)}\n')
+    if node_attr: self.stream.write(f'\tnode{dot_attr_list(attrs=node_attr)}\n')
+
+  def node(self, name, label=None, **attrs):
+    self.stream.write(f'\t{dot_quote(name)}{dot_attr_list(label, attrs)}\n')
+
+  def edge(self, tail_name, head_name, label=None, **attrs):
+    self.stream.write(f'\t{dot_quote_edge(tail_name)} -> {dot_quote_edge(head_name)}{dot_attr_list(label, attrs)}\n')
+
+  def close(self):
+    self.stream.write('}\n')
+
+
+def bus_label(names):
+  # a bundle of signals by name, or by count once the names would crowd the drawing
+  return ", ".join(names) if len(names) <= 3 else f"{len(names)} signals"
+
+
+class BundlingDot:
+  # passes nodes through to a DotWriter or Digraph but holds back the edges and connect points until flush.
+  # A point with one edge in and one out becomes a single edge, then edges that share a tail, a head and a
+  # style become one bus edge labelled with their signals, which are all listed in its tooltip
+  def __init__(self, dot):
+    self.dot = dot
+    self.points: Dict[str, tuple] = {}
+    self.edges: List[list] = []
+
+  def node(self, name, label=None, **attrs):
+    if attrs.get('shape') == 'point': self.points[name] = (label, attrs)
+    else: self.dot.node(name, label, **attrs)
+
+  def edge(self, tail_name, head_name, label=None, **attrs):
+    self.edges.append([tail_name, head_name, label, attrs])
+
+  def flush(self):
+    incoming: Dict[str, List[list]] = {}
+    outgoing: Dict[str, List[list]] = {}
+    for edge in self.edges:
+      outgoing.setdefault(edge[0], []).append(edge)
+      incoming.setdefault(edge[1], []).append(edge)
+    # the edge into a point takes over the head, label and arrow of the edge out of it; a chain of points
+    # collapses one point at a time
+    removed = set()
+    for point in self.points:
+      into, out_of = incoming.get(point, []), outgoing.get(point, [])
+      if len(into) != 1 or len(out_of) != 1 or into[0] is out_of[0]: continue
+      edge, after = into[0], out_of[0]
+      edge[1], edge[2], edge[3] = after[1], after[2] if after[2] is not None else edge[2], after[3]
+      heads = incoming[after[1]]
+      heads[next(i for i, other in enumerate(heads) if other is after)] = edge
+      incoming[point], outgoing[point] = [], []
+      removed.add(id(after))
+      removed.add(point)
+    for point, (label, attrs) in self.points.items():
+      if point not in removed: self.dot.node(point, label, **attrs)
+    # colour and width come from --draw activity and don't split a bus; it takes those of its busiest signal
+    bundles: Dict[tuple, List[list]] = {}
+    for edge in self.edges:
+      if id(edge) in removed: continue
+      style = tuple(sorted((k, v) for k, v in edge[3].items() if k not in ('color', 'penwidth', 'tooltip')))
+      bundles.setdefault((edge[0], edge[1], style), []).append(edge)
+    for (tail_name, head_name, _), edges in bundles.items():
+      if len(edges) == 1:
+        self.dot.edge(tail_name, head_name, edges[0][2], **edges[0][3])
         continue
-      if '(' in group and ')' in group:
-        return_gate.inputs.append(build_gate(tokenize_line(group)))
-      else:
-        appending_input = group
-        if group[0] == '~': appending_input = SingleInputGate(name='~', input=group[1:])
-        return_gate.inputs.append(appending_input)
-  
-  if not_the_gate: return SingleInputGate(name='~', input=return_gate)
-  else: return return_gate
+      names = list(dict.fromkeys(edge[2] for edge in edges if edge[2] is not None))
+      attrs = dict(max(edges, key=lambda edge: float(edge[3].get('penwidth', 0)))[3])
+      if names: attrs['tooltip'] = ", ".join(names)
+      self.dot.edge(tail_name, head_name, bus_label(names) if names else None, **attrs)
+    self.points, self.edges = {}, []
+
+
+class NullDot:
+  # stands in for a graph when only the names of the gate nodes are wanted
+  def node(self, name, label=None, **attrs): pass
+  def edge(self, tail_name, head_name, label=None, **attrs): pass
 
 
 class Schematic:
@@ -127,88 +409,165 @@ class Schematic:
     self.nodes: Dict[str, Node] = {}
     self.node_visited: Dict[str, bool] = {}
     self.gate_nodes: Dict[str, List[str]] = {}
-    self.gate_names: List[str] = []
+    # next free number for each gate node name prefix
+    self.gate_counts: Dict[str, int] = {}
   
-  def connect(self, input: Input, output_name: str, node_type, clk=None, line=None, module_name=None):
+  def connect(self, input: Input, output_name: str, node_type, clk=None, line=None, module_name=None, tokens=None):
     visited = output_name in self.nodes.keys()
     if not visited: self.nodes[output_name] = node_type(name=output_name)
     input.outputs.append(self.nodes[output_name])
     if node_type is Block:
       self.nodes[output_name].clocked = clk
       self.nodes[output_name].module_name = module_name
-    if line is not None and len(tokenize_line(line)) > 5: self.nodes[output_name].gate = build_gate(tokenize_line(line)[3:-1])
+    gate = statement_gate(line, tokens)
+    if gate is not None: self.nodes[output_name].gate = gate
+    self.node_visited[output_name] = visited
     return visited
 
+  def visited(self, name):
+    # whether the node already existed when it was last connected; the DFS only follows nodes it just made
+    return self.node_visited[name]
+
   def add_input(self, input: Input):
     self.inputs.append(input)
     self.nodes[input.name] = input
+
+  def compact(self, release=False):
+    # the same graph as integer node IDs and arrays, see schematic_graph.SchematicGraph; release empties this schematic
+    from schematic_graph import SchematicGraph
+    return SchematicGraph.from_schematic(self, release)
   
-  def input_to_block(self, dot: Digraph, start_name: str, input: Input):
-    if type(input) == Output or type(input) == Inout: dot.node(f'outputof/{input.name}', style='invis')
-    if len(input.outputs) > 1:
-      dot.node(f'junctionof/{input.name}', shape='point', width='0.01')
-      dot.edge(start_name, f'junctionof/{input.name}', label=input.name, arrowhead='none')
-      if type(input) == Output: dot.edge(f'junctionof/{input.name}', f'outputof/{input.name}', label=input.name)
-      elif type(input) == Inout: dot.edge(f'junctionof/{input.name}', f'outputof/{input.name}', label=input.name, dir='both')
-      for output in input.outputs:
-        if isinstance(output, Block) or isinstance(output, Reg): dot.edge(f'junctionof/{input.name}', output.name)
-        elif isinstance(output, Wire) and output.gate is not None:
-          for gate_node in self.gate_nodes[input.name]: dot.edge(f'junctionof/{input.name}', gate_node)
-        else: self.input_to_block(dot, f'junctionof/{input.name}', output)
-    elif len(input.outputs) == 1:
-      if isinstance(input.outputs[0], Block) or isinstance(input.outputs[0], Reg):
-        if type(input) == Output or type(input) == Inout:
-          dot.node(f'connectof/{input.name}', shape='point', width='0.01')
-          dot.edge(start_name, f'connectof/{input.name}', label=input.name, arrowhead='none')
-          if type(input) == Output: dot.edge(f'connectof/{input.name}', f'outputof/{input.name}', label=input.name)
-          elif type(input) == Inout: dot.edge(f'connectof/{input.name}', f'outputof/{input.name}', label=input.name, dir='both')
-          dot.edge(f'connectof/{input.name}', input.outputs[0].name, label=input.name)
-        else: dot.edge(start_name, input.outputs[0].name, label=input.name)
-      elif isinstance(input.outputs[0], Wire) and input.outputs[0].gate is not None:
-        if type(input) == Output or type(input) == Inout:
+  def input_to_block(self, dot: Union[Digraph, DotWriter], start_name: str, input: Input):
+    work = [(start_name, input)]
+    # a loop made only of plain wires, possible once instances are elaborated, is walked once
+    walked = set()
+    while work:
+      start_name, input = work.pop()
+      if isinstance(input, str):
+        dot.edge(start_name, input)
+        continue
+      if (start_name, input.name) in walked: continue
+      walked.add((start_name, input.name))
+      if type(input) == Output or type(input) == Inout: dot.node(f'outputof/{input.name}', style='invis')
+      if len(input.outputs) > 1:
+        dot.node(f'junctionof/{input.name}', shape='point', width='0.01')
+        dot.edge(start_name, f'junctionof/{input.name}', label=input.name, arrowhead='none')
+        if type(input) == Output: dot.edge(f'junctionof/{input.name}', f'outputof/{input.name}', label=input.name)
+        elif type(input) == Inout: dot.edge(f'junctionof/{input.name}', f'outputof/{input.name}', label=input.name, dir='both')
+        # queued in reverse so the junction's edges come out in output order
+        pending = []
+        for output in input.outputs:
+          if isinstance(output, Block) or isinstance(output, Reg): pending.append((f'junctionof/{input.name}', output.name))
+          elif isinstance(output, Wire) and output.gate is not None:
+            for gate_node in self.gate_nodes[input.name]: pending.append((f'junctionof/{input.name}', gate_node))
+          else: pending.append((f'junctionof/{input.name}', output))
+        work.extend(reversed(pending))
+      elif len(input.outputs) == 1:
+        if isinstance(input.outputs[0], Block) or isinstance(input.outputs[0], Reg):
+          if type(input) == Output or type(input) == Inout:
+            dot.node(f'connectof/{input.name}', shape='point', width='0.01')
+            dot.edge(start_name, f'connectof/{input.name}', label=input.name, arrowhead='none')
+            if type(input) == Output: dot.edge(f'connectof/{input.name}', f'outputof/{input.name}', label=input.name)
+            elif type(input) == Inout: dot.edge(f'connectof/{input.name}', f'outputof/{input.name}', label=input.name, dir='both')
+            dot.edge(f'connectof/{input.name}', input.outputs[0].name, label=input.name)
+          else: dot.edge(start_name, input.outputs[0].name, label=input.name)
+        elif isinstance(input.outputs[0], Wire) and input.outputs[0].gate is not None:
+          if type(input) == Output or type(input) == Inout:
+            dot.node(f'connectof/{input.name}', shape='point', width='0.01')
+            dot.edge(start_name, f'connectof/{input.name}', label=input.name, arrowhead='none')
+            if type(input) == Output: dot.edge(f'connectof/{input.name}', f'outputof/{input.name}', label=input.name)
+            elif type(input) == Inout: dot.edge(f'connectof/{input.name}', f'outputof/{input.name}', label=input.name, dir='both')
+            for gate_node in self.gate_nodes[input.name]: dot.edge(f'connectof/{input.name}', gate_node, label=input.name)
+          else: 
+            for gate_node in self.gate_nodes[input.name]: dot.edge(start_name, gate_node, label=input.name)
+        else:
           dot.node(f'connectof/{input.name}', shape='point', width='0.01')
           dot.edge(start_name, f'connectof/{input.name}', label=input.name, arrowhead='none')
           if type(input) == Output: dot.edge(f'connectof/{input.name}', f'outputof/{input.name}', label=input.name)
           elif type(input) == Inout: dot.edge(f'connectof/{input.name}', f'outputof/{input.name}', label=input.name, dir='both')
-          for gate_node in self.gate_nodes[input.name]: dot.edge(f'connectof/{input.name}', gate_node, label=input.name)
-        else: 
-          for gate_node in self.gate_nodes[input.name]: dot.edge(start_name, gate_node, label=input.name)
+          work.append((f'connectof/{input.name}', input.outputs[0]))
+      # an output nothing inside the module reads still needs its arrow out
+      elif type(input) == Output: dot.edge(start_name, f'outputof/{input.name}', label=input.name)
+      elif type(input) == Inout: dot.edge(start_name, f'outputof/{input.name}', label=input.name, dir='both')
+
+  def gate_level_up(self, dot: Union[Digraph, DotWriter], gate_name_below: str, current_level_content: Union[str, Gate], level: int, wire_name: str, record=True):
+    work = [(gate_name_below, current_level_content, level)]
+    while work:
+      gate_name_below, current_level_content, level = work.pop()
+      if isinstance(current_level_content, Gate):
+        gate_prefix = f'gatelevel{level}/{wire_name}/{current_level_content.name}'
+        num = self.gate_counts.get(gate_prefix, 0)
+        self.gate_counts[gate_prefix] = num + 1
+        gate_node_name = f'{gate_prefix}/{num}'
+        dot.node(gate_node_name, current_level_content.name)
+        dot.edge(gate_node_name, gate_name_below)
+        if type(current_level_content) == SingleInputGate: gate_inputs = [current_level_content.input]
+        elif type(current_level_content) == TSB: gate_inputs = [current_level_content.input, current_level_content.enable]
+        elif type(current_level_content) == MultiInputGate: gate_inputs = current_level_content.inputs
+        else: gate_inputs = []
+        for gate_input in reversed(gate_inputs): work.append((gate_node_name, gate_input, level+1))
       else:
-        dot.node(f'connectof/{input.name}', shape='point', width='0.01')
-        dot.edge(start_name, f'connectof/{input.name}', label=input.name, arrowhead='none')
-        if type(input) == Output: dot.edge(f'connectof/{input.name}', f'outputof/{input.name}', label=input.name)
-        elif type(input) == Inout: dot.edge(f'connectof/{input.name}', f'outputof/{input.name}', label=input.name, dir='both')
-        self.input_to_block(dot, f'connectof/{input.name}', input.outputs[0])
-
-  def gate_level_up(self, dot: Digraph, gate_name_below: str, current_level_content: Union[str, Gate], level: int, wire_name: str):
-    if isinstance(current_level_content, Gate):
-      num = 0
-      gate_node_name = f'gatelevel{level}/{wire_name}/{current_level_content.name}/{num}'
-      while gate_node_name in self.gate_names:
-        num += 1
-        gate_node_name = f'gatelevel{level}/{wire_name}/{current_level_content.name}/{num}'
-      self.gate_names.append(gate_node_name)
-      dot.node(gate_node_name, current_level_content.name)
-      dot.edge(gate_node_name, gate_name_below)
-      if type(current_level_content) == SingleInputGate: self.gate_level_up(dot, gate_node_name, current_level_content.input, level+1, wire_name)
-      elif type(current_level_content) == TSB:
-        self.gate_level_up(dot, gate_node_name, current_level_content.input, level+1, wire_name)
-        self.gate_level_up(dot, gate_node_name, current_level_content.enable, level+1, wire_name)
-      elif type(current_level_content) == MultiInputGate:
-        for gate_input in current_level_content.inputs: self.gate_level_up(dot, gate_node_name, gate_input, level+1, wire_name)
+        if current_level_content[0].isdigit():
+          dot.node(f'num/{current_level_content}/{gate_name_below}', style='invis')
+          dot.edge(f'num/{current_level_content}/{gate_name_below}', gate_name_below, label=current_level_content)
+        elif not record: continue
+        elif current_level_content not in self.gate_nodes.keys(): self.gate_nodes[current_level_content] = [gate_name_below]
+        else: self.gate_nodes[current_level_content].append(gate_name_below)
+
+  def draw_gate_tree(self, dot: Union[Digraph, DotWriter], wire: Wire, record=True):
+    dot.node(f'gatelevel0/{wire.name}/{wire.gate.name}', wire.gate.name)
+    if type(wire.gate) == SingleInputGate: self.gate_level_up(dot, f'gatelevel0/{wire.name}/{wire.gate.name}', wire.gate.input, 1, wire.name, record)
+    elif type(wire.gate) == TSB:
+      self.gate_level_up(dot, f'gatelevel0/{wire.name}/{wire.gate.name}', wire.gate.input, 1, wire.name, record)
+      self.gate_level_up(dot, f'gatelevel0/{wire.name}/{wire.gate.name}', wire.gate.enable, 1, wire.name, record)
+    elif type(wire.gate) == MultiInputGate:
+      for gate_input in wire.gate.inputs: self.gate_level_up(dot, f'gatelevel0/{wire.name}/{wire.gate.name}', gate_input, 1, wire.name, record)
+
+  def draw_schematic(self, use_digraph=False, format='png', activity=None, bundle=False):
+    # activity, a SchematicActivity from schematic_activity.py, colours the drawing by switching activity;
+    # bundle merges parallel edges into bus edges, see BundlingDot
+    if use_digraph:
+      dot = Digraph(graph_attr=GRAPH_ATTR, node_attr=NODE_ATTR)
+      with phase("emit_dot"): self.emit_schematic(dot, activity, bundle)
+      with phase("render"):
+        if format == 'dot': dot.save(f'{self.name}.dot')
+        else: dot.render(self.name, format=format, cleanup=True)
     else:
-      if current_level_content[0].isdigit():
-        dot.node(f'num/{current_level_content}/{gate_name_below}', style='invis')
-        dot.edge(f'num/{current_level_content}/{gate_name_below}', gate_name_below, label=current_level_content)
-      elif current_level_content not in self.gate_nodes.keys(): self.gate_nodes[current_level_content] = [gate_name_below]
-      else: self.gate_nodes[current_level_content].append(gate_name_below)
-
-  def draw_schematic(self):
-    dot = Digraph(graph_attr={'rankdir': 'LR'}, node_attr={'shape': 'box'})
-
-    blocks = [n for n in self.nodes.values() if isinstance(n, Block)]
-    regs = [n for n in self.nodes.values() if isinstance(n, Reg)]
-    gated_wires = [n for n in self.nodes.values() if isinstance(n, Wire) and not isinstance(n, Block) and not isinstance(n, Reg) and n.gate is not None]
+      dot_path = f'{self.name}.dot' if format == 'dot' else self.name
+      with open(dot_path, 'w') as f: self.write_dot(f, activity, bundle)
+      if format != 'dot':
+        with phase("render"): render('dot', format, dot_path)
+        os.remove(dot_path)
+
+  def dot_source(self, use_digraph=False, activity=None, bundle=False):
+    if use_digraph:
+      dot = Digraph(graph_attr=GRAPH_ATTR, node_attr=NODE_ATTR)
+      with phase("emit_dot"): self.emit_schematic(dot, activity, bundle)
+      return dot.source
+    stream = io.StringIO()
+    self.write_dot(stream, activity, bundle)
+    return stream.getvalue()
+
+  def write_dot(self, stream, activity=None, bundle=False):
+    with phase("emit_dot"):
+      dot = DotWriter(stream, graph_attr=GRAPH_ATTR, node_attr=NODE_ATTR)
+      self.emit_schematic(dot, activity, bundle)
+      dot.close()
+
+  def emit_schematic(self, dot: Union[Digraph, DotWriter], activity=None, bundle=False):
+    if profiler is not None: dot = profiler.counting(dot)
+    bundler = dot = BundlingDot(dot) if bundle else dot
+    if activity is not None: dot = activity.annotating(dot)
+    blocks, regs, gated_wires = [], [], []
+    for node in self.nodes.values():
+      if isinstance(node, Block): blocks.append(node)
+      elif isinstance(node, Reg): regs.append(node)
+      elif isinstance(node, Wire) and node.gate is not None: gated_wires.append(node)
+    # name every gate node before drawing, so a wire can connect to the gates of a wire drawn after it
+    self.gate_nodes = {}
+    self.gate_counts = {}
+    for wire in gated_wires: self.draw_gate_tree(NullDot(), wire)
+    self.gate_counts = {}
     if 'clk' in [i.name for i in self.inputs]:
       dot.node('invisnodeforclock', style='invis')
       dot.node('visiblenodeforclock', 'CLK', style='filled', fillcolor='lightblue')
@@ -222,13 +581,7 @@ class Schematic:
     for reg in regs: dot.node(reg.name)
     for wire in gated_wires:
       if type(wire) == Output or type(wire) == Inout: dot.node(f'outputof/{wire.name}', style='invis')
-      dot.node(f'gatelevel0/{wire.name}/{wire.gate.name}', wire.gate.name)
-      if type(wire.gate) == SingleInputGate: self.gate_level_up(dot, f'gatelevel0/{wire.name}/{wire.gate.name}', wire.gate.input, 1, wire.name)
-      elif type(wire.gate) == TSB:
-        self.gate_level_up(dot, f'gatelevel0/{wire.name}/{wire.gate.name}', wire.gate.input, 1, wire.name)
-        self.gate_level_up(dot, f'gatelevel0/{wire.name}/{wire.gate.name}', wire.gate.enable, 1, wire.name)
-      elif type(wire.gate) == MultiInputGate:
-        for gate_input in wire.gate.inputs: self.gate_level_up(dot, f'gatelevel0/{wire.name}/{wire.gate.name}', gate_input, 1, wire.name)
+      self.draw_gate_tree(dot, wire, record=False)
       if len(wire.outputs) > 1:
         dot.node(f'junctionof/{wire.name}', shape='point', width='0.01')
         dot.edge(f'gatelevel0/{wire.name}/{wire.gate.name}', f'junctionof/{wire.name}', label=wire.name, arrowhead='none')
@@ -254,6 +607,8 @@ class Schematic:
           dot.node(f'connectof/{wire.name}', shape='point', width='0.01')
           dot.edge(start_point, f'connectof/{wire.name}', label=wire.name, arrowhead='none')
           self.input_to_block(dot, f'connectof/{wire.name}', wire.outputs[0])
+      elif type(wire) == Output: dot.edge(f'gatelevel0/{wire.name}/{wire.gate.name}', f'outputof/{wire.name}', label=wire.name)
+      elif type(wire) == Inout: dot.edge(f'gatelevel0/{wire.name}/{wire.gate.name}', f'outputof/{wire.name}', label=wire.name, dir='both')
     for input in [inp for inp in self.inputs if type(inp) == Input]:
       dot.node(f'inputof/{input.name}', style='invis')
       if len(input.outputs) > 1:
@@ -267,7 +622,7 @@ class Schematic:
       elif len(input.outputs) == 1:
         if isinstance(input.outputs[0], Block) or isinstance(input.outputs[0], Reg): dot.edge(f'inputof/{input.name}', input.outputs[0].name, label=input.name)
         elif isinstance(input.outputs[0], Wire) and input.outputs[0].gate is not None:
-          for gate_node in self.gate_nodes[input.name]: dot.edge(f'inputof/{input.name}', self.gate_nodes[input.name])
+          for gate_node in self.gate_nodes[input.name]: dot.edge(f'inputof/{input.name}', gate_node, label=input.name)
         else:
           dot.node(f'connectof/{input.name}', shape='point', width='0.01')
           dot.edge(f'inputof/{input.name}', f'connectof/{input.name}', label=input.name, arrowhead='none')
@@ -275,8 +630,7 @@ class Schematic:
     for block in blocks + regs:
       for output in block.outputs:
         self.input_to_block(dot, block.name, output)
-    
-    dot.render(self.name, format='png', cleanup=True)
+    if bundle: bundler.flush()
 
 
 def strip_verilog(lines):
@@ -284,24 +638,23 @@ def strip_verilog(lines):
   in_block_comment = False
   for line in lines:
     i = 0
-    stripped_line = ""
+    pieces = []
     while i < len(line):
       if not in_block_comment:
-        if line.startswith("/*", i):
-          in_block_comment = True
-          i += 2
-          continue
-        if line.startswith("//", i) or line.startswith("`", i):
+        comment = COMMENT_START.search(line, i)
+        if comment is None:
+          pieces.append(line[i:])
           break
-        stripped_line += line[i]
-        i += 1
+        pieces.append(line[i:comment.start()])
+        if comment.group() != "/*": break
+        in_block_comment = True
+        i = comment.end()
       else:
-        if line.startswith("*/", i):
-          in_block_comment = False
-          i += 2
-        else:
-          i += 1
-    stripped_line = stripped_line.strip()
+        end = line.find("*/", i)
+        if end == -1: break
+        in_block_comment = False
+        i = end + 2
+    stripped_line = "".join(pieces).strip()
     if not stripped_line:
         continue
     parts = stripped_line.split(';')
@@ -320,22 +673,18 @@ def strip_verilog(lines):
 
 
 def get_submodule(module_name, lines):
+  if profiler is not None: profiler.counts["get_submodule_lines"] += len(lines)
   result = []
   inside_module = False
   for line in lines:
-    if line.startswith("module "):
-      name = ""
-      for char in line[7:]:
-        if char == " ": continue
-        elif char == "(": break
-        else: name += char
-      if name == module_name: inside_module = True
+    if line.startswith("module ") and module_name_of(line) == module_name: inside_module = True
     if inside_module: result.append(line)
     if "endmodule" in line and inside_module: return result
   raise ValueError(f"{module_name} module not found or not correctly instantiated.\nmodule {module_name}( must be on 1 line.")
 
 
 def get_leafs_of_keyword(submodule, keyword):
+  if profiler is not None: profiler.counts["get_leafs_of_keyword_lines"] += len(submodule)
   input_names = []
   input = ""
   for raw_line in submodule:
@@ -354,128 +703,692 @@ def get_leafs_of_keyword(submodule, keyword):
   return input_names
 
 
-def dfs_from_node(all_lines, submodule, node: Input, schematic: Schematic):
-  if not isinstance(node, Block):
-    move_down = True
-    i = 0
-    while i < len(submodule):
-      tokens = tokenize_line(submodule[i])
-
-      total_line = ""
-      j = i
-      while j < len(submodule):
-        total_line += submodule[j]
-        if submodule[j].rstrip().endswith(";"): break
-        else: total_line += " "
-        j += 1
-      big_tokens = tokenize_line(total_line)
-      
-      if "(" + node.name + ")" in submodule[i].replace(" ", "") and "." in submodule[i] and node.name != "clk" and move_down:
-        move_down = False
-        branch_i = i
-      if not move_down and "." not in tokens[0] and "(" not in tokens[0]:
-        submod_inputs = get_leafs_of_keyword(get_submodule(tokens[0], all_lines), "input") + get_leafs_of_keyword(get_submodule(tokens[0], all_lines), "inout")
-        clk = "clk" in submod_inputs
+DECLARATION_KEYWORDS = ["input", "output", "inout", "wire", "reg"]
+PORT_CONNECTION = re.compile(r"\(([^()]*)\)")
+NET_NODE_TYPES = {"wire": Wire, "inout": Inout, "output": Output}
+# order in which a net's kind is decided when it is declared more than once
+NET_KIND_PRIORITY = ["wire", "inout", "output", "input", "reg"]
+
+
+@dataclass
+class FanoutIndex:
+  line_tokens: List[List[str]] = field(default_factory=list)
+  # net name -> indices of the lines that read it
+  readers: Dict[str, List[int]] = field(default_factory=dict)
+  # line index -> (tokens, text) of the wire/assign/<= statement starting on that line
+  statements: Dict[int, tuple] = field(default_factory=dict)
+  # line index -> index of the instance header line above it
+  headers: Dict[int, int] = field(default_factory=dict)
+  instance_starts: Dict[str, List[int]] = field(default_factory=dict)
+  lines: List[str] = field(default_factory=list, repr=False)
+
+  def add_reader(self, net_name, i):
+    readers = self.readers.setdefault(net_name, [])
+    if not readers or readers[-1] != i: readers.append(i)
+
+  def instance_lines(self, instance_name):
+    result = []
+    for start in self.instance_starts.get(instance_name, []):
+      if result and start <= result[-1]: continue
+      i = start
+      while i < len(self.lines):
+        result.append(i)
+        if self.lines[i].rstrip().endswith(");"): break
+        i += 1
+    return result
+
+
+def build_fanout_index(lines):
+  fanout = FanoutIndex(lines=lines)
+  header = 0
+  for i, line in enumerate(lines):
+    tokens = tokenize_line(line)
+    fanout.line_tokens.append(tokens)
+    if "." not in tokens[0] and "(" not in tokens[0]: header = i
+    fanout.headers[i] = header
+    if len(tokens) > 1: fanout.instance_starts.setdefault(tokens[1].replace("(", ""), []).append(i)
+
+    if "." in line:
+      for net_name in PORT_CONNECTION.findall(line.replace(" ", "")): fanout.add_reader(net_name, i)
+
+    total_line = ""
+    j = i
+    while j < len(lines):
+      total_line += lines[j]
+      if lines[j].rstrip().endswith(";"): break
+      else: total_line += " "
+      j += 1
+    big_tokens = tokenize_line(total_line)
+    if len(big_tokens) > 3 and big_tokens[2] == "=" and (big_tokens[0] == "wire" or big_tokens[0] == "assign" or big_tokens[1] == "<"):
+      fanout.statements[i] = (big_tokens, total_line)
+      for t in big_tokens[3:]: fanout.add_reader(t.replace("(", "").replace(")", "").replace("~", ""), i)
+  return fanout
+
+
+@dataclass
+class Module:
+  name: str
+  lines: List[str] = field(default_factory=list)
+  ports: List[str] = field(default_factory=list)
+  declarations: Dict[str, List[str]] = field(default_factory=dict)
+  net_kinds: Dict[str, str] = field(default_factory=dict)
+  declared: Dict[str, set] = field(default_factory=dict, repr=False)
+  fanout_index: FanoutIndex = field(default=None, repr=False)
+
+  def to_dict(self):
+    return {"name": self.name, "lines": self.lines, "ports": self.ports, "declarations": self.declarations, "net_kinds": self.net_kinds}
+
+  @classmethod
+  def from_dict(cls, data):
+    module = cls(**data)
+    module.declared = {keyword: set(names) for keyword, names in module.declarations.items()}
+    return module
+
+  def leafs(self, keyword):
+    return self.declarations.get(keyword, [])
+
+  def fanout(self):
+    if self.fanout_index is None:
+      with phase("fanout_index"): self.fanout_index = build_fanout_index(self.lines)
+    return self.fanout_index
+
+  def is_declared(self, name, keyword):
+    return name in self.declared[keyword]
+
+  def index(self):
+    for keyword in DECLARATION_KEYWORDS: self.declarations[keyword] = get_leafs_of_keyword(self.lines, keyword)
+    self.declared = {keyword: set(names) for keyword, names in self.declarations.items()}
+    for keyword in NET_KIND_PRIORITY:
+      for name in self.declarations[keyword]: self.net_kinds.setdefault(name, keyword)
+    header = ""
+    for line in self.lines:
+      header += line
+      if line.rstrip().endswith(";"): break
+      header += " "
+    port_list = header.partition("(")[2].rpartition(")")[0]
+    self.ports = [port.strip() for port in port_list.split(",") if port.strip()]
+    return self
+
+
+def module_name_of(line):
+  name = ""
+  for char in line[7:]:
+    if char == " ": continue
+    elif char == "(": break
+    else: name += char
+  return name
+
+
+def build_module_table(lines):
+  if profiler is not None: profiler.counts["module_table_lines"] += len(lines)
+  modules: Dict[str, Module] = {}
+  current = None
+  for line in lines:
+    if line.startswith("module "):
+      current = Module(name=module_name_of(line))
+      if current.name in modules: current = None # first definition wins, like get_submodule
+    if current is not None:
+      current.lines.append(line)
+      if "endmodule" in line:
+        modules[current.name] = current.index()
+        current = None
+  return modules
+
+
+def get_module(modules, module_name):
+  if profiler is not None: profiler.counts["module_lookups"] += 1
+  if module_name not in modules: raise ValueError(f"{module_name} module not found or not correctly instantiated.\nmodule {module_name}( must be on 1 line.")
+  return modules[module_name]
+
+
+def connected_port(line, net_name):
+  port_name = ""
+  in_name = ""
+  reading_chars_port = False
+  reading_chars_in = False
+  for char in line:
+    if char == ".": reading_chars_port = True
+    elif reading_chars_port and char != "(": port_name += char
+    elif reading_chars_port:
+      reading_chars_port = False
+      reading_chars_in = True
+      continue
+    if reading_chars_in and char != ")": in_name += char
+    elif reading_chars_in:
+      if in_name == net_name: break
+      else:
         port_name = ""
         in_name = ""
-        reading_chars_port = False
         reading_chars_in = False
-        for char in submodule[branch_i]:
-          if char == ".": reading_chars_port = True
-          elif reading_chars_port and char != "(": port_name += char
-          elif reading_chars_port:
-            reading_chars_port = False
-            reading_chars_in = True
-            continue
-          if reading_chars_in and char != ")": in_name += char
-          elif reading_chars_in:
-            if in_name == node.name: break
-            else:
-              port_name = ""
-              in_name = ""
-              reading_chars_in = False
-        if port_name in submod_inputs: schematic.node_visited[tokens[1].replace("(", "")] = schematic.connect(node, tokens[1].replace("(", ""), Block, clk=clk, module_name=tokens[0])
-        move_down = True
-        i = branch_i
-      elif node.name in [t.replace("(", "").replace(")", "").replace("~", "") for t in big_tokens[3:]] and big_tokens[2] == "=" and big_tokens[0] == "wire": schematic.node_visited[big_tokens[1]] = schematic.connect(node, big_tokens[1], Wire)
-      elif node.name in [t.replace("(", "").replace(")", "").replace("~", "") for t in big_tokens[3:]] and big_tokens[2] == "=" and big_tokens[0] == "assign":
-        if big_tokens[1] in get_leafs_of_keyword(submodule, "wire"): schematic.node_visited[big_tokens[1]] = schematic.connect(node, big_tokens[1], Wire, line=total_line)
-        elif big_tokens[1] in get_leafs_of_keyword(submodule, "inout"): schematic.node_visited[big_tokens[1]] = schematic.connect(node, big_tokens[1], Inout, line=total_line)
-        elif big_tokens[1] in get_leafs_of_keyword(submodule, "output"): schematic.node_visited[big_tokens[1]] = schematic.connect(node, big_tokens[1], Output, line=total_line)
-      elif node.name in [t.replace("(", "").replace(")", "").replace("~", "") for t in big_tokens[3:]] and big_tokens[2] == "=" and big_tokens[1] == "<":
-        if big_tokens[0] in get_leafs_of_keyword(submodule, "reg"): schematic.node_visited[big_tokens[0]] = schematic.connect(node, big_tokens[0], Reg, line=total_line)
-      if move_down: i += 1
-      else: i -= 1
+  return port_name
+
+
+def connect_readers(modules: Dict[str, Module], module: Module, node: Input, schematic: Schematic):
+  submodule = module.lines
+  fanout = module.fanout()
+  if profiler is not None: profiler.counts["dfs_visits"] += 1
+  if not isinstance(node, Block):
+    # only the statements that read this net are visited, in line order
+    if profiler is not None: profiler.counts["reader_lines"] += len(fanout.readers.get(node.name, []))
+    for i in fanout.readers.get(node.name, []):
+      if "(" + node.name + ")" in submodule[i].replace(" ", "") and "." in submodule[i] and node.name != "clk":
+        tokens = fanout.line_tokens[fanout.headers[i]]
+        instanced = get_module(modules, tokens[0])
+        submod_inputs = instanced.leafs("input") + instanced.leafs("inout")
+        clk = "clk" in submod_inputs
+        if connected_port(submodule[i], node.name) in submod_inputs: schematic.connect(node, tokens[1].replace("(", ""), Block, clk=clk, module_name=tokens[0])
+      elif i in fanout.statements:
+        big_tokens, total_line = fanout.statements[i]
+        if big_tokens[0] == "wire": schematic.connect(node, big_tokens[1], Wire)
+        elif big_tokens[0] == "assign":
+          net_kind = module.net_kinds.get(big_tokens[1])
+          if net_kind in NET_NODE_TYPES: schematic.connect(node, big_tokens[1], NET_NODE_TYPES[net_kind], line=total_line, tokens=big_tokens)
+        elif big_tokens[1] == "<":
+          if module.is_declared(big_tokens[0], "reg"): schematic.connect(node, big_tokens[0], Reg, line=total_line, tokens=big_tokens)
   else: # Block case
-    for block_output in (get_leafs_of_keyword(get_submodule(node.module_name, all_lines), "output") + get_leafs_of_keyword(get_submodule(node.module_name, all_lines), "inout")):
-      search_for_output = False
-      for line in submodule:
-        if len(tokenize_line(line)) > 1 and tokenize_line(line)[1].replace("(", "") == node.name: search_for_output = True
-
-        if search_for_output:
-          search_for_num = False
-          num_in = ""
-          for idx, char in enumerate(line.replace(" ", "")):
-            if char == '(' and line.replace(" ", "")[idx+1].isdigit():
-              search_for_num = True
-              continue
-            if search_for_num and char != ')': num_in += char
-            elif search_for_num:
-              search_for_num = False
-              node.input_nums.append(num_in)
-              num_in = ""
-
-        if search_for_output and "." + block_output + "(" in line:
-          for token in tokenize_line(line):
+    instance_lines = fanout.instance_lines(node.name)
+    instanced = get_module(modules, node.module_name)
+    for block_output in (instanced.leafs("output") + instanced.leafs("inout")):
+      for i in instance_lines:
+        line = submodule[i]
+        search_for_num = False
+        num_in = ""
+        packed_line = line.replace(" ", "")
+        for idx, char in enumerate(packed_line):
+          if char == '(' and idx + 1 < len(packed_line) and packed_line[idx+1].isdigit():
+            search_for_num = True
+            continue
+          if search_for_num and char != ')': num_in += char
+          elif search_for_num:
+            search_for_num = False
+            node.input_nums.append(num_in)
+            num_in = ""
+
+        if "." + block_output + "(" in line:
+          for token in fanout.line_tokens[i]:
             if token.startswith(block_output + "("):
               output_name = ""
               for char in token[len(block_output)+1:]:
                 if char == ")": break
                 output_name += char
-              if output_name in get_leafs_of_keyword(submodule, "wire"): schematic.node_visited[output_name] = schematic.connect(node, output_name, Wire)
-              elif output_name in get_leafs_of_keyword(submodule, "inout"): schematic.node_visited[output_name] = schematic.connect(node, output_name, Inout)
-              elif output_name in get_leafs_of_keyword(submodule, "output"): schematic.node_visited[output_name] = schematic.connect(node, output_name, Output)
-        if search_for_output and line.rstrip().endswith(");"): search_for_output = False
-  
-  for dest in node.outputs:
-    if isinstance(dest, Input) and not schematic.node_visited[dest.name]: dfs_from_node(all_lines, submodule, dest, schematic)
+              net_kind = module.net_kinds.get(output_name)
+              if net_kind in NET_NODE_TYPES: schematic.connect(node, output_name, NET_NODE_TYPES[net_kind])
+
+
+def dfs_from_node(modules: Dict[str, Module], module: Module, node: Input, schematic: Schematic):
+  connect_readers(modules, module, node, schematic)
+  # explicit stack of (node, index of the next output to follow)
+  stack = [[node, 0]]
+  while stack:
+    frame = stack[-1]
+    node, idx = frame
+    if idx == len(node.outputs):
+      stack.pop()
+      continue
+    frame[1] += 1
+    dest = node.outputs[idx]
+    if isinstance(dest, Input) and not schematic.visited(dest.name):
+      connect_readers(modules, module, dest, schematic)
+      stack.append([dest, 0])
+
+
+INSTANCE_PORT = re.compile(r"\.([^.()]+)\(([^()]*)\)")
+
+
+def instance_ports(module: Module, instance_name):
+  # (port, net) pairs of the .port(net) connections of an instance
+  fanout = module.fanout()
+  packed_lines = "".join(module.lines[i] for i in fanout.instance_lines(instance_name)).replace(" ", "")
+  return INSTANCE_PORT.findall(packed_lines)
+
+
+def rename_gate(gate: Union[str, Gate], names: Dict[str, str]):
+  # copy of a gate tree with its leaves renamed; parsed gates are shared through the parser cache so they are never changed in place
+  if not isinstance(gate, Gate): return names.get(gate, gate)
+  root = replace(gate)
+  work = [root]
+  while work:
+    item = work.pop()
+    if type(item) == MultiInputGate:
+      item.inputs = [replace(i) if isinstance(i, Gate) else names.get(i, i) for i in item.inputs]
+      children = item.inputs
+    else:
+      item.input = replace(item.input) if isinstance(item.input, Gate) else names.get(item.input, item.input)
+      children = [item.input]
+      if type(item) == TSB:
+        item.enable = replace(item.enable) if isinstance(item.enable, Gate) else names.get(item.enable, item.enable)
+        children.append(item.enable)
+    work.extend(child for child in children if isinstance(child, Gate))
+  return root
+
+
+def node_fields(node: Node):
+  # the fields of a node as keyword arguments, to copy it; nodes are slotted and have no __dict__
+  return {node_field.name: getattr(node, node_field.name) for node_field in fields(node)}
+
 
+def instantiate(template: Schematic, prefix):
+  # fresh copies of a module's nodes named <instance>/<net>, with its ports turned into plain wires of the parent
+  names = {name: f"{prefix}/{name}" for name in template.nodes}
+  copies: Dict[str, Node] = {}
+  for name, node in template.nodes.items():
+    node_type = Wire if type(node) in (Input, Output, Inout) else type(node)
+    node_data = {**node_fields(node), "name": names[name], "outputs": []}
+    if isinstance(node, Wire) and node.gate is not None: node_data["gate"] = rename_gate(node.gate, names)
+    if isinstance(node, Block): node_data["input_nums"] = list(node.input_nums)
+    copies[name] = node_type(**node_data)
+  for name, node in template.nodes.items(): copies[name].outputs = [copies[output.name] for output in node.outputs]
+  return copies
 
-def generate_schematic(module_name):
-  schematic = Schematic(module_name)
-  all_lines = []
 
+def elaborate_schematic(modules: Dict[str, Module], module: Module, schematic: Schematic, depth, templates):
+  # replaces each instance with a copy of its module's schematic. A module is traversed once per depth
+  # and every instance of it, including an instance array like reg_cell regcell[30:0], reuses that template
+  if depth <= 0: return schematic
+  expanded = {}
+  for node in schematic.nodes.values():
+    if not isinstance(node, Block): continue
+    key = (node.module_name, depth - 1)
+    if key not in templates: templates[key] = build_schematic(modules, node.module_name, depth - 1, templates)
+    expanded[node.name] = (node, instantiate(templates[key], node.name), instance_ports(module, node.name), get_module(modules, node.module_name))
+  if not expanded: return schematic
+
+  nodes: Dict[str, Node] = {}
+  for name, node in schematic.nodes.items():
+    if name in expanded: nodes.update((copy.name, copy) for copy in expanded[name][1].values())
+    else: nodes[name] = node
+  # a net that fed an instance now feeds the input ports it is connected to
+  for node in nodes.values():
+    outputs = []
+    for output in node.outputs:
+      if output.name in expanded and output is expanded[output.name][0]:
+        block, copies, ports, instanced = expanded[output.name]
+        outputs += [copies[port] for port, net in ports if net == node.name and port in copies and instanced.net_kinds.get(port) in ("input", "inout")]
+      else: outputs.append(output)
+    node.outputs = outputs
+  for block, copies, ports, instanced in expanded.values():
+    driven = {output.name for output in block.outputs}
+    for port, net in ports:
+      # a port on a bit or range of a bus, like .Aselect(Aselect[30:0]), connects to the whole bus
+      net = net.split("[")[0]
+      if port not in copies or net not in nodes: continue
+      port_kind = instanced.net_kinds.get(port)
+      # output ports drive their nets; input ports the search never connected, like clk, are connected here
+      if port_kind == "output" or (port_kind == "inout" and net in driven): copies[port].outputs.append(nodes[net])
+      elif port_kind in ("input", "inout") and all(output is not copies[port] for output in nodes[net].outputs): nodes[net].outputs.append(copies[port])
+  schematic.nodes = nodes
+  return schematic
+
+
+def read_file_list(path="files.txt"):
   try:
-    with open("files.txt", "r") as f:
-      verilog_files = [line.strip() for line in f if line.strip()]
+    with open(path, "r") as f:
+      # listed files are relative to the directory of the list
+      return [os.path.join(os.path.dirname(path), line.strip()) for line in f if line.strip()]
   except FileNotFoundError:
-    print("Error: files.txt not found.")
-    sys.exit(1)
+    raise FileNotFoundError(f"{path} not found.") from None
+
+
+def read_sources(verilog_files):
+  sources = []
   for vfile in verilog_files:
     try:
-      with open(vfile, "r") as f:
-        cleaned_lines = strip_verilog(f)
-        for line in cleaned_lines:
-          all_lines.append(line)
+      with phase("read_sources"), open(vfile, "rb") as f: sources.append((vfile, f.read()))
     except FileNotFoundError:
-      print(f"Error: listed file '{vfile}' does not exist.")
-      sys.exit(1)
-  
-  top_module = get_submodule(module_name, all_lines)
-  
+      raise FileNotFoundError(f"listed file '{vfile}' does not exist.") from None
+  return sources
+
+
+def load_modules(sources, cache: SchematicCache = None):
+  modules: Dict[str, Module] = {}
+  for vfile, data in sources:
+    file_hash = content_hash(data)
+    cached = None
+    if cache is not None:
+      with phase("cache"): cached = cache.load_modules(file_hash)
+    if cached is not None: file_modules = {name: Module.from_dict(module_data) for name, module_data in cached.items()}
+    else:
+      with phase("strip_verilog"): stripped = strip_verilog(io.StringIO(data.decode(), newline=None))
+      with phase("module_table"): file_modules = build_module_table(stripped)
+      if cache is not None:
+        with phase("cache"): cache.save_modules(file_hash, {name: module.to_dict() for name, module in file_modules.items()})
+    # the first definition of a module wins, like get_submodule
+    for name, module in file_modules.items(): modules.setdefault(name, module)
+  return modules
+
+
+MODULE_BOUNDARY = re.compile(rb"/\*|\*/|//|`|endmodule|module ")
+
+
+def module_spans(data):
+  # (start, end) byte offsets of each module in a source, from its module keyword to the end of its endmodule
+  # line, skipping comments the way strip_verilog does but without stripping anything
+  spans = []
+  in_block_comment = False
+  skip_to = 0
+  code_start = 0
+  start = None
+  for match in MODULE_BOUNDARY.finditer(data):
+    if match.start() < skip_to: continue
+    token = match.group()
+    if in_block_comment:
+      if token == b"*/":
+        in_block_comment = False
+        code_start = match.end()
+    elif token == b"/*": in_block_comment = True
+    elif token == b"//" or token == b"`":
+      # the rest of the line is a comment
+      skip_to = data.find(b"\n", match.end())
+      if skip_to == -1: break
+    elif token == b"module ":
+      # only at the start of a line, after any comment that ends on it, like build_module_table's startswith
+      line_start = max(data.rfind(b"\n", 0, match.start()) + 1, code_start)
+      if not data[line_start:match.start()].strip(): start = match.start()
+    elif token == b"endmodule" and start is not None:
+      end = data.find(b"\n", match.end())
+      spans.append((start, len(data) if end == -1 else end + 1))
+      start = None
+  return spans
+
+
+def named_module_spans(data):
+  # (name, start, end) of each module_spans span, named from its stripped module line
+  result = []
+  for start, end in module_spans(data):
+    line_end = data.find(b"\n", start, end)
+    header = strip_verilog([data[start:end if line_end == -1 else line_end].decode()])
+    result.append((module_name_of(header[0]), start, end))
+  return result
+
+
+class LazyModules(Mapping):
+  # the modules of the listed files by name, like load_modules, but each file is memory-mapped and only the
+  # module boundaries are found up front. A module is stripped and indexed the first time it is looked up,
+  # so modules the traversal from the top never reaches are never parsed or kept in memory. texts are
+  # Verilog source strings read after the files
+  def __init__(self, verilog_files, cache: SchematicCache = None, texts=()):
+    self.cache = cache
+    self.sources = []
+    self.file_hashes = []
+    # (name, start, end) of the modules in each source
+    self.file_spans: List[List[tuple]] = []
+    self.loaded: Dict[str, Module] = {}
+    for data in self.open_sources(verilog_files, texts):
+      with phase("scan_sources"):
+        self.file_hashes.append(content_hash(data))
+        self.file_spans.append(named_module_spans(data))
+      self.sources.append(data)
+    self.index_spans()
+
+  def index_spans(self):
+    # module name -> (index of its source, start, end); the first definition wins, like load_modules
+    self.spans: Dict[str, tuple] = {}
+    for source, file_spans in enumerate(self.file_spans):
+      for name, start, end in file_spans: self.spans.setdefault(name, (source, start, end))
+
+  def open_sources(self, verilog_files, texts):
+    for vfile in verilog_files:
+      try:
+        with phase("read_sources"), open(vfile, "rb") as f: data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+      except FileNotFoundError:
+        raise FileNotFoundError(f"listed file '{vfile}' does not exist.") from None
+      yield data
+    for text in texts: yield text.encode()
+
+  def __getitem__(self, name):
+    if name not in self.loaded:
+      source, start, end = self.spans[name]
+      module_key = content_hash(self.file_hashes[source], name)
+      cached = None
+      if self.cache is not None:
+        with phase("cache"): cached = self.cache.load_modules(module_key)
+      if cached is not None: module = Module.from_dict(cached[name])
+      else:
+        if profiler is not None: profiler.counts["modules_parsed"] += 1
+        with phase("strip_verilog"): stripped = strip_verilog(io.StringIO(self.sources[source][start:end].decode(), newline=None))
+        with phase("module_table"): module = build_module_table(stripped)[name]
+        if self.cache is not None:
+          with phase("cache"): self.cache.save_modules(module_key, {name: module.to_dict()})
+      self.loaded[name] = module
+    return self.loaded[name]
+
+  def __contains__(self, name):
+    return name in self.spans
+
+  def __iter__(self):
+    return iter(self.spans)
+
+  def __len__(self):
+    return len(self.spans)
+
+  def reachable(self, module_names):
+    # the named modules and every module instantiated below them, loading only those
+    found = {}
+    work = list(module_names)
+    while work:
+      name = work.pop()
+      if name in found or name not in self.spans: continue
+      found[name] = self[name]
+      for line in self[name].lines[1:]:
+        first_token = TOKEN.match(line)
+        if first_token is not None and first_token.group() in self.spans: work.append(first_token.group())
+    return list(found)
+
+
+def search_schematic(modules, top_module: Module, schematic: Schematic):
   # get the inputs
-  for leaf in get_leafs_of_keyword(top_module, "input"): schematic.add_input(Input(name=leaf))
-  for leaf in get_leafs_of_keyword(top_module, "inout"): schematic.add_input(Inout(name=leaf))
+  for leaf in top_module.leafs("input"): schematic.add_input(Input(name=leaf))
+  for leaf in top_module.leafs("inout"): schematic.add_input(Inout(name=leaf))
   # search from all inputs
-  for input in schematic.inputs: dfs_from_node(all_lines, top_module, input, schematic)
-  for node in schematic.nodes.values():
-    if isinstance(node, Block): print(node.module_name, node.name, [o.name for o in node.outputs], node.input_nums)
-    elif isinstance(node, Wire): print(node.name, [o.name for o in node.outputs], node.gate)
-    else: print(node.name, [o.name for o in node.outputs])
-  
-  schematic.draw_schematic()
+  with phase("dfs"):
+    for input in schematic.inputs: dfs_from_node(modules, top_module, input, schematic)
+  return schematic
+
+
+def build_schematic(modules, module_name, depth=0, templates=None, compact=False):
+  # with compact, the DFS and elaboration fill a SchematicGraph directly and no node objects are kept
+  if compact:
+    from schematic_graph import build_graph
+    return build_graph(modules, module_name, depth, templates)
+  top_module = get_module(modules, module_name)
+  schematic = search_schematic(modules, top_module, Schematic(module_name))
+  with phase("elaborate"): return elaborate_schematic(modules, top_module, schematic, depth, templates if templates is not None else {})
+
+
+def extract_schematic(modules, module_name, depth=0, verbose=False):
+  # build_schematic with the debug dump of every node printed when verbose
+  schematic = build_schematic(modules, module_name, depth)
+  if not verbose: return schematic
+  with phase("debug_dump"):
+    for node in schematic.nodes.values():
+      if isinstance(node, Block): print(node.module_name, node.name, [o.name for o in node.outputs], node.input_nums)
+      elif isinstance(node, Wire): print(node.name, [o.name for o in node.outputs], node.gate)
+      else: print(node.name, [o.name for o in node.outputs])
+  return schematic
+
+
+def render_dot(dot_text, name, cache: SchematicCache = None, format="png"):
+  # skips Graphviz when the same DOT text was already rendered to this output
+  output_path = f"{name}.{format}"
+  dot_hash = content_hash(dot_text)
+  if cache is not None and cache.render_up_to_date(output_path, dot_hash): return
+  if format == "dot":
+    with open(output_path, "w") as f: f.write(dot_text)
+  else:
+    with open(name, "w") as f: f.write(dot_text)
+    with phase("render"): render('dot', format, name)
+    os.remove(name)
+  if cache is not None: cache.record_render(output_path, dot_hash)
+
+
+def extract_netlist(module_name, files=(), texts=(), file_list=None, depth=0, cache_dir=None, compact=False):
+  # library entry point: the schematic of module_name read from Verilog files, the files in a files.txt-style
+  # list, and Verilog source strings, without printing, rendering or writing anything but the cache. With
+  # compact, a SchematicGraph built without node objects. A missing module raises ValueError and a missing file FileNotFoundError
+  verilog_files = list(files) + (read_file_list(file_list) if file_list is not None else [])
+  cache = SchematicCache(cache_dir, salt=generator_salt()) if cache_dir is not None else None
+  return build_schematic(LazyModules(verilog_files, cache, texts), module_name, depth, compact=compact)
+
+
+def generate_schematic(module_name, use_digraph=False, cache_dir=None, file_list="files.txt", format="png", partition=None, jobs=None, depth=0, verbose=False, bundle=False, cone=None, cone_depth=None, cone_direction="both"):
+  cache = SchematicCache(cache_dir, salt=generator_salt()) if cache_dir is not None else None
+  modules = LazyModules(read_file_list(file_list), cache)
+  if format in NETLIST_FORMATS:
+    from schematic_export import write_netlist
+    schematic = extract_schematic(modules, module_name, depth, verbose)
+    with phase("export"): write_netlist(schematic, f"{module_name}.{format}", format)
+  elif partition is not None:
+    from schematic_partition import render_partitioned
+    schematic = extract_schematic(modules, module_name, depth, verbose)
+    with phase("partition"): render_partitioned(schematic, partition, format=format, jobs=jobs, cache=cache, bundle=bundle)
+  elif cone is not None:
+    # only the logic around the cone nets is laid out, into [module_name].cone.[format]
+    from schematic_partition import extract_cone
+    schematic = extract_schematic(modules, module_name, depth, verbose)
+    with phase("cone"): cone_schematic = extract_cone(schematic, cone, cone_depth, cone_direction)
+    render_dot(cone_schematic.dot_source(use_digraph=use_digraph, bundle=bundle), cone_schematic.name, cache, format=format)
+  elif cache is None:
+    schematic = extract_schematic(modules, module_name, depth, verbose)
+    schematic.draw_schematic(use_digraph=use_digraph, format=format, bundle=bundle)
+  else:
+    dot_key = cache.dot_key(module_name, modules.file_hashes, depth, bundle)
+    # a verbose run extracts the schematic even when its DOT text is cached, for the node dump
+    dot_text = None
+    if not verbose:
+      with phase("cache"): dot_text = cache.load_dot(dot_key)
+    if dot_text is None:
+      schematic = extract_schematic(modules, module_name, depth, verbose)
+      dot_text = schematic.dot_source(use_digraph=use_digraph, bundle=bundle)
+      with phase("cache"): cache.save_dot(dot_key, dot_text)
+    render_dot(dot_text, module_name, cache, format=format)
+
+
+# set once in each batch worker by init_batch_worker
+batch_state = {}
+
+
+def init_batch_worker(modules_data, options, cache_dir, file_hashes):
+  batch_state["modules"] = {name: Module.from_dict(module_data) for name, module_data in modules_data.items()}
+  batch_state["options"] = options
+  batch_state["cache"] = SchematicCache(cache_dir, salt=generator_salt()) if cache_dir is not None else None
+  batch_state["file_hashes"] = file_hashes
+
+
+def run_batch_task(module_name):
+  # the debug dump is captured so the output of parallel workers doesn't interleave. With --profile, a worker
+  # process profiles each task on its own and hands back the report to be merged
+  output = io.StringIO()
+  options = batch_state["options"]
+  cache = batch_state["cache"]
+  task_profiler = Profiler() if options["profile"] else None
+  error = None
+  try:
+    with contextlib.redirect_stdout(output), (profiling(task_profiler) if task_profiler is not None else contextlib.nullcontext()):
+      if options["format"] in NETLIST_FORMATS:
+        from schematic_export import write_netlist
+        schematic = extract_schematic(batch_state["modules"], module_name, options["depth"], options["verbose"])
+        with phase("export"): write_netlist(schematic, f"{module_name}.{options['format']}", options["format"])
+      elif options["partition"] is not None:
+        from schematic_partition import render_partitioned
+        schematic = extract_schematic(batch_state["modules"], module_name, options["depth"], options["verbose"])
+        with phase("partition"): render_partitioned(schematic, options["partition"], format=options["format"], jobs=1, cache=cache, bundle=options["bundle"])
+      else:
+        dot_key = dot_text = None
+        if cache is not None:
+          dot_key = cache.dot_key(module_name, batch_state["file_hashes"], options["depth"], options["bundle"])
+          if not options["verbose"]:
+            with phase("cache"): dot_text = cache.load_dot(dot_key)
+        if dot_text is None:
+          dot_text = extract_schematic(batch_state["modules"], module_name, options["depth"], options["verbose"]).dot_source(use_digraph=options["use_digraph"], bundle=options["bundle"])
+          if cache is not None:
+            with phase("cache"): cache.save_dot(dot_key, dot_text)
+        render_dot(dot_text, module_name, cache, format=options["format"])
+  except Exception as e:
+    error = f"{type(e).__name__}: {e}"
+  return module_name, output.getvalue(), error, task_profiler.report() if task_profiler is not None else None
+
+
+def generate_schematics(module_names=None, jobs=None, use_digraph=False, cache_dir=None, file_list="files.txt", format="png", partition=None, depth=0, verbose=False, bundle=False):
+  # parses the sources once, then extracts and renders every top module on a pool of worker processes
+  cache = SchematicCache(cache_dir, salt=generator_salt()) if cache_dir is not None else None
+  modules = LazyModules(read_file_list(file_list), cache)
+  if module_names is None: module_names = list(modules.keys())
+  # a batch run in this process is profiled by the profiler already running
+  options = {"use_digraph": use_digraph, "format": format, "partition": partition, "depth": depth, "verbose": verbose, "bundle": bundle, "profile": profiler is not None and jobs != 1}
+  # workers only get the modules the requested tops can reach
+  initargs = ({name: modules[name].to_dict() for name in modules.reachable(module_names)}, options, cache_dir, modules.file_hashes)
+
+  if jobs == 1:
+    init_batch_worker(*initargs)
+    results = map(run_batch_task, module_names)
+  else:
+    pool = ProcessPoolExecutor(max_workers=jobs, initializer=init_batch_worker, initargs=initargs)
+    results = pool.map(run_batch_task, module_names)
+  failed = []
+  for module_name, output, error, profile_report in results:
+    print(output, end="")
+    if profile_report is not None: profiler.merge(profile_report)
+    if error is not None:
+      print(f"Error: {module_name}: {error}")
+      failed.append(module_name)
+  if jobs != 1: pool.shutdown()
+  return failed
+
+
+def write_profile(run_profiler: Profiler, path):
+  # the summary goes to stderr so it doesn't mix with the debug dump
+  with open(path, "w") as f: json.dump(run_profiler.report(), f, indent=2)
+  if run_profiler.cprofile is not None: run_profiler.cprofile.dump_stats(f"{os.path.splitext(path)[0]}.prof")
+  print(run_profiler.summary(), file=sys.stderr)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Generate a schematic from a Verilog top module.")
+  parser.add_argument("modules", nargs="*", metavar="module", help="name of the top module; give several to generate them in one batch")
+  parser.add_argument("--all", action="store_true", help="generate a schematic for every module in the listed files")
+  parser.add_argument("--jobs", type=int, default=None, help="number of worker processes for a batch, or Graphviz processes for a partitioned schematic (default: one per CPU)")
+  parser.add_argument("--file-list", default="files.txt", help="file listing the Verilog sources (default: files.txt)")
+  parser.add_argument("--format", choices=["png", "svg", "dot"] + NETLIST_FORMATS, default="png", help="output format; dot writes the DOT file without running Graphviz, jsonl and netlist write the extracted netlist as JSON Lines or binary (default: png)")
+  parser.add_argument("--partition", choices=["stage", "module"], default=None, help="split the schematic into pipeline stages or per-instance clusters, each laid out separately, plus an overview linking them")
+  parser.add_argument("--depth", type=int, default=0, help="expand module instances into their own logic this many levels down (default: 0, every instance is a block)")
+  parser.add_argument("--cone", nargs="+", metavar="NET", help="draw only the logic driving or driven by these nets, to [top-module-name].cone.[format]")
+  parser.add_argument("--cone-depth", type=int, default=None, help="keep the nodes at most this many edges from a --cone net (default: no limit)")
+  parser.add_argument("--cone-direction", choices=["forward", "backward", "both"], default="both", help="follow the --cone nets forward to the logic they drive, backward to the logic driving them, or both (default: both)")
+  parser.add_argument("--digraph", action="store_true", help="build the whole graphviz.Digraph in memory instead of streaming the DOT file")
+  parser.add_argument("--bundle", action="store_true", help="merge the edges between the same two nodes into one bus edge and drop connect points with a single fanout")
+  parser.add_argument("--cache-dir", default=".schematic_cache", help="directory for parsed modules and DOT output keyed by file content (default: .schematic_cache)")
+  parser.add_argument("--no-cache", action="store_true", help="parse, traverse and render from scratch without reading or writing the cache")
+  parser.add_argument("--watch", action="store_true", help="keep running and update the output of the top module each time a listed file is saved")
+  parser.add_argument("--interval", type=float, default=0.5, help="seconds between checks of the listed files with --watch (default: 0.5)")
+  parser.add_argument("--verbose", action="store_true", help="print every extracted node before rendering")
+  parser.add_argument("--profile", nargs="?", const="counters", choices=CAPTURES, default=None, help="time each phase and count the work done in it; add cprofile or tracemalloc to also capture function timings or allocations")
+  parser.add_argument("--profile-output", default="schematic_profile.json", help="JSON file for the --profile report (default: schematic_profile.json)")
+  args = parser.parse_args(argv)
+  if not args.modules and not args.all: parser.error("give a top module name or --all")
+  if args.partition and args.format in NETLIST_FORMATS: parser.error(f"--format {args.format} writes the whole netlist, so it can't be used with --partition")
+  if args.cone and (len(args.modules) != 1 or args.all or args.partition or args.watch or args.format in NETLIST_FORMATS): parser.error("--cone takes one top module and a drawing format, without --partition or --watch")
+  cache_dir = None if args.no_cache else args.cache_dir
+  if args.watch:
+    if len(args.modules) != 1 or args.all or args.partition: parser.error("--watch takes one top module and no --partition")
+    from schematic_watch import SchematicWatcher
+    try: SchematicWatcher(args.modules[0], file_list=args.file_list, depth=args.depth, format=args.format, use_digraph=args.digraph, cache_dir=cache_dir, bundle=args.bundle).run(args.interval)
+    except FileNotFoundError as e:
+      print(f"Error: {e}")
+      sys.exit(1)
+    return
+  failed = False
+  with (profiling(Profiler(args.profile)) if args.profile else contextlib.nullcontext()) as run_profiler:
+    try:
+      if len(args.modules) == 1 and not args.all: generate_schematic(args.modules[0], use_digraph=args.digraph, cache_dir=cache_dir, file_list=args.file_list, format=args.format, partition=args.partition, jobs=args.jobs, depth=args.depth, verbose=args.verbose, bundle=args.bundle, cone=args.cone, cone_depth=args.cone_depth, cone_direction=args.cone_direction)
+      else: failed = bool(generate_schematics(None if args.all else args.modules, jobs=args.jobs, use_digraph=args.digraph, cache_dir=cache_dir, file_list=args.file_list, format=args.format, partition=args.partition, depth=args.depth, verbose=args.verbose, bundle=args.bundle))
+    except FileNotFoundError as e:
+      print(f"Error: {e}")
+      sys.exit(1)
+  if run_profiler is not None: write_profile(run_profiler, args.profile_output)
+  if failed: sys.exit(1)
 
 
 if __name__ == '__main__':
-  top_module_name = sys.argv[1]
-  generate_schematic(top_module_name)
+  # run through the importable module so worker processes and helper modules share its classes
+  from schematic_generator import main
+  main()
@@ -0,0 +1,358 @@
+import sys
+from array import array
+from enum import IntEnum
+from typing import Dict, List
+
+from schematic_generator import Block, Gate, Inout, Input, Module, Output, Reg, Schematic, Wire, get_module, instance_ports, phase, rename_gate, search_schematic, statement_gate
+
+
+class NodeKind(IntEnum):
+  INPUT = 0
+  WIRE = 1
+  OUTPUT = 2
+  INOUT = 3
+  BLOCK = 4
+  REG = 5
+
+
+NODE_TYPES = [Input, Wire, Output, Inout, Block, Reg]
+KIND_OF_TYPE = {node_type: NodeKind(kind) for kind, node_type in enumerate(NODE_TYPES)}
+
+
+class GraphBuilder:
+  # collects nodes and edges, then packs them into a SchematicGraph. Edges keep the order they were added in,
+  # so each node's outputs come out in the same order as its outputs list
+  def __init__(self, name):
+    self.name = name
+    self.ids: Dict[str, int] = {}
+    self.names: List[str] = []
+    self.kinds = array("B")
+    self.sources = array("I")
+    self.targets = array("I")
+    self.gates: Dict[int, Gate] = {}
+    self.blocks: Dict[int, tuple] = {}
+    # blocks of the same module with the same constant inputs share one tuple
+    self.block_data: Dict[tuple, tuple] = {}
+
+  def add_node(self, name, kind: NodeKind):
+    if name not in self.ids:
+      self.ids[name] = len(self.names)
+      self.names.append(name)
+      self.kinds.append(kind)
+    return self.ids[name]
+
+  def add_block(self, node_id, module_name, clocked, input_nums):
+    data = (module_name, clocked, tuple(input_nums))
+    self.blocks[node_id] = self.block_data.setdefault(data, data)
+
+  def add_edge(self, source, target):
+    self.sources.append(source)
+    self.targets.append(target)
+
+  def build(self, inputs=()):
+    # counting sort of the edges by source into CSR offsets and targets
+    offsets = array("I", bytes(4 * (len(self.names) + 1)))
+    for source in self.sources: offsets[source + 1] += 1
+    for i in range(len(self.names)): offsets[i + 1] += offsets[i]
+    targets = array("I", bytes(4 * len(self.targets)))
+    fill = array("I", offsets)
+    for source, target in zip(self.sources, self.targets):
+      targets[fill[source]] = target
+      fill[source] += 1
+    return SchematicGraph(self.name, self.names, self.kinds, offsets, targets, array("I", inputs), self.gates, self.blocks)
+
+
+class GraphSchematic(Schematic):
+  # the Schematic the DFS fills when building a SchematicGraph directly: nodes and edges go to a GraphBuilder
+  # as they are connected. Each connect hands the DFS a fresh node object that is dropped once its outputs have
+  # been followed; only blocks, a small share of the nodes, keep one object for their module and constant inputs
+  def __init__(self, name):
+    super().__init__(name)
+    self.builder = GraphBuilder(name)
+    # per node ID, whether the node already existed when it was last connected
+    self.visited_flags = bytearray()
+    self.block_nodes: Dict[int, Block] = {}
+
+  def add_node(self, name, kind: NodeKind):
+    node_id = self.builder.add_node(name, kind)
+    if node_id == len(self.visited_flags): self.visited_flags.append(0)
+    return node_id
+
+  def connect(self, input: Input, output_name: str, node_type, clk=None, line=None, module_name=None, tokens=None):
+    visited = output_name in self.builder.ids
+    node_id = self.add_node(output_name, KIND_OF_TYPE[node_type])
+    kind = self.builder.kinds[node_id]
+    if kind == NodeKind.BLOCK:
+      node = self.block_nodes.setdefault(node_id, Block(name=output_name))
+      if node_type is Block: node.clocked, node.module_name = clk, module_name
+    else: node = NODE_TYPES[kind](name=output_name)
+    self.builder.add_edge(self.builder.ids[input.name], node_id)
+    input.outputs.append(node)
+    gate = statement_gate(line, tokens)
+    if gate is not None: self.builder.gates[node_id] = gate
+    self.visited_flags[node_id] = visited
+    return visited
+
+  def add_input(self, input: Input):
+    self.inputs.append(input)
+    self.add_node(input.name, KIND_OF_TYPE[type(input)])
+
+  def visited(self, name):
+    return self.visited_flags[self.builder.ids[name]]
+
+  def graph(self):
+    for node_id, node in self.block_nodes.items(): self.builder.add_block(node_id, node.module_name, node.clocked, node.input_nums)
+    return self.builder.build([self.builder.ids[input.name] for input in self.inputs])
+
+
+def build_graph(modules, module_name, depth=0, templates=None):
+  # build_schematic straight into a SchematicGraph. Instances are elaborated from template graphs, so no
+  # node objects are made for the copies either; templates maps (module name, depth) to its graph
+  top_module = get_module(modules, module_name)
+  graph = search_schematic(modules, top_module, GraphSchematic(module_name)).graph()
+  with phase("elaborate"): return elaborate_graph(modules, top_module, graph, depth, templates if templates is not None else {})
+
+
+def elaborate_graph(modules, module: Module, graph: "SchematicGraph", depth, templates):
+  # elaborate_schematic on graphs: each block is replaced by a copy of its module's graph named <instance>/<net>,
+  # with the ports turned into plain wires, and the nets around it rewired to the ports the same way
+  if depth <= 0: return graph
+  expanded = {}
+  for node_id, (module_name, clocked, input_nums) in graph.blocks.items():
+    key = (module_name, depth - 1)
+    if key not in templates: templates[key] = build_graph(modules, module_name, depth - 1, templates)
+    expanded[node_id] = (templates[key], instance_ports(module, graph.name_of(node_id)), get_module(modules, module_name))
+  if not expanded: return graph
+
+  builder = GraphBuilder(graph.name)
+  # new IDs of the nodes that stay and of the copies of each instance
+  node_ids = array("I", bytes(4 * len(graph)))
+  copy_ids: Dict[int, array] = {}
+  for node_id in range(len(graph)):
+    if node_id not in expanded:
+      node_ids[node_id] = builder.add_node(graph.name_of(node_id), graph.kinds[node_id])
+      if node_id in graph.gates: builder.gates[node_ids[node_id]] = graph.gates[node_id]
+      continue
+    template = expanded[node_id][0]
+    prefix = graph.name_of(node_id) + "/"
+    names = {template.name_of(copy): prefix + template.name_of(copy) for copy in range(len(template))} if template.gates else {}
+    copies = copy_ids[node_id] = array("I")
+    for copy in range(len(template)):
+      kind = template.kinds[copy]
+      copies.append(builder.add_node(prefix + template.name_of(copy), NodeKind.WIRE if kind in (NodeKind.INPUT, NodeKind.OUTPUT, NodeKind.INOUT) else kind))
+      if copy in template.gates: builder.gates[copies[-1]] = rename_gate(template.gates[copy], names)
+      if copy in template.blocks: builder.blocks[copies[-1]] = template.blocks[copy]
+
+  # a net that fed an instance now feeds the input ports it is connected to
+  net_outputs: Dict[int, List[int]] = {}
+  for node_id in range(len(graph)):
+    if node_id in expanded:
+      template, copies = expanded[node_id][0], copy_ids[node_id]
+      for copy in range(len(template)):
+        for target in template.successors(copy): builder.add_edge(copies[copy], copies[target])
+      continue
+    name = graph.name_of(node_id)
+    outputs = net_outputs[node_ids[node_id]] = []
+    for target in graph.successors(node_id):
+      if target not in expanded:
+        outputs.append(node_ids[target])
+        continue
+      template, ports, instanced = expanded[target]
+      outputs += [copy_ids[target][template.id_of(port)] for port, net in ports if net == name and port in template and instanced.net_kinds.get(port) in ("input", "inout")]
+    for target in outputs: builder.add_edge(node_ids[node_id], target)
+  for node_id, (template, ports, instanced) in expanded.items():
+    driven = {graph.name_of(target) for target in graph.successors(node_id)}
+    for port, net in ports:
+      # a port on a bit or range of a bus, like .Aselect(Aselect[30:0]), connects to the whole bus
+      net = net.split("[")[0]
+      if port not in template or net not in builder.ids: continue
+      port_id, net_id = copy_ids[node_id][template.id_of(port)], builder.ids[net]
+      port_kind = instanced.net_kinds.get(port)
+      # output ports drive their nets; input ports the search never connected, like clk, are connected here
+      if port_kind == "output" or (port_kind == "inout" and net in driven): builder.add_edge(port_id, net_id)
+      elif port_kind in ("input", "inout") and port_id not in net_outputs.setdefault(net_id, []):
+        net_outputs[net_id].append(port_id)
+        builder.add_edge(net_id, port_id)
+  return builder.build([node_ids[node_id] for node_id in graph.inputs])
+
+
+class NodeView:
+  # one node of a SchematicGraph looked at like a Schematic node; made on demand and holding no data of its own
+  __slots__ = ("graph", "id")
+
+  def __init__(self, graph, node_id):
+    self.graph = graph
+    self.id = node_id
+
+  @property
+  def name(self):
+    return self.graph.name_of(self.id)
+
+  @property
+  def kind(self):
+    return NodeKind(self.graph.kinds[self.id])
+
+  @property
+  def outputs(self):
+    return [NodeView(self.graph, target) for target in self.graph.successors(self.id)]
+
+  @property
+  def gate(self):
+    return self.graph.gates.get(self.id)
+
+  @property
+  def module_name(self):
+    return self.graph.blocks[self.id][0] if self.id in self.graph.blocks else None
+
+  @property
+  def clocked(self):
+    return self.graph.blocks[self.id][1] if self.id in self.graph.blocks else False
+
+  @property
+  def input_nums(self):
+    return list(self.graph.blocks[self.id][2]) if self.id in self.graph.blocks else []
+
+  def __eq__(self, other):
+    return isinstance(other, NodeView) and other.graph is self.graph and other.id == self.id
+
+  def __hash__(self):
+    return hash(self.id)
+
+  def __repr__(self):
+    return f"{NODE_TYPES[self.graph.kinds[self.id]].__name__}View(name={self.name!r}, outputs={[output.name for output in self.outputs]!r})"
+
+
+class SchematicGraph:
+  # a schematic as integer node IDs. The names are packed into one string, the kind of each node is one byte,
+  # and the outputs of node i are targets[offsets[i]:offsets[i + 1]], CSR style. The gates of gated nodes and
+  # the module name, clock and constant inputs of blocks are side tables, since most nodes have none of them
+  def __init__(self, name, names, kinds, offsets, targets, inputs, gates, blocks):
+    self.name = name
+    self.name_text = "".join(names)
+    self.name_offsets = array("I", [0])
+    for node_name in names: self.name_offsets.append(self.name_offsets[-1] + len(node_name))
+    self.kinds = kinds
+    self.offsets = offsets
+    self.targets = targets
+    self.inputs = inputs
+    self.gates = gates
+    self.blocks = blocks
+    # built on first use: name -> id, and the transposed CSR for the readers of a node
+    self.ids: Dict[str, int] = None
+    self.reverse_offsets = self.reverse_targets = None
+
+  @classmethod
+  def from_schematic(cls, schematic: Schematic, release=False):
+    # packs a finished schematic, so the build has already paid for the node objects; this only lowers what
+    # is held afterwards, see build_graph for a lower peak. With release, the schematic is emptied while packing
+    builder = GraphBuilder(schematic.name)
+    for name, node in schematic.nodes.items():
+      node_id = builder.add_node(name, KIND_OF_TYPE[type(node)])
+      if isinstance(node, Wire) and node.gate is not None: builder.gates[node_id] = node.gate
+      if isinstance(node, Block): builder.add_block(node_id, node.module_name, node.clocked, node.input_nums)
+    inputs = [builder.ids[node.name] for node in schematic.inputs]
+    for node in schematic.nodes.values():
+      source = builder.ids[node.name]
+      for output in node.outputs: builder.add_edge(source, builder.ids[output.name])
+      # dropping the outputs breaks the loops between nodes, so they are freed as soon as the dicts let go
+      if release: node.outputs = []
+    if release:
+      for table in (schematic.nodes, schematic.node_visited, schematic.inputs, schematic.gate_nodes): table.clear()
+    return builder.build(inputs)
+
+  def __len__(self):
+    return len(self.kinds)
+
+  def __iter__(self):
+    return (NodeView(self, node_id) for node_id in range(len(self.kinds)))
+
+  def __contains__(self, name):
+    return self.id_of(name) is not None
+
+  def __getitem__(self, name):
+    node_id = self.id_of(name)
+    if node_id is None: raise KeyError(name)
+    return NodeView(self, node_id)
+
+  def name_of(self, node_id):
+    return self.name_text[self.name_offsets[node_id]:self.name_offsets[node_id + 1]]
+
+  def id_of(self, name):
+    if self.ids is None: self.ids = {self.name_of(node_id): node_id for node_id in range(len(self.kinds))}
+    return self.ids.get(name)
+
+  def successors(self, node_id):
+    return self.targets[self.offsets[node_id]:self.offsets[node_id + 1]]
+
+  def predecessors(self, node_id):
+    if self.reverse_offsets is None: self.build_reverse()
+    return self.reverse_targets[self.reverse_offsets[node_id]:self.reverse_offsets[node_id + 1]]
+
+  def build_reverse(self):
+    count = len(self.kinds)
+    offsets = array("I", bytes(4 * (count + 1)))
+    for target in self.targets: offsets[target + 1] += 1
+    for i in range(count): offsets[i + 1] += offsets[i]
+    targets = array("I", bytes(4 * len(self.targets)))
+    fill = array("I", offsets)
+    for source in range(count):
+      for target in self.targets[self.offsets[source]:self.offsets[source + 1]]:
+        targets[fill[target]] = source
+        fill[target] += 1
+    self.reverse_offsets, self.reverse_targets = offsets, targets
+
+  def of_kind(self, kind: NodeKind):
+    return [node_id for node_id, node_kind in enumerate(self.kinds) if node_kind == kind]
+
+  def reachable(self, starts, reverse=False, depth=None):
+    # ids of the nodes reachable from the start ids, following outputs, or drivers when reverse, in visit order.
+    # With depth, only the nodes at most that many edges from a start, found level by level
+    if reverse and self.reverse_offsets is None: self.build_reverse()
+    offsets, targets = (self.reverse_offsets, self.reverse_targets) if reverse else (self.offsets, self.targets)
+    seen = bytearray(len(self.kinds))
+    order = []
+    work = list(starts)
+    for node_id in work: seen[node_id] = 1
+    if depth is not None:
+      order.extend(work)
+      for _ in range(depth):
+        level = []
+        for node_id in work:
+          for target in targets[offsets[node_id]:offsets[node_id + 1]]:
+            if not seen[target]:
+              seen[target] = 1
+              level.append(target)
+        if not level: break
+        order.extend(level)
+        work = level
+      return order
+    while work:
+      node_id = work.pop()
+      order.append(node_id)
+      for target in targets[offsets[node_id]:offsets[node_id + 1]]:
+        if not seen[target]:
+          seen[target] = 1
+          work.append(target)
+    return order
+
+  def nbytes(self):
+    # bytes held by the graph, not counting the gate trees and module names it shares with the schematic
+    arrays = [self.name_offsets, self.kinds, self.offsets, self.targets, self.inputs]
+    size = sys.getsizeof(self.name_text) + sum(sys.getsizeof(values) for values in arrays)
+    for table in (self.gates, self.blocks): size += sys.getsizeof(table) + sum(sys.getsizeof(node_id) for node_id in table)
+    shared_blocks = {id(data): data for data in self.blocks.values()}
+    return size + sum(sys.getsizeof(data) + sys.getsizeof(data[2]) for data in shared_blocks.values())
+
+  def to_schematic(self):
+    # the object form of the graph, for code that walks Schematic.nodes
+    schematic = Schematic(self.name)
+    nodes = []
+    for node_id, kind in enumerate(self.kinds):
+      node = NODE_TYPES[kind](name=self.name_of(node_id))
+      if node_id in self.gates: node.gate = self.gates[node_id]
+      if node_id in self.blocks: node.module_name, node.clocked, node.input_nums = self.blocks[node_id][0], self.blocks[node_id][1], list(self.blocks[node_id][2])
+      nodes.append(node)
+      schematic.nodes[node.name] = node
+    for node_id, node in enumerate(nodes): node.outputs = [nodes[target] for target in self.successors(node_id)]
+    schematic.inputs = [nodes[node_id] for node_id in self.inputs]
+    return schematic
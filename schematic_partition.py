@@ -0,0 +1,157 @@
+import io
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from schematic_cache import SchematicCache
+from schematic_generator import GRAPH_ATTR, NODE_ATTR, Block, DotWriter, Input, Node, Output, Reg, Schematic, Wire, bus_label, node_fields, render_dot
+
+
+# pipeline register modules in pipeline order; the register after stage i starts stage i + 1
+PIPELINE_REGISTERS = ["IF_ID_reg", "ID_EX_reg", "EX_MEM_reg", "MEM_WB_reg"]
+PIPELINE_STAGES = ["IF", "ID", "EX", "MEM", "WB"]
+
+
+def fetch_registers(schematic: Schematic):
+  # the clocked blocks and registers outside the pipeline registers that feed IF_ID_reg through combinational
+  # logic, like the program counter: they hold the state of the fetch stage
+  inputs_of: Dict[str, List[Node]] = {name: [] for name in schematic.nodes}
+  for node in schematic.nodes.values():
+    for output in node.outputs: inputs_of[output.name].append(node)
+  work = [node for node in schematic.nodes.values() if isinstance(node, Block) and node.module_name == PIPELINE_REGISTERS[0]]
+  seen = {node.name for node in work}
+  found = []
+  while work:
+    for node in inputs_of[work.pop().name]:
+      if node.name in seen: continue
+      seen.add(node.name)
+      if isinstance(node, Block) and node.module_name in PIPELINE_REGISTERS: continue
+      if type(node) == Reg or (isinstance(node, Block) and node.clocked): found.append(node)
+      else: work.append(node)
+  return found
+
+
+def stage_partition(schematic: Schematic):
+  # each pipeline register starts its stage, and the registers feeding IF_ID_reg, like the program counter,
+  # start IF. Everything else takes the earliest stage that feeds it, so write-back, forwarding and next-pc
+  # paths don't pull a stage forward. Top inputs like clk and reset feed every stage and don't count; logic
+  # reached only from them lands in IF
+  stage: Dict[str, int] = {}
+  work = deque()
+  for node in schematic.nodes.values():
+    if isinstance(node, Block) and node.module_name in PIPELINE_REGISTERS:
+      stage[node.name] = PIPELINE_REGISTERS.index(node.module_name) + 1
+      work.append(node)
+  for node in fetch_registers(schematic):
+    stage[node.name] = 0
+    work.append(node)
+  while work:
+    node = work.popleft()
+    for output in node.outputs:
+      if isinstance(output, Block) and output.module_name in PIPELINE_REGISTERS: continue
+      if stage[node.name] < stage.get(output.name, len(PIPELINE_STAGES)):
+        stage[output.name] = stage[node.name]
+        work.append(output)
+  return {name: PIPELINE_STAGES[stage.get(name, 0)] for name in schematic.nodes}
+
+
+def module_partition(schematic: Schematic):
+  # every instance anchors its own cluster and the top inputs share one; the rest of the
+  # logic joins the cluster of the first anchor a breadth-first search reaches it from
+  cluster: Dict[str, str] = {}
+  work = deque()
+  for input in schematic.inputs:
+    cluster[input.name] = "inputs"
+    work.append(input)
+  for node in schematic.nodes.values():
+    if isinstance(node, Block):
+      cluster[node.name] = node.name
+      work.append(node)
+  while work:
+    node = work.popleft()
+    for output in node.outputs:
+      if output.name not in cluster:
+        cluster[output.name] = cluster[node.name]
+        work.append(output)
+  return {name: cluster.get(name, "inputs") for name in schematic.nodes}
+
+
+PARTITIONS = {"stage": stage_partition, "module": module_partition}
+
+
+def cone_partition(schematic: Schematic, nets: List[str], depth=None, direction="both"):
+  # "cone" for the nodes within depth edges of the nets, along the outputs for the logic they drive, against
+  # them for the logic driving them, or both; "rest" for everything else. The drivers come from the reverse
+  # index of the compact graph
+  missing = [net for net in nets if net not in schematic.nodes]
+  if missing: raise ValueError(f"{', '.join(missing)} not found in {schematic.name}")
+  graph = schematic.compact()
+  starts = [graph.id_of(net) for net in nets]
+  cone = set()
+  if direction != "backward": cone.update(graph.reachable(starts, depth=depth))
+  if direction != "forward": cone.update(graph.reachable(starts, reverse=True, depth=depth))
+  return {graph.name_of(node_id): "cone" if node_id in cone else "rest" for node_id in range(len(graph))}
+
+
+def extract_cone(schematic: Schematic, nets: List[str], depth=None, direction="both"):
+  # the cone of the nets as a schematic of its own named [top].cone; its edges to the pruned logic end in
+  # outputs, and the pruned nets it reads become its inputs, as for a cluster of split_schematic
+  return split_schematic(schematic, cone_partition(schematic, nets, depth, direction))["cone"]
+
+
+def split_schematic(schematic: Schematic, partition: Dict[str, str]):
+  # one sub-schematic per cluster; a signal crossing between clusters leaves its own cluster as
+  # an output and enters the reading cluster as a stub input of the same name
+  cluster_names = list(dict.fromkeys(partition[name] for name in schematic.nodes))
+  if set(cluster_names) <= set(PIPELINE_STAGES): cluster_names = [stage for stage in PIPELINE_STAGES if stage in cluster_names]
+  clusters = {key: Schematic(f"{schematic.name}.{key}") for key in cluster_names}
+  crossing: Dict[str, Dict[str, List[Node]]] = {key: {} for key in cluster_names}
+
+  copies: Dict[str, Node] = {}
+  for name, node in schematic.nodes.items():
+    node_type = type(node)
+    if node_type is Wire and any(partition[output.name] != partition[name] for output in node.outputs): node_type = Output
+    copies[name] = node_type(**{**node_fields(node), "outputs": []})
+  for name, node in schematic.nodes.items():
+    key = partition[name]
+    for output in node.outputs:
+      if partition[output.name] == key: copies[name].outputs.append(copies[output.name])
+      else: crossing[partition[output.name]].setdefault(name, []).append(copies[output.name])
+
+  top_inputs = {input.name for input in schematic.inputs}
+  for name, copy in copies.items():
+    sub_schematic = clusters[partition[name]]
+    if name in top_inputs: sub_schematic.add_input(copy)
+    else: sub_schematic.nodes[name] = copy
+  for key, stubs in crossing.items():
+    for name, outputs in stubs.items(): clusters[key].add_input(Input(name=name, outputs=outputs))
+  return clusters
+
+
+def overview_source(schematic: Schematic, clusters: Dict[str, Schematic], partition: Dict[str, str], format="png"):
+  # one box per cluster linking to its own file, with the signals that cross between clusters on the edges
+  signals: Dict[tuple, List[str]] = {}
+  for name, node in schematic.nodes.items():
+    for output in node.outputs:
+      if partition[output.name] != partition[name]:
+        crossing = signals.setdefault((partition[name], partition[output.name]), [])
+        if name not in crossing: crossing.append(name)
+  stream = io.StringIO()
+  dot = DotWriter(stream, graph_attr=GRAPH_ATTR, node_attr=NODE_ATTR)
+  for key, sub_schematic in clusters.items(): dot.node(key, key, URL=f"{sub_schematic.name}.{format}")
+  for (tail, head), names in signals.items():
+    dot.edge(tail, head, label=bus_label(names), tooltip=", ".join(names))
+  dot.close()
+  return stream.getvalue()
+
+
+def render_partitioned(schematic: Schematic, mode: str, format="png", jobs=None, cache: SchematicCache = None, bundle=False):
+  # lays out every cluster in its own Graphviz process, then the overview as [top].overview, so a partitioned
+  # run doesn't overwrite the output of a plain one
+  partition = PARTITIONS[mode](schematic)
+  clusters = split_schematic(schematic, partition)
+  renders = [(sub_schematic.dot_source(bundle=bundle), sub_schematic.name) for sub_schematic in clusters.values()]
+  renders.append((overview_source(schematic, clusters, partition, format=format), f"{schematic.name}.overview"))
+  with ThreadPoolExecutor(max_workers=jobs) as pool:
+    for _ in pool.map(lambda item: render_dot(item[0], item[1], cache, format=format), renders): pass
+  return clusters
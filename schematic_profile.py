@@ -0,0 +1,120 @@
+import contextlib
+import cProfile
+import pstats
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+CAPTURES = ["counters", "cprofile", "tracemalloc"]
+
+
+class CountingDot:
+  # passes nodes and edges through to a DotWriter or Digraph, counting them on the way
+  def __init__(self, dot, counts: Counter):
+    self.dot = dot
+    self.counts = counts
+
+  def node(self, name, label=None, **attrs):
+    self.counts["dot_nodes"] += 1
+    self.dot.node(name, label, **attrs)
+
+  def edge(self, tail_name, head_name, label=None, **attrs):
+    self.counts["dot_edges"] += 1
+    self.dot.edge(tail_name, head_name, label, **attrs)
+
+
+class Profiler:
+  # wall time and calls per phase, plus named counters. A phase's time excludes the phases nested inside it,
+  # so the phases add up to the time spent in any of them
+  def __init__(self, capture="counters"):
+    self.capture = capture
+    self.counts = Counter()
+    # phase name -> [seconds, calls]
+    self.phases = {}
+    self.wall_seconds = 0.0
+    self.lock = threading.Lock()
+    # render_partitioned renders clusters on threads, so each thread keeps its own stack of open phases
+    self.local = threading.local()
+    self.cprofile = None
+    self.memory = None
+    self.started = None
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    stack = self.local.__dict__.setdefault("stack", [])
+    # [start time, time spent in nested phases]
+    frame = [time.perf_counter(), 0.0]
+    stack.append(frame)
+    try: yield
+    finally:
+      stack.pop()
+      elapsed = time.perf_counter() - frame[0]
+      if stack: stack[-1][1] += elapsed
+      with self.lock:
+        entry = self.phases.setdefault(name, [0.0, 0])
+        entry[0] += elapsed - frame[1]
+        entry[1] += 1
+
+  def counting(self, dot):
+    return CountingDot(dot, self.counts)
+
+  def start(self):
+    if self.capture == "cprofile":
+      self.cprofile = cProfile.Profile()
+      self.cprofile.enable()
+    elif self.capture == "tracemalloc": tracemalloc.start()
+    self.started = time.perf_counter()
+
+  def stop(self):
+    self.wall_seconds += time.perf_counter() - self.started
+    if self.cprofile is not None: self.cprofile.disable()
+    if self.capture == "tracemalloc" and tracemalloc.is_tracing():
+      current, peak = tracemalloc.get_traced_memory()
+      top = tracemalloc.take_snapshot().statistics("lineno")[:15]
+      tracemalloc.stop()
+      self.memory = {"current_bytes": current, "peak_bytes": peak, "top": [{"location": str(statistic.traceback[0]), "bytes": statistic.size, "blocks": statistic.count} for statistic in top]}
+
+  def merge(self, report):
+    # adds the phases and counters of a report from a batch worker; workers run side by side, so merged
+    # phase times can add up to more than the wall time
+    for name, entry in report["phases"].items():
+      merged = self.phases.setdefault(name, [0.0, 0])
+      merged[0] += entry["seconds"]
+      merged[1] += entry["calls"]
+    self.counts.update(report["counts"])
+
+  def top_functions(self, limit=25):
+    stats = pstats.Stats(self.cprofile).stats
+    ranked = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+    return [{"function": f"{file}:{line}({name})", "calls": calls, "tottime": round(tottime, 6), "cumtime": round(cumtime, 6)} for (file, line, name), (_, calls, tottime, cumtime, _) in ranked]
+
+  def report(self):
+    result = {
+      "capture": self.capture,
+      "wall_seconds": round(self.wall_seconds, 6),
+      "phases": {name: {"seconds": round(seconds, 6), "calls": calls} for name, (seconds, calls) in sorted(self.phases.items(), key=lambda item: -item[1][0])},
+      "counts": dict(sorted(self.counts.items())),
+    }
+    if self.cprofile is not None: result["functions"] = self.top_functions()
+    if self.memory is not None: result["memory"] = self.memory
+    return result
+
+  def summary(self):
+    report = self.report()
+    lines = [f"{'phase':<16} {'calls':>8} {'seconds':>10} {'share':>7}"]
+    total = sum(entry["seconds"] for entry in report["phases"].values()) or 1.0
+    for name, entry in report["phases"].items(): lines.append(f"{name:<16} {entry['calls']:>8} {entry['seconds']:>10.4f} {entry['seconds'] / total:>7.1%}")
+    lines.append(f"{'wall':<16} {'':>8} {report['wall_seconds']:>10.4f}")
+    lines.append("")
+    lines.append(f"{'counter':<24} {'count':>12}")
+    for name, count in report["counts"].items(): lines.append(f"{name:<24} {count:>12,}")
+    if "functions" in report:
+      lines.append("")
+      lines.append(f"{'cumtime':>10} {'tottime':>10} {'calls':>10}  function")
+      for entry in report["functions"][:15]: lines.append(f"{entry['cumtime']:>10.4f} {entry['tottime']:>10.4f} {entry['calls']:>10}  {entry['function']}")
+    if "memory" in report:
+      lines.append("")
+      lines.append(f"peak traced memory {report['memory']['peak_bytes']:,} bytes")
+      for entry in report["memory"]["top"][:10]: lines.append(f"{entry['bytes']:>12,}  {entry['location']}")
+    return "\n".join(lines)
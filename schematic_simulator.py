@@ -0,0 +1,1026 @@
+import argparse
+import random
+import re
+import sys
+import time
+from bisect import bisect_right
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+from schematic_generator import Gate, MultiInputGate, SingleInputGate, TSB, LazyModules, Module, build_gate, get_module, instance_ports, read_file_list
+
+
+# A top module and everything it instantiates flattened into nets, each with the expressions that drive
+# it, then levelized and emitted as straight-line Python: one generated function per clock edge, with
+# no event queue. The schematic graph keeps which nets feed which, but not the bit-selects of plain
+# assigns or the if/case conditions inside always blocks, so the nets are built from the same module
+# table and expression parser that schematic_generator.py uses.
+#
+# Expressions are tuples:
+#   ("net", name, lsb, width)     bits of a net
+#   ("const", value, width)
+#   ("op", operator, children)    gate names from the parser, unary operators prefixed with "u"
+#   ("slice", child, lsb, width)  bits of an expression
+#   ("rep", count, child)         {count{child}}
+
+DECLARATION = re.compile(r"(input|output|inout|wire|reg)\b\s*(?:reg\b\s*)?(?:\[\s*(\d+)\s*:\s*(\d+)\s*\])?(.*)$")
+NUMBER = re.compile(r"(\d*)'[sS]?([bBoOdDhH])([0-9a-fA-FxXzZ_?]+)$")
+NAME_SELECTS = re.compile(r"([^\[]+)((?:\[[^\]]*\])*)$")
+SELECT = re.compile(r"\[\s*(\d+)\s*(?::\s*(\d+)\s*)?\]")
+INSTANCE_HEADER = re.compile(r"(\w+)\s+(\w+)\s*(?:\[\s*(\d+)\s*:\s*(\d+)\s*\])?\s*\(")
+WORD = re.compile(r"\s*([A-Za-z_]\w*)")
+BASES = {"b": 2, "o": 8, "d": 10, "h": 16}
+# operators the code generators take any number of inputs for; the rest are folded into pairs
+CHAINED_OPERATORS = {"&", "|", "^", "+", "*"}
+COMPARISONS = {"=": "==", "===": "==", "!=": "!=", "!==": "!=", "<": "<", "<=": "<=", ">": ">", ">=": ">="}
+EDGES = ["posedge", "negedge"]
+
+
+@dataclass
+class Net:
+  name: str
+  width: int = 1
+  # (lsb, width, expression) of every assignment to the net; several drivers on the same bits are OR-ed,
+  # like a tri-state bus whose disabled drivers read as 0
+  drivers: List[tuple] = field(default_factory=list)
+  # input, wire, posedge, negedge, or latch (a combinational always block that can keep its value)
+  kind: str = "wire"
+
+
+def mask(width):
+  return (1 << width) - 1
+
+
+def parse_number(text):
+  # x and z bits read as 0
+  match = NUMBER.match(text)
+  if match is None: return ("const", int(text.replace("_", "")), 32)
+  size, base, digits = match.groups()
+  digits = re.sub(r"[xXzZ?]", "0", digits.replace("_", ""))
+  width = int(size) if size else 32
+  return ("const", int(digits, BASES[base.lower()]) & mask(width), width)
+
+
+def declared_ranges(module: Module):
+  # net name -> (msb, lsb) as declared, like [63:0]; a net declared without a range is (0, 0)
+  ranges: Dict[str, tuple] = {}
+  for line in module.lines:
+    match = DECLARATION.match(line)
+    if match is None: continue
+    msb, lsb, names = match.group(2), match.group(3), match.group(4)
+    for name in names.rstrip(";").split(","):
+      name = name.split("=")[0].split("[")[0].strip()
+      if not name: continue
+      if msb is not None or name not in ranges: ranges[name] = (int(msb), int(lsb)) if msb is not None else (0, 0)
+  return ranges
+
+
+def children_of(expression):
+  kind = expression[0]
+  if kind == "op": return expression[2]
+  if kind == "slice": return (expression[1],)
+  if kind == "rep": return (expression[2],)
+  return ()
+
+
+def net_references(expression):
+  names = set()
+  work = [expression]
+  while work:
+    item = work.pop()
+    if item[0] == "net": names.add(item[1])
+    else: work.extend(children_of(item))
+  return names
+
+
+class Widths:
+  # self-determined width of every expression, cached by identity since the expressions are shared
+  def __init__(self):
+    self.cache: Dict[int, int] = {}
+
+  def __call__(self, root):
+    if id(root) in self.cache: return self.cache[id(root)]
+    work = [(root, False)]
+    while work:
+      expression, ready = work.pop()
+      if id(expression) in self.cache: continue
+      children = children_of(expression)
+      if not ready and children:
+        work.append((expression, True))
+        work.extend((child, False) for child in children if id(child) not in self.cache)
+        continue
+      kind = expression[0]
+      if kind in ("net", "const"): width = expression[-1]
+      elif kind == "slice": width = expression[3]
+      elif kind == "rep": width = expression[1] * self.cache[id(expression[2])]
+      else:
+        operator, sizes = expression[1], [self.cache[id(child)] for child in children]
+        if operator in COMPARISONS or operator in ("u!", "u&", "u|", "u^", "u~&", "u~|", "u~^"): width = 1
+        elif operator in ("<<", ">>", "<<<", ">>>", "**"): width = sizes[0]
+        elif operator == "?": width = max(sizes[1:])
+        elif operator == "tsb": width = sizes[1]
+        elif operator == "{}": width = sum(sizes)
+        else: width = max(sizes)
+      self.cache[id(expression)] = width
+    return self.cache[id(root)]
+
+
+def gate_expression(gate, leaf):
+  # parsed gate tree -> expression, converting each leaf string with leaf()
+  results = []
+  work = [(gate, False)]
+  while work:
+    item, ready = work.pop()
+    if not isinstance(item, Gate):
+      results.append(leaf(item))
+      continue
+    if type(item) == MultiInputGate: children = item.inputs
+    elif type(item) == TSB: children = [item.input, item.enable]
+    else: children = [item.input]
+    if not ready:
+      work.append((item, True))
+      work.extend((child, False) for child in reversed(children))
+      continue
+    args = tuple(results[len(results) - len(children):])
+    del results[len(results) - len(children):]
+    if type(item) == TSB: results.append(("op", "tsb", args))
+    elif type(item) == SingleInputGate: results.append(("op", "u" + item.name.replace("^~", "~^"), args))
+    elif item.name in ("?", "{}"): results.append(("op", item.name, args))
+    elif item.name.startswith("{"):
+      count = parse_number(item.name[1:-1])[1]
+      results.append(("rep", count, args[0] if len(args) == 1 else ("op", "{}", args)))
+    else:
+      name = "~^" if item.name == "^~" else item.name
+      if name in CHAINED_OPERATORS: results.append(("op", name, args))
+      else:
+        folded = args[0]
+        for arg in args[1:]: folded = ("op", name, (folded, arg))
+        results.append(folded)
+  return results[0]
+
+
+class StatementParser:
+  # begin/end, if/else, case and assignments of an always or initial block, read from the text of the module
+  def __init__(self, text, pos):
+    self.text = text
+    self.pos = pos
+
+  def peek_word(self):
+    match = WORD.match(self.text, self.pos)
+    return match.group(1) if match else None
+
+  def take_word(self):
+    match = WORD.match(self.text, self.pos)
+    self.pos = match.end()
+    return match.group(1)
+
+  def skip_space(self):
+    while self.pos < len(self.text) and self.text[self.pos].isspace(): self.pos += 1
+
+  def take_until(self, stops):
+    # text up to the first stop character outside of brackets
+    start, depth = self.pos, 0
+    while self.pos < len(self.text):
+      char = self.text[self.pos]
+      if depth == 0 and char in stops: return self.text[start:self.pos].strip()
+      if char in "([{": depth += 1
+      elif char in ")]}": depth -= 1
+      self.pos += 1
+    raise ValueError(f"Unterminated statement: {self.text[start:start + 60]}")
+
+  def take_parenthesis(self):
+    self.skip_space()
+    if self.text[self.pos] != "(": raise ValueError(f"Expected '(' at: {self.text[self.pos:self.pos + 60]}")
+    self.pos += 1
+    inside = self.take_until(")")
+    self.pos += 1
+    return inside
+
+  def event_control(self):
+    # @(posedge clk or posedge reset) -> posedge, @(a or b) and @* -> None
+    self.skip_space()
+    if self.text[self.pos] != "@": return None
+    self.pos += 1
+    self.skip_space()
+    if self.text[self.pos] == "*":
+      self.pos += 1
+      return None
+    events = self.take_parenthesis().split()
+    return events[0] if events and events[0] in EDGES else None
+
+  def statement(self):
+    # one statement and everything nested in it. The open begin, if and case statements are kept on a stack
+    # of [kind, ...] frames instead of the Python stack, so deep nesting and long cases parse in a loop
+    stack = []
+    while True:
+      word = self.peek_word()
+      result = None
+      if word == "begin":
+        self.take_word()
+        self.skip_space()
+        if self.text.startswith(":", self.pos):
+          self.pos += 1
+          self.take_word()
+        stack.append(["block", []])
+      elif word == "if":
+        self.take_word()
+        # condition, then, and whether the else part is being read
+        stack.append(["if", self.take_parenthesis(), None, False])
+        continue
+      elif word in ("case", "casez", "casex"):
+        self.take_word()
+        # subject, items, and the labels of the item being read
+        stack.append(["case", self.take_parenthesis(), [], None])
+      else: result = self.simple_statement()
+      # hand the finished statement to the frames it closes, until one needs another statement
+      while True:
+        if not stack: return result
+        frame = stack[-1]
+        if frame[0] == "block":
+          if result is not None: frame[1].append(result)
+          if self.peek_word() != "end": break
+          self.take_word()
+          result = ("block", stack.pop()[1])
+        elif frame[0] == "if":
+          if frame[3]:
+            stack.pop()
+            result = ("if", frame[1], frame[2], result)
+          elif self.peek_word() == "else":
+            self.take_word()
+            frame[2], frame[3] = result, True
+            break
+          else:
+            stack.pop()
+            result = ("if", frame[1], result, None)
+        else:
+          if result is not None: frame[2].append((frame[3], result))
+          if self.peek_word() == "endcase":
+            self.take_word()
+            stack.pop()
+            result = ("case", frame[1], frame[2])
+            continue
+          if self.peek_word() == "default":
+            self.take_word()
+            self.skip_space()
+            if self.text.startswith(":", self.pos): self.pos += 1
+            frame[3] = None
+          else:
+            labels = self.take_until(":")
+            self.pos += 1
+            frame[3] = split_top_level(labels)
+          break
+
+  def simple_statement(self):
+    self.skip_space()
+    text = self.take_until(";")
+    self.pos += 1
+    if not text: return ("block", [])
+    if "=" not in text: raise ValueError(f"Unsupported statement in always block: {text}")
+    equals = text.index("=")
+    blocking = equals == 0 or text[equals - 1] != "<"
+    return ("assign", text[:equals if blocking else equals - 1].strip(), blocking, text[equals + 1:].strip())
+
+
+def split_top_level(text):
+  parts, depth, start = [], 0, 0
+  for i, char in enumerate(text):
+    if char in "([{": depth += 1
+    elif char in ")]}": depth -= 1
+    elif char == "," and depth == 0:
+      parts.append(text[start:i].strip())
+      start = i + 1
+  parts.append(text[start:].strip())
+  return parts
+
+
+class Netlist:
+  # every net of the flattened design, named like the expanded schematic: <instance>/<net>
+  def __init__(self, modules: Dict[str, Module], top_name: str):
+    self.modules = modules
+    self.top = get_module(modules, top_name)
+    self.nets: Dict[str, Net] = {}
+    self.ranges: Dict[str, tuple] = {}
+    self.widths = Widths()
+    self.inputs = self.top.leafs("input") + self.top.leafs("inout")
+    self.outputs = self.top.leafs("output") + self.top.leafs("inout")
+    self.module_ranges: Dict[str, Dict[str, tuple]] = {}
+    work = [("", self.top)]
+    while work: work.extend(self.add_module(*work.pop()))
+    for name in self.inputs: self.net(name).kind = "input"
+
+  def net(self, name):
+    if name not in self.nets:
+      msb, lsb = self.ranges.get(name, (0, 0))
+      self.nets[name] = Net(name=name, width=abs(msb - lsb) + 1)
+    return self.nets[name]
+
+  def add_module(self, prefix, module: Module):
+    # the nets and drivers of one instance; returns the instances inside it
+    if module.name not in self.module_ranges: self.module_ranges[module.name] = declared_ranges(module)
+    for name, declared in self.module_ranges[module.name].items(): self.ranges[prefix + name] = declared
+    for name in self.module_ranges[module.name]: self.net(prefix + name)
+    lines = module.lines
+    text = " ".join(lines)
+    line_starts = []
+    position = 0
+    for line in lines:
+      line_starts.append(position)
+      position += len(line) + 1
+    children = []
+    i = 0
+    while i < len(lines):
+      line = lines[i]
+      match = WORD.match(line)
+      word = match.group(1) if match else ""
+      if word == "assign" or (word == "wire" and "=" in line.replace("==", "")):
+        statement = line
+        while not lines[i].rstrip().endswith(";") and i + 1 < len(lines):
+          i += 1
+          statement += " " + lines[i]
+        body = statement.strip()[len(word):].rstrip().rstrip(";")
+        if word == "wire": body = re.sub(r"^\s*(?:\[[^\]]*\])?", "", body)
+        equals = body.index("=")
+        self.drive(self.lvalue(prefix, body[:equals]), self.expression(prefix, body[equals + 1:]))
+      elif word in ("always", "initial"):
+        parser = StatementParser(text, line_starts[i] + len(word))
+        edge = parser.event_control() if word == "always" else None
+        statement = parser.statement()
+        if word == "always": self.add_always(prefix, edge, statement)
+        i = bisect_right(line_starts, parser.pos - 1) - 1
+      elif word in self.modules and module.fanout().headers[i] == i:
+        children += self.add_instance(prefix, module, i)
+      i += 1
+    return children
+
+  def expression(self, prefix, text, reads=None):
+    return gate_expression(build_gate([text]), lambda leaf: self.leaf(prefix, leaf, reads))
+
+  def leaf(self, prefix, leaf, reads=None):
+    if leaf[0].isdigit() or leaf[0] == "'": return parse_number(leaf)
+    name, lsb, width = self.select(prefix, leaf)
+    if reads is not None and name in reads:
+      whole = reads[name]
+      return whole if lsb == 0 and width == self.net(name).width else ("slice", whole, lsb, width)
+    return ("net", name, lsb, width)
+
+  def select(self, prefix, leaf):
+    # net name and the bits of it a leaf like instr[9:5] or c[0] selects
+    base, selects = NAME_SELECTS.match(leaf).groups()
+    name = prefix + base.strip()
+    net = self.net(name)
+    if not selects: return name, 0, net.width
+    match = SELECT.fullmatch(selects.replace(" ", ""))
+    if match is None: raise ValueError(f"Unsupported select in {leaf}: only constant bit and part selects are compiled")
+    msb, lsb = self.ranges.get(name, (net.width - 1, 0))
+    first = int(match.group(1))
+    last = int(match.group(2)) if match.group(2) is not None else first
+    offsets = [index - lsb if msb >= lsb else lsb - index for index in (first, last)]
+    return name, min(offsets), abs(first - last) + 1
+
+  def lvalue(self, prefix, text):
+    # (net, lsb, width) of each part of an assignment target, most significant first
+    gate = build_gate([text])
+    parts = gate.inputs if isinstance(gate, MultiInputGate) and gate.name == "{}" else [gate]
+    if not all(isinstance(part, str) for part in parts): raise ValueError(f"Unsupported assignment target: {text}")
+    return [self.select(prefix, part) for part in parts]
+
+  def drive(self, targets, source, start=0, width=None):
+    # source drives the bits [start, start + width) of the concatenated targets
+    width = width if width is not None else sum(part[2] for part in targets)
+    position = 0
+    for name, lsb, part_width in reversed(targets):
+      low, high = max(position, start), min(position + part_width, start + width)
+      if low < high:
+        piece = source if low == start else ("slice", source, low - start, high - low)
+        self.net(name).drivers.append((lsb + low - position, high - low, piece))
+      position += part_width
+
+  def add_always(self, prefix, edge, statement):
+    values: Dict[str, tuple] = {}
+    self.run(prefix, statement, values, {})
+    for name, value in values.items():
+      net = self.net(name)
+      if net.kind != "wire" or net.drivers: raise ValueError(f"{name} is assigned in more than one always block or also by an assign")
+      # a combinational block that keeps the old value on some path infers a latch
+      net.kind = edge if edge is not None else ("latch" if name in net_references(value) else "wire")
+      net.drivers.append((0, net.width, value))
+
+  def run(self, prefix, statement, values, reads):
+    # symbolic execution: values holds each assigned net's value at the end of the statements so far,
+    # reads the values blocking assignments make visible to the statements after them. The statements
+    # still to run wait on a stack with the values and reads they run on, and a branch's merge waits
+    # under the statements of its branches
+    work = [(statement, values, reads)]
+    while work:
+      statement, values, reads = work.pop()
+      kind = statement[0]
+      if kind == "block": work.extend((item, values, reads) for item in reversed(statement[1]))
+      elif kind == "assign":
+        _, target, blocking, text = statement
+        value = self.expression(prefix, text, reads)
+        targets = self.lvalue(prefix, target)
+        position = sum(part[2] for part in targets)
+        for name, lsb, width in targets:
+          position -= width
+          net = self.net(name)
+          part = value if position == 0 and len(targets) == 1 else ("slice", value, position, width)
+          if lsb != 0 or width != net.width:
+            old = values.get(name, ("net", name, 0, net.width))
+            pieces = [("slice", old, lsb + width, net.width - lsb - width)] if lsb + width < net.width else []
+            pieces.append(("slice", part, 0, width))
+            if lsb: pieces.append(("slice", old, 0, lsb))
+            part = ("op", "{}", tuple(pieces))
+          values[name] = part
+          if blocking: reads[name] = part
+      elif kind in ("if", "case"):
+        if kind == "if":
+          _, condition, then, otherwise = statement
+          choices, default = [(self.expression(prefix, condition, reads), then)], otherwise
+        else:
+          # a flat list of subject == label choices, the first that matches taken; default wherever it is
+          _, subject, items = statement
+          choices = [(self.expression(prefix, " || ".join(f"(({subject}) == ({label}))" for label in labels), reads), item) for labels, item in items if labels is not None]
+          default = next((item for labels, item in items if labels is None), None)
+        branches = [(condition, item, dict(values), dict(reads)) for condition, item in choices]
+        if default is not None: branches.append((None, default, dict(values), dict(reads)))
+        work.append((("merge", branches), values, reads))
+        work.extend((item, branch_values, branch_reads) for _, item, branch_values, branch_reads in branches)
+      elif kind == "merge": self.merge(statement[1], values, reads)
+
+  def merge(self, branches, values, reads):
+    # the value of every net a branch assigned: a ?: chain over the conditions in order, ending in the
+    # default branch, or the value from before the branches when there is none
+    choices = [branch for branch in branches if branch[0] is not None]
+    default = branches[-1] if branches and branches[-1][0] is None else None
+    for merged, index in ((values, 2), (reads, 3)):
+      names = set()
+      for branch in branches: names |= set(branch[index])
+      for name in names:
+        before = merged.get(name, ("net", name, 0, self.net(name).width))
+        result = default[index].get(name, before) if default is not None else before
+        for branch in reversed(choices):
+          value = branch[index].get(name, before)
+          if value is not result: result = ("op", "?", (branch[0], value, result))
+        merged[name] = result
+
+  def add_instance(self, prefix, module: Module, i):
+    match = INSTANCE_HEADER.match(module.lines[i])
+    if match is None: raise ValueError(f"Unsupported instance: {module.lines[i]}")
+    module_name, instance_name, first, last = match.groups()
+    instanced = get_module(self.modules, module_name)
+    if instanced.name not in self.module_ranges: self.module_ranges[instanced.name] = declared_ranges(instanced)
+    ranges = self.module_ranges[instanced.name]
+    # an instance array like reg_cell regcell[30:0] is one instance per index, each taking its slice of a
+    # connection as wide as all of them together, or the whole connection otherwise
+    indices = [None] if first is None else list(range(min(int(first), int(last)), max(int(first), int(last)) + 1))
+    ports = [(port, net) for port, net in instance_ports(module, module.fanout().line_tokens[i][1].replace("(", "")) if net]
+    children = []
+    for position, index in enumerate(indices):
+      child_prefix = f"{prefix}{instance_name}/" if index is None else f"{prefix}{instance_name}[{index}]/"
+      for port, text in ports:
+        msb, lsb = ranges.get(port, (0, 0))
+        port_width = abs(msb - lsb) + 1
+        port_name = child_prefix + port
+        self.ranges[port_name] = (msb, lsb)
+        if instanced.net_kinds.get(port) == "input":
+          source = self.expression(prefix, text)
+          if len(indices) > 1 and self.widths(source) == port_width * len(indices): source = ("slice", source, position * port_width, port_width)
+          self.net(port_name).drivers.append((0, port_width, source))
+        else:
+          # inout ports of instances are treated as outputs
+          targets = self.lvalue(prefix, text)
+          sliced = len(indices) > 1 and sum(part[2] for part in targets) == port_width * len(indices)
+          self.drive(targets, ("net", port_name, 0, port_width), position * port_width if sliced else 0, port_width)
+      children.append((child_prefix, instanced))
+    return children
+
+  def dependencies(self, net: Net):
+    # nets whose current value the net's own value depends on; registers depend on nothing within a cycle
+    if net.kind in EDGES: return set()
+    names = set()
+    for _, _, expression in net.drivers: names |= net_references(expression)
+    names.discard(net.name)
+    return names
+
+  def levelize(self):
+    # Kahn's algorithm over the combinational nets: returns them in evaluation order with the logic depth
+    dependencies = {name: self.dependencies(net) for name, net in self.nets.items()}
+    for names in list(dependencies.values()):
+      for name in names: self.net(name)
+    for name in self.nets: dependencies.setdefault(name, set())
+    readers: Dict[str, List[str]] = {name: [] for name in self.nets}
+    for name, names in dependencies.items():
+      for dependency in names: readers[dependency].append(name)
+    waiting = {name: len(names) for name, names in dependencies.items()}
+    level = {name: 0 for name, count in waiting.items() if count == 0}
+    order = list(level)
+    for name in order:
+      for reader in readers[name]:
+        waiting[reader] -= 1
+        level[reader] = max(level.get(reader, 0), level[name] + 1)
+        if waiting[reader] == 0: order.append(reader)
+    if len(order) != len(self.nets):
+      loop = sorted(name for name, count in waiting.items() if count)
+      raise ValueError(f"Combinational loop through {', '.join(loop[:8])}{' ...' if len(loop) > 8 else ''}")
+    return order, level
+
+
+class ScalarCode:
+  # every net is one Python int
+  def __init__(self, widths: Widths):
+    self.widths = widths
+    self.lines: List[str] = []
+    self.temps = 0
+    # the temp already holding each line of code in this phase, so the same expression is only computed
+    # once, like the bint, g, and p every case item of alu_cell repeats
+    self.known: Dict[str, str] = {}
+
+  def temp(self, code):
+    if code in self.known: return self.known[code]
+    name = f"t{self.temps}"
+    self.temps += 1
+    self.lines.append(f"  {name} = {code}")
+    self.known[code] = name
+    return name
+
+  def constant(self, value, width):
+    return str(value & mask(width))
+
+  def net(self, variable, net_width, lsb, width, want):
+    code = variable if lsb == 0 else f"{variable} >> {lsb}"
+    if lsb + width < net_width or want < width: code = f"{code} & {mask(min(width, want))}"
+    return code if code == variable else self.temp(code)
+
+  def combine(self, expression, want, args, sizes, work):
+    kind = expression[0]
+    if kind == "slice":
+      shifted = f"{args[0]} >> {expression[2]}" if expression[2] else args[0]
+      return self.temp(f"{shifted} & {mask(min(expression[3], want))}")
+    if kind == "rep":
+      repeat = sum(1 << (i * sizes[0]) for i in range(expression[1]))
+      return self.temp(f"{args[0]} * {repeat}" + (f" & {mask(want)}" if expression[1] * sizes[0] > want else ""))
+    operator = expression[1]
+    m = mask(want)
+    fit = f" & {m}" if work > want else ""
+    if operator == "&": return self.temp(f"{' & '.join(args)}{fit}")
+    if operator == "|": return self.temp(f"({' | '.join(args)}){fit}" if fit else " | ".join(args))
+    if operator == "^": return self.temp(f"({' ^ '.join(args)}){fit}" if fit else " ^ ".join(args))
+    if operator == "~^": return self.temp(f"~({' ^ '.join(args)}) & {m}")
+    if operator == "+": return self.temp(f"({' + '.join(args)}) & {m}")
+    if operator == "-": return self.temp(f"({args[0]} - {args[1]}) & {m}")
+    if operator == "*": return self.temp(f"({' * '.join(args)}) & {m}")
+    if operator == "/": return self.temp(f"({args[0]} // {args[1]} if {args[1]} else 0) & {m}")
+    if operator == "%": return self.temp(f"({args[0]} % {args[1]} if {args[1]} else 0) & {m}")
+    if operator == "**": return self.temp(f"pow({args[0]}, {args[1]}, {m + 1})")
+    if operator in ("<<", "<<<"): return self.temp(f"({args[0]} << {args[1]} & {m} if {args[1]} < {want} else 0)")
+    if operator in (">>", ">>>"): return self.temp(f"{args[0]} >> {args[1]} & {m}" if work > want else f"{args[0]} >> {args[1]}")
+    # sel === 1'b1 on a one-bit sel, as the regfile's tri-state buses test their selects, is sel itself
+    if COMPARISONS.get(operator) == "==" and sizes == [1, 1] and "1" in args[:2]: return args[1] if args[0] == "1" else args[0]
+    if operator in COMPARISONS: return self.temp(f"1 if {args[0]} {COMPARISONS[operator]} {args[1]} else 0")
+    if operator == "u~": return self.temp(f"~{args[0]} & {m}")
+    if operator == "u-": return self.temp(f"-{args[0]} & {m}")
+    if operator == "u+": return self.temp(f"{args[0]}{fit}") if fit else args[0]
+    if operator == "u!" or operator == "u~|": return self.temp(f"0 if {args[0]} else 1")
+    if operator == "u|": return self.temp(f"1 if {args[0]} else 0")
+    if operator == "u&": return self.temp(f"1 if {args[0]} == {mask(sizes[0])} else 0")
+    if operator == "u~&": return self.temp(f"0 if {args[0]} == {mask(sizes[0])} else 1")
+    if operator == "u^": return self.temp(f"({args[0]}).bit_count() & 1")
+    if operator == "u~^": return self.temp(f"({args[0]}).bit_count() & 1 ^ 1")
+    if operator == "?" and args[1] == args[2]: return self.temp(f"{args[1]}{fit}") if fit else args[1]
+    if operator == "?": return self.temp(f"({args[1]} if {args[0]} else {args[2]}){fit}")
+    if operator == "tsb" and args[1] == "0": return "0"
+    if operator == "tsb": return self.temp(f"({args[1]} if {args[0]} else 0){fit}")
+    if operator == "{}":
+      shifts, position = [], 0
+      for arg, size in zip(reversed(args), reversed(sizes)):
+        shifts.append(arg if position == 0 else f"{arg} << {position}")
+        position += size
+      return self.temp(" | ".join(reversed(shifts)) + (f" & {m}" if position > want else ""))
+    raise ValueError(f"Unsupported operator {operator}")
+
+  def merge(self, net: Net, pieces, base=None):
+    # pieces are (lsb, code) of the net's drivers; base is an input's own value for an inout
+    terms = [base] if base is not None else []
+    terms += [code if lsb == 0 else f"{code} << {lsb}" for lsb, code in pieces]
+    return " | ".join(terms) if terms else "0"
+
+
+class BitCode:
+  # every bit of every net is one Python int holding that bit for all lanes, so the bitwise operators
+  # evaluate up to lanes independent vectors at once
+  def __init__(self, widths: Widths, lanes):
+    self.widths = widths
+    self.ones = str(mask(lanes))
+    self.lines: List[str] = []
+    self.temps = 0
+    self.known: Dict[str, str] = {}
+
+  def temp(self, code):
+    if code in self.known: return self.known[code]
+    name = f"t{self.temps}"
+    self.temps += 1
+    self.lines.append(f"  {name} = {code}")
+    self.known[code] = name
+    return name
+
+  def constant(self, value, width):
+    return [self.ones if value >> i & 1 else "0" for i in range(width)]
+
+  def net(self, bits, net_width, lsb, width, want):
+    selected = bits[lsb:lsb + min(width, want)]
+    return selected + ["0"] * (want - len(selected))
+
+  def AND(self, a, b):
+    if a == "0" or b == "0": return "0"
+    if a == self.ones: return b
+    if b == self.ones: return a
+    return self.temp(f"{a} & {b}")
+
+  def OR(self, a, b):
+    if a == self.ones or b == self.ones: return self.ones
+    if a == "0": return b
+    if b == "0": return a
+    return self.temp(f"{a} | {b}")
+
+  def XOR(self, a, b):
+    if a == "0": return b
+    if b == "0": return a
+    if a == self.ones: return self.NOT(b)
+    if b == self.ones: return self.NOT(a)
+    return self.temp(f"{a} ^ {b}")
+
+  def NOT(self, a):
+    if a == "0": return self.ones
+    if a == self.ones: return "0"
+    return self.temp(f"{a} ^ {self.ones}")
+
+  def MUX(self, select, high, low):
+    if high == low: return high
+    return self.OR(self.AND(select, high), self.AND(self.NOT(select), low))
+
+  def any(self, bits):
+    result = "0"
+    for bit in bits: result = self.OR(result, bit)
+    return result
+
+  def all(self, bits):
+    result = self.ones
+    for bit in bits: result = self.AND(result, bit)
+    return result
+
+  def add(self, a, b, carry="0"):
+    result = []
+    for x, y in zip(a, b):
+      half = self.XOR(x, y)
+      result.append(self.XOR(half, carry))
+      carry = self.OR(self.AND(x, y), self.AND(carry, half))
+    return result, carry
+
+  def shift(self, bits, amount, left):
+    # a barrel shifter, one stage per bit of the amount
+    width = len(bits)
+    for k, select in enumerate(amount):
+      if select == "0": continue
+      distance = 1 << k
+      if distance >= width:
+        bits = [self.AND(self.NOT(select), bit) for bit in bits]
+        continue
+      shifted = ["0"] * distance + bits[:width - distance] if left else bits[distance:] + ["0"] * distance
+      bits = [self.MUX(select, s, b) for s, b in zip(shifted, bits)]
+    return bits
+
+  def less(self, a, b):
+    # a < b exactly when a - b borrows
+    _, carry = self.add(a, [self.NOT(bit) for bit in b], self.ones)
+    return self.NOT(carry)
+
+  def combine(self, expression, want, args, sizes, work):
+    kind = expression[0]
+    if kind == "slice":
+      selected = args[0][expression[2]:expression[2] + min(expression[3], want)]
+      return selected + ["0"] * (want - len(selected))
+    if kind == "rep": return (args[0] * expression[1] + ["0"] * want)[:want]
+    operator = expression[1]
+    if operator in ("&", "|", "^", "~^"):
+      step = {"&": self.AND, "|": self.OR, "^": self.XOR, "~^": self.XOR}[operator]
+      result = []
+      for i in range(want):
+        bit = args[0][i]
+        for arg in args[1:]: bit = step(bit, arg[i])
+        result.append(self.NOT(bit) if operator == "~^" else bit)
+      return result
+    if operator == "+":
+      result = args[0]
+      for arg in args[1:]: result, _ = self.add(result, arg)
+      return result[:want]
+    if operator == "-": return self.add(args[0], [self.NOT(bit) for bit in args[1]], self.ones)[0][:want]
+    if operator == "*":
+      # multiplication by a constant only, as shifted additions
+      constant = next((arg for arg in args if all(bit in ("0", self.ones) for bit in arg)), None)
+      if constant is None or len(args) != 2: raise ValueError("Only multiplication by a constant is compiled in bit-parallel mode")
+      other = args[1] if constant is args[0] else args[0]
+      result = ["0"] * work
+      for k, bit in enumerate(constant):
+        if bit != "0": result, _ = self.add(result, ["0"] * k + other[:work - k])
+      return result[:want]
+    if operator in ("<<", "<<<", ">>", ">>>"): return self.shift(args[0], args[1], operator.startswith("<"))[:want]
+    if operator in COMPARISONS:
+      a, b = args
+      if operator in ("=", "===", "!=", "!=="):
+        equal = self.all([self.NOT(self.XOR(x, y)) for x, y in zip(a, b)])
+        bit = equal if operator in ("=", "===") else self.NOT(equal)
+      elif operator == "<": bit = self.less(a, b)
+      elif operator == ">": bit = self.less(b, a)
+      elif operator == "<=": bit = self.NOT(self.less(b, a))
+      else: bit = self.NOT(self.less(a, b))
+      return [bit] + ["0"] * (want - 1)
+    if operator == "u~": return [self.NOT(bit) for bit in args[0]][:want]
+    if operator == "u-": return self.add(["0"] * len(args[0]), [self.NOT(bit) for bit in args[0]], self.ones)[0][:want]
+    if operator == "u+": return args[0][:want]
+    if operator in ("u!", "u|", "u~|", "u&", "u~&", "u^", "u~^"):
+      if operator in ("u&", "u~&"): bit = self.all(args[0])
+      elif operator in ("u^", "u~^"):
+        bit = "0"
+        for item in args[0]: bit = self.XOR(bit, item)
+      else: bit = self.any(args[0])
+      if operator in ("u!", "u~|", "u~&", "u~^"): bit = self.NOT(bit)
+      return [bit] + ["0"] * (want - 1)
+    if operator == "?":
+      select = self.any(args[0])
+      return [self.MUX(select, high, low) for high, low in zip(args[1], args[2])][:want]
+    if operator == "tsb":
+      select = self.any(args[0])
+      return [self.AND(select, bit) for bit in args[1]][:want]
+    if operator == "{}":
+      bits = []
+      for arg in reversed(args): bits += arg
+      return (bits + ["0"] * want)[:want]
+    raise ValueError(f"Unsupported operator {operator} in bit-parallel mode")
+
+  def merge(self, net: Net, pieces, base=None):
+    bits = list(base) if base is not None else ["0"] * net.width
+    for lsb, code in pieces:
+      for i, bit in enumerate(code): bits[lsb + i] = self.OR(bits[lsb + i], bit)
+    return bits
+
+
+def operand_widths(expression, want, widths: Widths):
+  # the width each child is evaluated at and the width the operator works at: operands of arithmetic and
+  # bitwise operators are extended to the width of the context, like Verilog, the rest keep their own
+  sizes = [widths(child) for child in children_of(expression)]
+  kind = expression[0]
+  if kind == "slice": return [max(sizes[0], expression[2] + expression[3])], want
+  if kind == "rep": return sizes, want
+  operator = expression[1]
+  work = max([want] + sizes)
+  if operator in COMPARISONS:
+    size = max(sizes)
+    return [size, size], want
+  if operator in ("<<", "<<<", ">>", ">>>", "**"):
+    work = max(want, sizes[0])
+    return [work, sizes[1]], work
+  if operator in ("?", "tsb"):
+    work = max([want] + sizes[1:])
+    return [sizes[0]] + [work] * (len(sizes) - 1), work
+  if operator in ("{}",) or operator in ("u!", "u&", "u|", "u^", "u~&", "u~|", "u~^"): return sizes, want
+  return [work] * len(sizes), work
+
+
+class Compiler:
+  def __init__(self, netlist: Netlist, lanes=None):
+    self.netlist = netlist
+    self.lanes = lanes
+    self.order, self.level = netlist.levelize()
+    self.slots: Dict[str, tuple] = {}
+    for name in self.order:
+      net = netlist.nets[name]
+      if net.kind in EDGES or net.kind == "latch":
+        self.slots[name] = (sum(width for _, width in self.slots.values()) if lanes else len(self.slots), net.width)
+    self.variables = {name: f"n{i}" for i, name in enumerate(self.order)}
+
+  def code(self):
+    return BitCode(self.netlist.widths, self.lanes) if self.lanes else ScalarCode(self.netlist.widths)
+
+  def value(self, code, root, want, values, cache):
+    # code for an expression at exactly want bits; post-order with an explicit stack
+    results = []
+    work = [(root, want, False)]
+    while work:
+      expression, width, ready = work.pop()
+      key = (id(expression), width)
+      if key in cache:
+        results.append(cache[key])
+        continue
+      kind = expression[0]
+      if kind == "const": result = code.constant(expression[1], width)
+      elif kind == "net":
+        net = self.netlist.nets[expression[1]]
+        result = code.net(values[expression[1]], net.width, expression[2], expression[3], width)
+      elif not ready:
+        work.append((expression, width, True))
+        child_widths, _ = operand_widths(expression, width, self.netlist.widths)
+        work.extend((child, child_width, False) for child, child_width in reversed(list(zip(children_of(expression), child_widths))))
+        continue
+      else:
+        children = children_of(expression)
+        args = results[len(results) - len(children):]
+        del results[len(results) - len(children):]
+        child_widths, working = operand_widths(expression, width, self.netlist.widths)
+        result = code.combine(expression, width, args, child_widths, working)
+      cache[key] = result
+      results.append(result)
+    return results[0]
+
+  def cone(self, roots):
+    # the combinational nets the roots depend on
+    needed = set()
+    work = list(roots)
+    while work:
+      name = work.pop()
+      if name in needed: continue
+      needed.add(name)
+      work.extend(self.netlist.dependencies(self.netlist.nets[name]))
+    return needed
+
+  def phase(self, code, edge=None, outputs=False):
+    # settle the logic that the edge's registers and/or the top outputs depend on, then clock the registers
+    nets = self.netlist.nets
+    registers = [name for name in self.order if nets[name].kind == edge]
+    roots = set(self.netlist.outputs) if outputs else set()
+    for name in registers: roots |= net_references(nets[name].drivers[0][2]) | {name}
+    needed = self.cone(roots)
+    values: Dict[str, object] = {}
+    cache: Dict[tuple, object] = {}
+    code.known.clear()
+    for name in self.order:
+      if name not in needed: continue
+      net = nets[name]
+      variable = self.variables[name]
+      if net.kind in EDGES:
+        values[name] = self.load(code, name, variable)
+        continue
+      base = self.load_input(code, name, variable) if net.kind == "input" else None
+      if base is not None and not net.drivers:
+        values[name] = base
+        continue
+      # a latch reads its held value while it settles
+      if net.kind == "latch": values[name] = self.load(code, name, variable)
+      pieces = [(lsb, self.value(code, expression, width, values, cache)) for lsb, width, expression in net.drivers]
+      values[name] = self.store(code, name, variable, code.merge(net, pieces, base))
+      if net.kind == "latch":
+        self.save(code, name, values[name])
+        # the latch's variable may now hold its new value, so code read from the held one can't be reused
+        code.known.clear()
+    updates = [(name, self.value(code, nets[name].drivers[0][2], nets[name].width, values, cache)) for name in registers]
+    for name, update in updates: self.save(code, name, update)
+    if outputs: code.lines.append("  return {" + ", ".join(f"{name!r}: {self.output(values[name])}" for name in self.netlist.outputs) + "}")
+
+  def load(self, code, name, variable):
+    slot, width = self.slots[name]
+    if not self.lanes:
+      code.lines.append(f"  {variable} = state[{slot}]")
+      return variable
+    bits = [f"{variable}_{i}" for i in range(width)]
+    code.lines.append(f"  {', '.join(bits)}, = state[{slot}:{slot + width}]")
+    return bits
+
+  def load_input(self, code, name, variable):
+    width = self.netlist.nets[name].width
+    if not self.lanes:
+      code.lines.append(f"  {variable} = inputs.get({name!r}, 0) & {mask(width)}")
+      return variable
+    bits = [f"{variable}_{i}" for i in range(width)]
+    code.lines.append(f"  {', '.join(bits)}, = inputs.get({name!r}, ZEROS)[:{width}]")
+    return bits
+
+  def store(self, code, name, variable, merged):
+    if not self.lanes:
+      # a net that is just another net or temp takes its variable instead of a copy, named in a comment
+      if merged.isidentifier():
+        code.lines.append(f"  # {name} = {merged}")
+        return merged
+      code.lines.append(f"  {variable} = {merged}  # {name}")
+      return variable
+    return merged
+
+  def save(self, code, name, value):
+    slot, width = self.slots[name]
+    if not self.lanes: code.lines.append(f"  state[{slot}] = {value}")
+    else: code.lines.append(f"  state[{slot}:{slot + width}] = {', '.join(value)},")
+
+  def output(self, value):
+    return value if not self.lanes else "[" + ", ".join(value) + "]"
+
+  def function(self, name, phases):
+    code = self.code()
+    code.lines.append(f"def {name}(inputs, state):")
+    for edge, outputs in phases: self.phase(code, edge, outputs)
+    if not any(outputs for _, outputs in phases): code.lines.append("  return None")
+    return code.lines
+
+  def source(self):
+    edges = [edge for edge in EDGES if any(net.kind == edge for net in self.netlist.nets.values())]
+    lines = []
+    for edge in edges: lines += self.function(edge, [(edge, False)]) + [""]
+    lines += self.function("evaluate", [(None, True)]) + [""]
+    # one clock cycle: the rising edge, the outputs after it, then the falling edge
+    cycle = [("posedge", False)] if "posedge" in edges else []
+    cycle.append(("negedge" if "negedge" in edges else None, True))
+    lines += self.function("cycle", cycle)
+    return "\n".join(lines) + "\n"
+
+
+class Simulator:
+  # a compiled top module with its register state; inputs and outputs are dicts by port name. With
+  # lanes set, every port value is a list of bit planes, see pack and unpack
+  def __init__(self, modules: Dict[str, Module], top_name: str, lanes=None):
+    self.netlist = Netlist(modules, top_name)
+    compiler = Compiler(self.netlist, lanes)
+    self.lanes = lanes
+    self.source = compiler.source()
+    self.slots = compiler.slots
+    self.levels = max(compiler.level.values(), default=0)
+    self.inputs = {name: self.netlist.nets[name].width for name in self.netlist.inputs}
+    self.outputs = {name: self.netlist.nets[name].width for name in self.netlist.outputs}
+    namespace = {"ZEROS": (0,) * max(self.inputs.values(), default=0)}
+    exec(compile(self.source, f"<compiled {top_name}>", "exec"), namespace)
+    self.functions = namespace
+    self.state = [0] * sum(width for _, width in self.slots.values()) if lanes else [0] * len(self.slots)
+
+  def posedge(self, inputs):
+    if "posedge" in self.functions: self.functions["posedge"](inputs, self.state)
+
+  def negedge(self, inputs):
+    if "negedge" in self.functions: self.functions["negedge"](inputs, self.state)
+
+  def evaluate(self, inputs):
+    return self.functions["evaluate"](inputs, self.state)
+
+  def cycle(self, inputs):
+    return self.functions["cycle"](inputs, self.state)
+
+  def register(self, name):
+    slot, width = self.slots[name]
+    return self.state[slot] if not self.lanes else self.state[slot:slot + width]
+
+
+def pack(values: List[int], width):
+  # one int per lane -> one int per bit holding that bit of every lane
+  planes = [0] * width
+  for lane, value in enumerate(values):
+    for i in range(width):
+      if value >> i & 1: planes[i] |= 1 << lane
+  return planes
+
+
+def unpack(planes: List[int], lanes):
+  values = [0] * lanes
+  for i, plane in enumerate(planes):
+    for lane in range(lanes):
+      if plane >> lane & 1: values[lane] |= 1 << i
+  return values
+
+
+def benchmark(simulator: Simulator, cycles, seed=0):
+  # cycles with fresh random inputs every cycle; returns cycles per second (per lane)
+  rng = random.Random(seed)
+  stimulus = []
+  for _ in range(min(cycles, 64)):
+    inputs = {name: rng.getrandbits(width) for name, width in simulator.inputs.items()}
+    if simulator.lanes: inputs = {name: [rng.getrandbits(simulator.lanes) for _ in range(width)] for name, width in simulator.inputs.items()}
+    stimulus.append(inputs)
+  cycle = simulator.functions["cycle"]
+  state = simulator.state
+  start = time.perf_counter()
+  for k in range(cycles): cycle(stimulus[k % len(stimulus)], state)
+  return cycles / (time.perf_counter() - start)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Compile a Verilog top module into a straight-line Python simulator.")
+  parser.add_argument("top", help="top module to compile")
+  parser.add_argument("--file-list", default="files.txt", help="file listing the Verilog sources (default: files.txt)")
+  parser.add_argument("--lanes", type=int, default=0, help="simulate this many vectors at once, one bit per lane")
+  parser.add_argument("--emit", metavar="PATH", help="write the generated Python to PATH")
+  parser.add_argument("--benchmark", type=int, metavar="CYCLES", default=0, help="time this many cycles with random inputs")
+  args = parser.parse_args(argv)
+
+  try: modules = LazyModules(read_file_list(args.file_list))
+  except FileNotFoundError as e:
+    print(f"Error: {e}")
+    sys.exit(1)
+  start = time.perf_counter()
+  simulator = Simulator(modules, args.top, lanes=args.lanes or None)
+  elapsed = time.perf_counter() - start
+  state_bits = sum(width for _, width in simulator.slots.values())
+  print(f"{args.top}: {len(simulator.netlist.nets)} nets, {simulator.levels} levels, {state_bits} state bits, {simulator.source.count(chr(10))} lines of Python in {elapsed:.2f}s")
+  if args.emit:
+    with open(args.emit, "w") as f: f.write(simulator.source)
+  if args.benchmark:
+    rate = benchmark(simulator, args.benchmark)
+    lanes = simulator.lanes or 1
+    print(f"{rate:,.0f} cycles/s" + (f", {rate * lanes:,.0f} vector-cycles/s over {lanes} lanes" if simulator.lanes else ""))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,353 @@
+import argparse
+import heapq
+import itertools
+import json
+import math
+import sys
+from collections import deque
+from typing import Dict, List
+
+from schematic_export import gate_children
+from schematic_generator import TOKEN, Block, Gate, Inout, LazyModules, Node, Output, Reg, Schematic, Wire, build_schematic, get_module, instance_ports, read_file_list
+from schematic_partition import PIPELINE_REGISTERS, PIPELINE_STAGES, stage_partition
+
+
+def is_constant(leaf: str):
+  return leaf[0].isdigit() or leaf[0] == "'"
+
+
+def leaf_net(leaf: str):
+  # the node a gate input reads, without its bit select
+  return leaf.split("[", 1)[0]
+
+
+# output port -> the input ports that reach it without a clock edge, for the clocked modules that have such
+# read ports, like the register file's selects; --delays can add to them with "read_ports"
+REGISTER_READ_PORTS = {"abus": ["Aselect"], "bbus": ["Bselect"]}
+READ_PORTS = {"regfile": REGISTER_READ_PORTS, "reg_cell": REGISTER_READ_PORTS, "zero_reg": REGISTER_READ_PORTS}
+
+
+def default_gate_delay(gate_name):
+  # concatenation and replication are wiring, every other gate is one level
+  return 0 if gate_name.startswith("{") else 1
+
+
+def read_port_nets(modules, top_name, schematic: Schematic, read_ports=None):
+  # block name -> output net -> the nets on the read ports reaching it, for each clocked block whose module
+  # is in read_ports, found from its instance line in the module it sits in
+  read_ports = READ_PORTS if read_ports is None else read_ports
+  found: Dict[str, set] = {}
+  for node in schematic.nodes.values():
+    if not (isinstance(node, Block) and node.clocked and node.module_name in read_ports): continue
+    *parents, instance = node.name.split("/")
+    module = get_module(modules, top_name)
+    for parent in parents:
+      line = module.lines[module.fanout().instance_lines(parent)[0]]
+      module = get_module(modules, TOKEN.match(line.strip()).group())
+    prefix = "".join(f"{parent}/" for parent in parents)
+    nets = {port: prefix + leaf_net(net) for port, net in instance_ports(module, instance)}
+    found[node.name] = {nets[output]: {nets[port] for port in inputs if port in nets} for output, inputs in read_ports[node.module_name].items() if output in nets}
+  return found
+
+
+class TimingAnalysis:
+  # static timing of a schematic in gate levels, or in the delays given per gate name and per module name.
+  # Paths launch at the top inputs, registers and clocked blocks and are captured at registers, clocked blocks
+  # and top outputs. A clocked block given read nets also passes them through to the outputs they reach, like
+  # the read ports of a register file, so a read path is timed from the register before it. The nodes are put in
+  # topological order once; each propagation then visits every node and walks every gate tree once, so the
+  # analysis is linear in the size of the schematic, once per stage
+  def __init__(self, schematic: Schematic, gate_delays: Dict[str, float] = None, module_delays: Dict[str, float] = None, read_nets: Dict[str, Dict[str, set]] = None):
+    self.schematic = schematic
+    self.gate_delays = gate_delays or {}
+    self.module_delays = module_delays or {}
+    self.read_nets = read_nets or {}
+    self.read_inputs = {name: set().union(*outputs.values()) for name, outputs in self.read_nets.items()}
+    self.inputs_of: Dict[str, List[str]] = {name: [] for name in schematic.nodes}
+    for name, node in schematic.nodes.items():
+      for output in node.outputs: self.inputs_of[output.name].append(name)
+    # a net nothing in the schematic drives or reads, like the ports of an always block inside an expanded
+    # instance, starts or ends a path too
+    top_inputs = {node.name for node in schematic.inputs}
+    self.starts = [name for name, node in schematic.nodes.items() if name in top_inputs or self.is_sequential(node) or not self.inputs_of[name]]
+    self.start_set = set(self.starts)
+    self.ends = [name for name, node in schematic.nodes.items() if self.is_sequential(node) or type(node) == Output or type(node) == Inout or not node.outputs]
+    self.loops = 0
+    self.order = self.topological_order()
+    self.position = {name: i for i, name in enumerate(self.order)}
+    # the gates on the way from each net a gate tree reads to its output, built on first use
+    self.leaf_paths: Dict[str, Dict[str, tuple]] = {}
+    if has_pipeline(schematic):
+      self.stages = stage_partition(schematic)
+      self.stage_names = [stage for stage in PIPELINE_STAGES if stage in {self.stages[name] for name in self.starts}]
+    else:
+      self.stages = {name: schematic.name for name in schematic.nodes}
+      self.stage_names = [schematic.name]
+    self.timing = self.propagate(self.starts)
+    self.boundary_timing = None
+
+  @staticmethod
+  def is_sequential(node: Node):
+    return type(node) == Reg or (type(node) == Block and bool(node.clocked))
+
+  def gate_delay(self, gate_name):
+    return self.gate_delays.get(gate_name, default_gate_delay(gate_name))
+
+  def captured_inputs(self, name):
+    return [input_name for input_name in self.inputs_of[name] if input_name not in self.read_inputs.get(name, ())]
+
+  def holds(self, name, input_name):
+    # whether the arrival of a node waits for an input: a start point only waits for its read nets
+    return name not in self.start_set or input_name in self.read_inputs.get(name, ())
+
+  def topological_order(self):
+    # Kahn's algorithm over the combinational edges; the inputs of a start point don't hold back its launch
+    nodes = self.schematic.nodes
+    waiting = {name: sum(self.holds(name, input_name) for input_name in inputs) for name, inputs in self.inputs_of.items()}
+    ready = deque(name for name, count in waiting.items() if count == 0)
+    order = []
+    unordered = iter(nodes)
+    while True:
+      while ready:
+        name = ready.popleft()
+        order.append(name)
+        for output in nodes[name].outputs:
+          if not self.holds(output.name, name): continue
+          waiting[output.name] -= 1
+          if waiting[output.name] == 0: ready.append(output.name)
+      # a combinational loop never becomes ready; it is broken at its first node in schematic order and counted
+      stuck = next((name for name in unordered if waiting[name] > 0), None)
+      if stuck is None: return order
+      self.loops += 1
+      waiting[stuck] = 0
+      ready.append(stuck)
+
+  def propagate(self, launch):
+    # (arrival, data, read) for paths from the launch start points. arrival is when the value of a node is
+    # ready, data when its inputs are, which for an end point is when its path is captured. read gives, for a
+    # block with read nets, the arrival at each output they reach. A node no launched path reaches is at -inf
+    launch = set(launch)
+    timing = ({}, {}, {})
+    for name in self.order: self.time_node(self.schematic.nodes[name], launch, timing)
+    # the start points were timed before their inputs, so capture their data again now every input is timed
+    for name in self.ends:
+      if name in self.start_set: self.time_node(self.schematic.nodes[name], launch, timing, capture=True)
+    return timing
+
+  def time_node(self, node: Node, launch, timing, capture=False):
+    arrival, data, read = timing
+    if isinstance(node, Wire) and node.gate is not None: latest = self.gate_arrival(node.gate, arrival)
+    else:
+      latest = -math.inf
+      # a read net passes through the block, it isn't captured by it
+      for name in self.captured_inputs(node.name):
+        latest = max(latest, arrival.get(name, -math.inf))
+        if name in read and node.name in read[name]: latest = max(latest, read[name][node.name])
+    data[node.name] = latest
+    if capture: return
+    module_delay = self.module_delays.get(node.module_name, 0 if node.clocked else 1) if type(node) == Block else 0
+    if node.name not in self.start_set:
+      arrival[node.name] = latest + module_delay
+      return
+    arrival[node.name] = module_delay if node.name in launch else -math.inf
+    if node.name in self.read_nets:
+      # through its read ports the block is combinational and counts like one
+      read[node.name] = {}
+      for output, inputs in self.read_nets[node.name].items():
+        read[node.name][output] = max((arrival.get(name, -math.inf) for name in inputs), default=-math.inf) + self.read_delay(node)
+
+  def read_delay(self, node: Node):
+    return self.module_delays.get(node.module_name, 1)
+
+  def node_delay(self, node: Node):
+    # the delay of a node that doesn't start a path: a combinational block's own, nothing for a net
+    return self.module_delays.get(node.module_name, 1) if type(node) == Block else 0
+
+  def gate_arrival(self, gate: Gate, arrival):
+    # the output time of a gate tree from the arrival of the nets it reads. Post-order with a stack, like the
+    # other gate tree walks
+    results = {}
+    work = [(gate, False)]
+    while work:
+      item, expanded = work.pop()
+      if not expanded:
+        work.append((item, True))
+        work.extend((child, False) for child in gate_children(item) if isinstance(child, Gate))
+        continue
+      latest = -math.inf
+      for child in gate_children(item):
+        if isinstance(child, Gate): latest = max(latest, results[id(child)])
+        elif not is_constant(child): latest = max(latest, arrival.get(leaf_net(child), -math.inf))
+      results[id(item)] = latest + self.gate_delay(item.name)
+    return results[id(gate)]
+
+  def leaf_path(self, node: Node, name):
+    # (delay, gates, input first) of the latest way from the net name through the gate tree of node, or None
+    # when the tree doesn't read it
+    if node.name not in self.leaf_paths:
+      paths = {}
+      work = [(node.gate, 0, ())]
+      while work:
+        item, delay, gates = work.pop()
+        delay, gates = delay + self.gate_delay(item.name), (item.name,) + gates
+        for child in gate_children(item):
+          if isinstance(child, Gate): work.append((child, delay, gates))
+          elif not is_constant(child) and delay > paths.get(leaf_net(child), (-math.inf,))[0]: paths[leaf_net(child)] = (delay, list(gates))
+      self.leaf_paths[node.name] = paths
+    return self.leaf_paths[node.name].get(name)
+
+  def edges_into(self, name, capture=False):
+    # (input, delay, gates) of every timed edge into a node: through its gate tree for a gated net, with the
+    # node's own delay added. Only inputs ordered before it were timed into it, unless it is a start point
+    # capturing its data, which is timed once every input is
+    node = self.schematic.nodes[name]
+    gated = isinstance(node, Wire) and node.gate is not None
+    delay = 0 if capture else self.node_delay(node)
+    edges = []
+    for input_name in dict.fromkeys(self.captured_inputs(name)):
+      if not capture and self.position[input_name] >= self.position[name]: continue
+      if not gated:
+        edges.append((input_name, delay, []))
+        continue
+      through = self.leaf_path(node, input_name)
+      if through is not None: edges.append((input_name, through[0] + delay, through[1]))
+    return edges
+
+  def worst_paths(self, count=5, timing=None, ends=None):
+    # the count latest distinct paths into the end points, latest first, each as (delay, steps) with the steps
+    # (node, gates passed inside it, arrival) from the start point on. Best-first search backward from the end
+    # points: a partial path is ranked by the arrival at its first node plus the delay after it, which is the
+    # latest way to finish it, so paths come out in order. Each step extends one path by one node, so this
+    # adds count times the path length to the propagation
+    arrival, data, read = timing or self.timing
+    queue, found, tie = [], [], itertools.count()
+
+    def reach(name, reader, after, suffix):
+      # the ways on from name into reader, with after the delay from name's arrival to the end point
+      if name not in self.start_set:
+        if arrival.get(name, -math.inf) > -math.inf: heapq.heappush(queue, (-(arrival[name] + after), next(tie), name, after, suffix))
+        return
+      if arrival[name] > -math.inf: heapq.heappush(queue, (-(arrival[name] + after), next(tie), None, after, ((name, [], arrival[name]),) + suffix))
+      # the block's read ports carry the path on to the read nets before it
+      delay = self.read_delay(self.schematic.nodes[name]) if name in self.read_nets else 0
+      for read_name in self.read_nets.get(name, {}).get(reader, ()): reach(read_name, name, after + delay, ((name, [], delay),) + suffix)
+
+    for name in ends if ends is not None else self.ends:
+      if data[name] == -math.inf: continue
+      for input_name, delay, gates in self.edges_into(name, capture=name in self.start_set): reach(input_name, name, delay, ((name, gates, delay),))
+    while queue and len(found) < count:
+      latest, _, name, after, suffix = heapq.heappop(queue)
+      if name is None:
+        steps, time = [], 0
+        for step_name, gates, delay in suffix:
+          time += delay
+          steps.append((step_name, gates, time))
+        found.append((-latest, steps))
+        continue
+      for input_name, delay, gates in self.edges_into(name): reach(input_name, name, after + delay, ((name, gates, delay),) + suffix)
+    return found
+
+  def boundary(self, steps):
+    # the stage a path launches in and the stage of the register or port capturing it
+    launch, capture = self.stages[steps[0][0]], self.stages[steps[-1][0]]
+    return launch if len(self.stage_names) == 1 and launch == capture else f"{launch} -> {capture}"
+
+  def boundary_worst(self):
+    # boundary -> the worst path across it, as (delay, steps), in stage order. Each launch stage is propagated
+    # on its own, and its end points are grouped by the stage they capture in
+    if self.boundary_timing is None:
+      self.boundary_timing = {}
+      order = {stage: i for i, stage in enumerate(self.stage_names + [stage for stage in PIPELINE_STAGES if stage not in self.stage_names])}
+      for stage in self.stage_names:
+        timing = self.propagate(name for name in self.starts if self.stages[name] == stage)
+        captures: Dict[str, List[str]] = {}
+        for name in self.ends:
+          if timing[1][name] > -math.inf: captures.setdefault(self.stages[name], []).append(name)
+        for capture in sorted(captures, key=lambda capture: order.get(capture, len(order))):
+          worst = self.worst_paths(1, timing, [max(captures[capture], key=lambda name: timing[1][name])])
+          if worst: self.boundary_timing[self.boundary(worst[0][1])] = worst[0]
+    return self.boundary_timing
+
+  def describe(self, name, gates=()):
+    node = self.schematic.nodes[name]
+    text = f"{name} ({node.module_name})" if type(node) == Block else name
+    return f"[{' '.join(gates)}] {text}" if gates else text
+
+  def path_text(self, steps):
+    return " -> ".join(self.describe(name, gates) for name, gates, _ in steps)
+
+  def path_record(self, steps):
+    return [{"node": name, "gates": gates, "arrival": arrival} for name, gates, arrival in steps]
+
+  def report(self, count=5):
+    paths = self.worst_paths(count)
+    return {
+      "module": self.schematic.name,
+      "nodes": len(self.schematic.nodes),
+      "loops": self.loops,
+      "worst": paths[0][0] if paths else 0,
+      "boundaries": {boundary: {"delay": delay, "end": steps[-1][0], "path": self.path_record(steps)} for boundary, (delay, steps) in self.boundary_worst().items()},
+      "paths": [{"delay": delay, "end": steps[-1][0], "boundary": self.boundary(steps), "path": self.path_record(steps)} for delay, steps in paths],
+    }
+
+  def summary(self, count=5):
+    lines = [f"{self.schematic.name}: {len(self.schematic.nodes)} nodes, {len(self.starts)} start points, {len(self.ends)} end points"]
+    if self.loops: lines[0] += f", {self.loops} combinational loops broken"
+    lines.append(f"{'boundary':<12}{'delay':>7}  worst path")
+    for boundary, (delay, steps) in self.boundary_worst().items(): lines.append(f"{boundary:<12}{delay:>7g}  {self.path_text(steps)}")
+    lines.append("critical paths:")
+    for rank, (delay, steps) in enumerate(self.worst_paths(count), 1): lines.append(f"{rank:>3}. {delay:g} ({self.boundary(steps)}): {self.path_text(steps)}")
+    return "\n".join(lines)
+
+
+def has_pipeline(schematic: Schematic):
+  return any(isinstance(node, Block) and node.module_name in PIPELINE_REGISTERS for node in schematic.nodes.values())
+
+
+def compare(report, baseline, tolerance=0):
+  # the stage boundaries whose worst delay grew over the baseline report by more than tolerance
+  regressions = []
+  for boundary, result in report["boundaries"].items():
+    before = baseline.get("boundaries", {}).get(boundary)
+    if before is not None and result["delay"] > before["delay"] + tolerance: regressions.append(f"{boundary}: {before['delay']:g} -> {result['delay']:g} at {result['end']}")
+  return regressions
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Report the logic depth of each pipeline stage and the critical paths of a Verilog top module.")
+  parser.add_argument("top", help="top module to analyze")
+  parser.add_argument("--file-list", default="files.txt", help="file listing the Verilog sources (default: files.txt)")
+  parser.add_argument("--depth", type=int, default=0, help="expand module instances this many levels down before timing, for modules without pipeline registers (default: 0)")
+  parser.add_argument("--paths", type=int, default=5, help="number of worst distinct paths to list (default: 5)")
+  parser.add_argument("--delays", metavar="PATH", help='JSON file of delays, {"gates": {"+": 4}, "modules": {"alu64": 12}, "read_ports": {"regfile": {"abus": ["Aselect"]}}}; other gates count 1, other modules 1 or 0 when clocked')
+  parser.add_argument("--output", metavar="PATH", help="write the report as JSON")
+  parser.add_argument("--compare", metavar="PATH", help="JSON report of an earlier run; exit with status 1 when a stage boundary got deeper")
+  parser.add_argument("--tolerance", type=float, default=0, help="delay a stage may grow by before --compare fails (default: 0)")
+  args = parser.parse_args(argv)
+
+  delays = {}
+  if args.delays:
+    with open(args.delays) as f: delays = json.load(f)
+  try:
+    modules = LazyModules(read_file_list(args.file_list))
+    schematic = build_schematic(modules, args.top)
+    # an expanded pipeline register loses the always block that latches it, so its stage boundary is gone
+    if args.depth > 0 and has_pipeline(schematic): raise ValueError(f"{args.top} has pipeline registers, which --depth would expand; its stages are only timed at --depth 0")
+    if args.depth > 0: schematic = build_schematic(modules, args.top, args.depth)
+    read_nets = read_port_nets(modules, args.top, schematic, {**READ_PORTS, **delays.get("read_ports", {})})
+  except (FileNotFoundError, ValueError) as e:
+    print(f"Error: {e}")
+    sys.exit(1)
+  analysis = TimingAnalysis(schematic, delays.get("gates"), delays.get("modules"), read_nets)
+  print(analysis.summary(args.paths))
+  report = analysis.report(args.paths)
+  if args.output:
+    with open(args.output, "w") as f: json.dump(report, f, indent=2)
+  if args.compare:
+    with open(args.compare) as f: regressions = compare(report, json.load(f), args.tolerance)
+    for regression in regressions: print(f"Deeper: {regression}")
+    if regressions: sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
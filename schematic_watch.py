@@ -0,0 +1,141 @@
+import os
+import time
+from typing import Dict, Set
+
+from schematic_cache import SchematicCache, content_hash
+from schematic_generator import NETLIST_FORMATS, TOKEN, LazyModules, build_schematic, generator_salt, named_module_spans, phase, read_file_list, render_dot
+
+
+def file_stamp(path):
+  # changes whenever an editor saves the file
+  try:
+    status = os.stat(path)
+    return status.st_mtime_ns, status.st_size
+  except FileNotFoundError:
+    return None
+
+
+class WatchedModules(LazyModules):
+  # LazyModules that reads each file into memory instead of mapping it, since an editor may rewrite a file in
+  # place under the mapping, and can re-read the files that changed since
+  def open_sources(self, verilog_files, texts):
+    self.paths = list(verilog_files)
+    self.stamps = []
+    for vfile in self.paths:
+      self.stamps.append(file_stamp(vfile))
+      try:
+        with phase("read_sources"), open(vfile, "rb") as f: data = f.read()
+      except FileNotFoundError:
+        raise FileNotFoundError(f"listed file '{vfile}' does not exist.") from None
+      yield data
+    for text in texts: yield text.encode()
+
+  def refresh(self):
+    # re-reads every file saved since it was last read and returns the names of the modules whose text changed,
+    # appeared or went away. Their parsed modules are dropped; modules that only moved within a file are kept
+    changed: Set[str] = set()
+    for source, path in enumerate(self.paths):
+      stamp = file_stamp(path)
+      if stamp is None or stamp == self.stamps[source]: continue
+      self.stamps[source] = stamp
+      with open(path, "rb") as f: data = f.read()
+      file_hash = content_hash(data)
+      if file_hash == self.file_hashes[source]: continue
+      old_texts = {}
+      for name, start, end in self.file_spans[source]: old_texts.setdefault(name, self.sources[source][start:end])
+      self.sources[source], self.file_hashes[source] = data, file_hash
+      with phase("scan_sources"): self.file_spans[source] = named_module_spans(data)
+      new_texts = {}
+      for name, start, end in self.file_spans[source]: new_texts.setdefault(name, data[start:end])
+      changed |= {name for name in old_texts.keys() | new_texts.keys() if old_texts.get(name) != new_texts.get(name)}
+    if changed:
+      self.index_spans()
+      for name in changed: self.loaded.pop(name, None)
+    return changed
+
+
+def port_interface(module):
+  # what a parent's search reads of an instanced module: the names of its ports by direction
+  return tuple(tuple(module.leafs(keyword)) for keyword in ("input", "output", "inout"))
+
+
+class SchematicWatcher:
+  # keeps the modules, the schematic of every module at every depth used, and the last output of one top
+  # module in memory. After an edit only the changed modules are parsed again, only the schematics that read
+  # them are rebuilt, and the output is only written when the graph it draws changed
+  def __init__(self, module_name, file_list="files.txt", depth=0, format="png", use_digraph=False, cache_dir=None, bundle=False):
+    self.module_name = module_name
+    self.depth = depth
+    self.format = format
+    self.use_digraph = use_digraph
+    self.bundle = bundle
+    self.cache = SchematicCache(cache_dir, salt=generator_salt()) if cache_dir is not None else None
+    self.modules = WatchedModules(read_file_list(file_list), self.cache)
+    # (module name, depth) -> schematic; build_schematic reuses them for instances and never changes them
+    self.templates: Dict[tuple, object] = {}
+    self.output = None
+
+  def children(self, name):
+    # the modules instantiated in a module, found the same way as LazyModules.reachable
+    found = set()
+    for line in self.modules[name].lines[1:]:
+      first_token = TOKEN.match(line)
+      if first_token is not None and first_token.group() in self.modules: found.add(first_token.group())
+    return found
+
+  def stale_templates(self, changed, interfaces_changed):
+    # a schematic is stale when its own module changed, when it instantiates a module whose ports changed, or
+    # when an instance it expanded was built from a stale schematic one level down
+    stale = set()
+    for key in sorted(self.templates, key=lambda key: key[1]):
+      name, depth = key
+      if name in changed or name not in self.modules: stale.add(key)
+      elif any(child in interfaces_changed or (child, depth - 1) in stale for child in self.children(name)): stale.add(key)
+    return stale
+
+  def build(self):
+    # the schematic of the top module from the templates still valid, writing the output if it changed.
+    # Returns whether it was written
+    key = (self.module_name, self.depth)
+    if key in self.templates and self.output is not None: return False
+    self.templates[key] = schematic = build_schematic(self.modules, self.module_name, self.depth, self.templates)
+    if self.format in NETLIST_FORMATS:
+      from schematic_export import netlist_records
+      output = list(netlist_records(schematic))
+    else: output = schematic.dot_source(use_digraph=self.use_digraph, bundle=self.bundle)
+    if output == self.output: return False
+    self.output = output
+    if self.format in NETLIST_FORMATS:
+      from schematic_export import write_netlist
+      write_netlist(schematic, f"{self.module_name}.{self.format}", self.format)
+    else: render_dot(output, self.module_name, self.cache, format=self.format)
+    return True
+
+  def update(self):
+    # one poll of the listed files: returns the changed module names and whether the output was written
+    interfaces = {name: port_interface(module) for name, module in self.modules.loaded.items()}
+    changed = self.modules.refresh()
+    if not changed: return changed, False
+    interfaces_changed = {name for name in changed if name not in self.modules or name not in interfaces or port_interface(self.modules[name]) != interfaces[name]}
+    for key in self.stale_templates(changed, interfaces_changed): del self.templates[key]
+    return changed, self.build()
+
+  def run(self, interval=0.5):
+    start = time.perf_counter()
+    self.build()
+    print(f"{self.module_name}: built in {(time.perf_counter() - start) * 1e3:.1f} ms, watching {len(self.modules.paths)} files (Ctrl-C to stop)")
+    try:
+      while True:
+        time.sleep(interval)
+        start = time.perf_counter()
+        try: changed, written = self.update()
+        except (ValueError, KeyError) as e:
+          # a half-finished edit; the next save tries again
+          print(f"Error: {e}")
+          self.templates.clear()
+          continue
+        if not changed: continue
+        result = f"wrote {self.module_name}.{self.format}" if written else "output unchanged"
+        print(f"{', '.join(sorted(changed))} changed: {result} in {(time.perf_counter() - start) * 1e3:.1f} ms")
+    except KeyboardInterrupt:
+      pass